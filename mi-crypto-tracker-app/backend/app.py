@@ -1,11 +1,38 @@
-rom flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
+import click
+import concurrent.futures
 from flask_cors import CORS
 import csv
+import gzip
+import hashlib
+import json
+import logging
 import os
+import queue
+import shutil
+import sqlite3
+import struct
+import sys
 from datetime import datetime, timedelta, timezone
-from apscheduler.schedulers.background import BackgroundScheduler 
 import asyncio 
 import httpx 
+import numpy as np
+import threading
+import time
+import atexit
+import bisect
+import contextlib
+import math
+import mmap
+import weakref
+from array import array
+from collections import deque, namedtuple
+from itertools import islice
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows: sin elección de líder, cada proceso barre por su cuenta
 
 app = Flask(__name__)
 CORS(app) 
@@ -13,23 +40,526 @@ CORS(app)
 # --- CONFIGURACIÓN BACKEND ---
 KUCOIN_INTERVAL = "1hour" 
 KUCOIN_LIMIT = 200 
+KUCOIN_MAX_CANDLES_PER_REQUEST = 1500 # Máximo de velas que devuelve KuCoin en una petición
+
+# Duración de cada tipo de vela de KuCoin en segundos
+KUCOIN_INTERVAL_SECONDS = {
+    '1min': 60, '3min': 180, '5min': 300, '15min': 900, '30min': 1800,
+    '1hour': 3600, '2hour': 7200, '4hour': 14400, '6hour': 21600, '8hour': 28800,
+    '12hour': 43200, '1day': 86400, '1week': 604800
+}
+
+# Temporalidades: en cada barrido solo se descarga KUCOIN_BASE_INTERVAL y las demás se construyen
+# agrupando esas velas. KUCOIN_INTERVAL sigue siendo la principal (oportunidades, historial, snapshot).
+# Cada temporalidad tiene que ser múltiplo de la base y caber en un día (las velas van alineadas a UTC).
+KUCOIN_BASE_INTERVAL = os.environ.get('KUCOIN_BASE_INTERVAL', '15min')
+ANALYSIS_TIMEFRAMES = tuple(os.environ.get('ANALYSIS_TIMEFRAMES', '15min,1hour,4hour,1day').split(','))
+for _timeframe in set(ANALYSIS_TIMEFRAMES) | {KUCOIN_INTERVAL}:
+    if _timeframe not in KUCOIN_INTERVAL_SECONDS or KUCOIN_INTERVAL_SECONDS[_timeframe] % KUCOIN_INTERVAL_SECONDS[KUCOIN_BASE_INTERVAL] or 86400 % KUCOIN_INTERVAL_SECONDS[_timeframe]:
+        raise ValueError(f"Timeframe {_timeframe} cannot be built from {KUCOIN_BASE_INTERVAL} candles.")
+if KUCOIN_INTERVAL not in ANALYSIS_TIMEFRAMES:
+    ANALYSIS_TIMEFRAMES = (KUCOIN_INTERVAL,) + ANALYSIS_TIMEFRAMES
+
+# URL base de la API (se puede apuntar a un servidor local de pruebas)
+KUCOIN_API_BASE = os.environ.get('KUCOIN_API_BASE', 'https://api.kucoin.com')
+
+# Descarga concurrente de velas: peticiones simultáneas y límite de peticiones.
+# KuCoin permite 2000 de peso cada 30s por IP en el pool público y cada petición
+# de velas pesa 3 (~22 req/s), así que por defecto nos quedamos en 20 req/s.
+KUCOIN_MAX_CONCURRENCY = int(os.environ.get('KUCOIN_MAX_CONCURRENCY', 16))
+KUCOIN_RATE_LIMIT = float(os.environ.get('KUCOIN_RATE_LIMIT', 20))
+KUCOIN_RATE_BURST = int(os.environ.get('KUCOIN_RATE_BURST', 20))
+KUCOIN_MAX_RETRIES = 4 # Reintentos ante HTTP 429
+KUCOIN_BACKOFF_BASE = 1.0 # Segundos, se duplica en cada reintento
+
+# Cliente HTTP compartido (uno por event loop) con HTTP/2 y keep-alive
+KUCOIN_HTTP2 = os.environ.get('KUCOIN_HTTP2', '1') == '1'
+KUCOIN_MAX_CONNECTIONS = int(os.environ.get('KUCOIN_MAX_CONNECTIONS', 20))
+KUCOIN_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('KUCOIN_MAX_KEEPALIVE_CONNECTIONS', 20))
+KUCOIN_KEEPALIVE_EXPIRY = float(os.environ.get('KUCOIN_KEEPALIVE_EXPIRY', 60))
+
+# Motor de indicadores del barrido: 'numpy' (todo el universo en un solo cálculo vectorizado)
+# o 'streaming' (indicadores incrementales símbolo a símbolo)
+ANALYSIS_BACKEND = os.environ.get('ANALYSIS_BACKEND', 'numpy')
+MIN_REQUIRED_KLINES = max(20, 50, 14) + 1
+
+# Respuestas de /get_latest_analysis serializadas una vez por símbolo y barrido (y comprimidas con gzip)
+ANALYSIS_RESPONSE_GZIP = os.environ.get('ANALYSIS_RESPONSE_GZIP', '1') == '1'
+ANALYSIS_RESPONSE_GZIP_LEVEL = 6
+
+# Poner a '0' para importar app.py sin arrancar el scheduler ni el barrido inicial (benchmarks, scripts)
+RUN_BACKGROUND_JOBS = os.environ.get('RUN_BACKGROUND_JOBS', '1') != '0'
+ANALYSIS_INTERVAL = timedelta(minutes=float(os.environ.get('ANALYSIS_INTERVAL_MINUTES', '2'))) # Cada cuánto se barre todo el universo
+WORKER_REQUEST_TIMEOUT = 30 # Segundos que una ruta de Flask espera a una tarea del loop de fondo
+
+# Barrido por niveles: en cada tick se refrescan los símbolos pedidos por clientes y los de más volumen;
+# el resto (la cola) va por turnos hasta completar una vuelta cada TAIL_REFRESH_INTERVAL.
+# El presupuesto de peticiones por tick sale del rate limit (dejando margen para las rutas) si no se fija.
+SWEEP_REQUEST_BUDGET = int(os.environ.get('SWEEP_REQUEST_BUDGET', 0)) # 0 = automático
+SWEEP_BUDGET_RATE_SHARE = 0.8 # Parte del rate limit de KuCoin que puede usar el barrido
+SWEEP_TAIL_MIN_SHARE = 0.2 # Parte del presupuesto reservada a la cola para que nunca se quede sin refrescar
+VOLUME_TIER_SIZE = int(os.environ.get('VOLUME_TIER_SIZE', 50)) # Nº de pares de mayor volumen que van en cada tick
+DEMAND_WINDOW = timedelta(minutes=15) # Un símbolo pedido por un cliente se considera "caliente" durante este tiempo
+TAIL_REFRESH_INTERVAL = timedelta(minutes=float(os.environ.get('TAIL_REFRESH_INTERVAL_MINUTES', '10')))
+VOLUME_REFRESH_INTERVAL = timedelta(minutes=10) # Cada cuánto se vuelve a pedir allTickers
 
 SAVE_REC_TO_BACKEND_INTERVAL = timedelta(hours=1) 
 PRICE_CHANGE_THRESHOLD = 0.03 
 
 CSV_FILE = 'data.csv' 
 LAST_REC_FILE = 'last_recommendations.csv'
+HISTORY_DB_FILE = os.environ.get('HISTORY_DB_FILE', 'history.db') # Historial indexado (SQLite en modo WAL)
+SYMBOLS_CACHE_FILE = 'symbols_cache.json' # Último universo de símbolos filtrado (USDT/USDC)
+ANALYSIS_SNAPSHOT_FILE = 'analysis_snapshot.bin' # Último análisis de todos los símbolos, para arrancar sin esperar al barrido
+SWEEPER_LOCK_FILE = 'sweeper.lock' # Lock (flock) que decide qué proceso hace el barrido
+SNAPSHOT_POLL_SECONDS = 2 # Cada cuánto un proceso seguidor mira si hay snapshot nuevo e intenta ser líder
+FORCED_ANALYSIS_PUBLISH_INTERVAL = 10 # Segundos mínimos entre dos snapshots publicados por análisis forzados (fuera del barrido)
+DEMAND_PUBLISH_INTERVAL = 60 # Segundos mínimos entre dos avisos de demanda del mismo símbolo al líder
+
+# Canal push (SSE) de /stream
+STREAM_MAX_CLIENTS = int(os.environ.get('STREAM_MAX_CLIENTS', 1000))
+STREAM_QUEUE_SIZE = 100 # Eventos pendientes por cliente; si se llena, el cliente se desconecta y reconecta
+STREAM_KEEPALIVE_SECONDS = 15
+STREAM_RETRY_MS = 5000 # Espera que indicamos al EventSource antes de reconectar
+SYMBOLS_CACHE_TTL = timedelta(minutes=float(os.environ.get('SYMBOLS_CACHE_TTL_MINUTES', '30'))) # Pasado este tiempo se refresca en segundo plano
+HISTORY_WINDOW = timedelta(hours=24) # Ventana del historial que se muestra
+
+# Escritura de data.csv: las filas se acumulan durante el barrido y se escriben de una vez.
+# El fichero activo se rota (y se comprime con gzip) al cambiar de día o al superar el tamaño máximo.
+HISTORY_FSYNC = os.environ.get('HISTORY_FSYNC', '1') == '1' # Un fsync por escritura de lote
+HISTORY_ROTATE_DAILY = os.environ.get('HISTORY_ROTATE_DAILY', '1') == '1'
+HISTORY_ROTATE_MAX_BYTES = int(os.environ.get('HISTORY_ROTATE_MAX_BYTES', 10 * 1024 * 1024))
+
+# Agregados del historial (aciertos, riesgos, cambios de recomendación) por símbolo y por hora
+STATS_BUCKET_SECONDS = 3600
+STATS_WINDOWS = {'24h': 24 * 3600, '7d': 7 * 24 * 3600, '30d': 30 * 24 * 3600}
+STATS_RETENTION_SECONDS = max(STATS_WINDOWS.values()) + STATS_BUCKET_SECONDS
+
+# Logs: LOG_LEVEL=DEBUG muestra también el detalle por símbolo; cada evento se limita a
+# LOG_RATE_LIMIT mensajes por ventana de LOG_RATE_WINDOW segundos (el resto se cuenta y se resume)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_RATE_LIMIT = int(os.environ.get('LOG_RATE_LIMIT', 20))
+LOG_RATE_WINDOW = float(os.environ.get('LOG_RATE_WINDOW', 60))
 
 current_analysis_cache = {} 
 
 SYMBOLS_TO_MONITOR = [] 
 
+# --- LOGS ESTRUCTURADOS ---
+# Una línea por evento: "[iso] NIVEL evento clave=valor ...". Con miles de símbolos por barrido el detalle
+# por símbolo va en DEBUG y los avisos repetidos (errores de KuCoin, 429) se limitan por evento.
+logger = logging.getLogger('crypto_tracker')
+
+def format_log_value(value):
+    if isinstance(value, float):
+        return f"{value:.6g}"
+    text = str(value)
+    return json.dumps(text) if not text or any(c.isspace() or c in '"=' for c in text) else text
+
+class StructuredFormatter(logging.Formatter):
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        parts = [record.getMessage()] + [f"{key}={format_log_value(value)}" for key, value in fields.items()]
+        return f"[{datetime.fromtimestamp(record.created).isoformat()}] {record.levelname} {' '.join(parts)}"
+
+# Deja pasar como mucho 'limit' mensajes de cada evento por ventana; el primero de la ventana
+# siguiente lleva suppressed=N con los que se descartaron
+class RateLimitFilter(logging.Filter):
+    def __init__(self, limit, window):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._windows = {} # evento -> [inicio de la ventana, emitidos, descartados]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        event = record.getMessage()
+        now = time.monotonic()
+        with self._lock:
+            state = self._windows.get(event)
+            if state is None or now - state[0] >= self.window:
+                suppressed = state[2] if state else 0
+                self._windows[event] = [now, 1, 0]
+                if suppressed:
+                    record.fields = dict(getattr(record, 'fields', {}), suppressed=suppressed)
+                return True
+            if state[1] < self.limit:
+                state[1] += 1
+                return True
+            state[2] += 1
+            return False
+
+if not logger.handlers:
+    _log_handler = logging.StreamHandler(sys.stdout)
+    _log_handler.setFormatter(StructuredFormatter())
+    _log_handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT, LOG_RATE_WINDOW))
+    logger.addHandler(_log_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+def log_event(level, event, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'fields': fields})
+
+# --- MÉTRICAS (FORMATO PROMETHEUS) ---
+# Registro propio y mínimo (contadores, histogramas y gauges calculados al leer) que /metrics expone en
+# el formato de texto de Prometheus. Las métricas son de este proceso: con varios workers de Gunicorn
+# cada uno tiene las suyas (el scrape llega a uno cualquiera; el barrido solo lo mide el líder).
+METRICS_REGISTRY = []
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_metric_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        escaped.append(f'{key}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS_REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.labelnames:
+            values[()] = 0
+        for key, value in sorted(values.items()):
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {} # etiquetas -> [cuenta por bucket (sin acumular, el último es +Inf), suma]
+        self._lock = threading.Lock()
+        METRICS_REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", labels + (('le', '+Inf' if bound == float('inf') else repr(float(bound))),), cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+# Valor leído en el momento del scrape (tamaño del universo, clientes conectados...)
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        METRICS_REGISTRY.append(self)
+
+    def samples(self):
+        yield self.name, (), self.callback()
+
+def render_metrics():
+    lines = []
+    for metric in METRICS_REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{format_metric_labels(labels)} {float(value):.10g}")
+    return '\n'.join(lines) + '\n'
+
+sweep_duration_metric = Histogram('crypto_tracker_sweep_duration_seconds', 'Duración de un barrido completo (descarga, análisis y escritura).', buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200))
+symbol_fetch_metric = Histogram('crypto_tracker_symbol_fetch_duration_seconds', 'Descarga de las velas de un símbolo en el barrido (todas sus peticiones).', buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+indicator_metric = Histogram('crypto_tracker_indicator_duration_seconds', 'Cálculo de indicadores y señales (un lote en numpy, un símbolo en streaming).', ['backend'])
+history_write_metric = Histogram('crypto_tracker_history_write_duration_seconds', 'Escritura del historial al final del barrido.', ['target'])
+http_request_metric = Histogram('crypto_tracker_http_request_duration_seconds', 'Tiempo de respuesta de la API por ruta.', ['route', 'method', 'status'])
+upstream_errors_metric = Counter('crypto_tracker_upstream_errors_total', 'Errores al llamar a KuCoin.', ['kind'])
+upstream_rate_limited_metric = Counter('crypto_tracker_upstream_rate_limited_total', 'Respuestas HTTP 429 de KuCoin.')
+analysis_cache_metric = Counter('crypto_tracker_analysis_cache_requests_total', 'Peticiones de /get_latest_analysis servidas desde la cache (hit) o en vivo (miss).', ['result'])
+recommendations_saved_metric = Counter('crypto_tracker_recommendations_saved_total', 'Recomendaciones guardadas en el historial.', ['recommendation'])
+sweep_skipped_metric = Counter('crypto_tracker_sweep_symbols_skipped_total', 'Símbolos del barrido sin velas nuevas (no se vuelven a analizar).')
+sweep_failed_metric = Counter('crypto_tracker_sweep_symbols_failed_total', 'Símbolos del barrido cuya descarga de velas falló (no se analizan).')
+Gauge('crypto_tracker_symbols_monitored', 'Símbolos del universo actual.', lambda: len(SYMBOLS_TO_MONITOR))
+Gauge('crypto_tracker_is_leader', '1 si este proceso es el que barre.', lambda: int(leader_lock.is_leader))
+Gauge('crypto_tracker_stream_clients', 'Clientes conectados a /stream en este proceso.', lambda: event_hub.get_stats()['clients'])
+
+# --- LIMITADOR DE PETICIONES (TOKEN BUCKET) ---
+# Cada petición consume un token; los tokens se reponen a 'rate' por segundo hasta 'capacity'.
+# El saldo puede quedar negativo: cada llamada reserva su turno y espera lo que le toca,
+# así no hace falta un asyncio.Lock (que quedaría atado a un único event loop).
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _reserve(self):
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    # Tras un 429 vaciamos el bucket para que todas las peticiones esperen 'seconds'
+    def pause(self, seconds):
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+kucoin_rate_limiter = TokenBucket(KUCOIN_RATE_LIMIT, KUCOIN_RATE_BURST)
+
+def get_retry_delay(response, attempt):
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            pass
+    return KUCOIN_BACKOFF_BASE * (2 ** attempt)
+
+# --- CLIENTE HTTP COMPARTIDO ---
+# Un httpx.AsyncClient por event loop: las conexiones de httpx quedan ligadas al loop que las abrió.
+http_clients = weakref.WeakKeyDictionary()
+http_clients_lock = threading.Lock()
+
+# Contadores para comprobar que se reutilizan las conexiones (latencia por petición y conexiones/TLS abiertos)
+http_stats = {
+    'requests': 0,
+    'errors': 0,
+    'rate_limited': 0,
+    'connections_opened': 0,
+    'tls_handshakes': 0,
+    'clients_created': 0,
+    'clients_closed': 0,
+    'latency_total': 0.0,
+    'latency_max': 0.0,
+}
+http_latencies = deque(maxlen=1000) # Últimas latencias para calcular percentiles
+http_stats_lock = threading.Lock()
+
+def record_http_stat(name, amount=1):
+    with http_stats_lock:
+        http_stats[name] += amount
+
+# Trace de httpcore: nos avisa cada vez que se abre una conexión TCP o se hace un handshake TLS
+async def trace_http_connection(event_name, info):
+    if event_name == 'connection.connect_tcp.complete':
+        record_http_stat('connections_opened')
+    elif event_name == 'connection.start_tls.complete':
+        record_http_stat('tls_handshakes')
+
+def get_http_client():
+    loop = asyncio.get_running_loop()
+    with http_clients_lock:
+        client = http_clients.get(loop)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                http2=KUCOIN_HTTP2,
+                limits=httpx.Limits(
+                    max_connections=KUCOIN_MAX_CONNECTIONS,
+                    max_keepalive_connections=KUCOIN_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=KUCOIN_KEEPALIVE_EXPIRY
+                )
+            )
+            http_clients[loop] = client
+            record_http_stat('clients_created')
+    return client
+
+# Cierra el cliente del loop actual (llamar antes de que el loop termine)
+async def close_http_client():
+    with http_clients_lock:
+        client = http_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None and not client.is_closed:
+        await client.aclose()
+        record_http_stat('clients_closed')
+
+# Hook de apagado: cierra los clientes que sigan abiertos en cualquier loop
+def close_all_http_clients():
+    with http_clients_lock:
+        remaining = list(http_clients.items())
+        http_clients.clear()
+    for loop, client in remaining:
+        if client.is_closed or loop.is_closed():
+            continue
+        try:
+            if loop.is_running():
+                asyncio.run_coroutine_threadsafe(client.aclose(), loop).result(timeout=5)
+            else:
+                loop.run_until_complete(client.aclose())
+            record_http_stat('clients_closed')
+        except Exception as e:
+            log_event(logging.ERROR, 'http_client_close_error', error=e)
+
+atexit.register(close_all_http_clients)
+
+# --- LOOP ASYNCIO DE FONDO ---
+# Un único event loop de larga vida en su propio hilo: es dueño del cliente HTTP, de la KlineStore
+# y del barrido periódico. Las rutas de Flask (síncronas) le mandan corrutinas con submit()/run()
+# en lugar de crear y destruir un loop por petición o por tick.
+class WorkerLoop:
+    def __init__(self, name='analysis-worker'):
+        self.name = name
+        self.loop = None
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.loop is not None:
+                return self.loop
+            loop = asyncio.new_event_loop()
+            started = threading.Event()
+
+            def run_loop():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(started.set)
+                loop.run_forever()
+
+            self.thread = threading.Thread(target=run_loop, name=self.name, daemon=True)
+            self.thread.start()
+            started.wait()
+            self.loop = loop
+            print(f"[{datetime.now().isoformat()}] Worker event loop started ({self.name}).")
+            return loop
+
+    # Devuelve un concurrent.futures.Future con el resultado de la corrutina
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.start())
+
+    # Bloquea el hilo que llama (una petición de Flask) hasta que la corrutina termina en el loop
+    def run(self, coro, timeout=WORKER_REQUEST_TIMEOUT):
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def stop(self):
+        with self._lock:
+            loop, thread = self.loop, self.thread
+            self.loop = self.thread = None
+        if loop is None:
+            return
+
+        # Cancela lo que siga en marcha (barrido, análisis forzados) antes de cerrar el cliente
+        async def shutdown():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await close_http_client()
+
+        try:
+            asyncio.run_coroutine_threadsafe(shutdown(), loop).result(timeout=10)
+        except Exception as e:
+            log_event(logging.ERROR, 'worker_stop_error', error=e)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=5)
+
+worker = WorkerLoop()
+atexit.register(worker.stop)
+
+def get_http_stats():
+    with http_stats_lock:
+        stats = dict(http_stats)
+        latencies = sorted(http_latencies)
+    requests_done = stats.pop('requests')
+    latency_total = stats.pop('latency_total')
+    stats['requests'] = requests_done
+    stats['latency_avg_ms'] = round(latency_total / requests_done * 1000, 2) if requests_done else 0.0
+    stats['latency_p50_ms'] = round(latencies[len(latencies) // 2] * 1000, 2) if latencies else 0.0
+    stats['latency_p99_ms'] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 2) if latencies else 0.0
+    stats['latency_max_ms'] = round(stats.pop('latency_max') * 1000, 2)
+    stats['connections_per_request'] = round(stats['connections_opened'] / requests_done, 4) if requests_done else 0.0
+    return stats
+
+# GET respetando el limitador; ante HTTP 429 espera (Retry-After o backoff exponencial) y reintenta
+async def get_with_backoff(client, url, timeout):
+    for attempt in range(KUCOIN_MAX_RETRIES + 1):
+        await kucoin_rate_limiter.acquire()
+        request_started_at = time.monotonic()
+        try:
+            response = await client.get(url, timeout=timeout, extensions={'trace': trace_http_connection})
+        except httpx.RequestError:
+            record_http_stat('errors')
+            upstream_errors_metric.inc(kind='network')
+            raise
+        elapsed = time.monotonic() - request_started_at
+        with http_stats_lock:
+            http_stats['requests'] += 1
+            http_stats['latency_total'] += elapsed
+            http_stats['latency_max'] = max(http_stats['latency_max'], elapsed)
+            http_latencies.append(elapsed)
+        if response.status_code == 429:
+            upstream_rate_limited_metric.inc()
+        if response.status_code != 429 or attempt == KUCOIN_MAX_RETRIES:
+            if response.status_code >= 400:
+                record_http_stat('errors')
+                upstream_errors_metric.inc(kind='rate_limited' if response.status_code == 429 else 'http')
+            return response
+        record_http_stat('rate_limited')
+        delay = get_retry_delay(response, attempt)
+        log_event(logging.WARNING, 'kucoin_rate_limited', url=url, retry_in=round(delay, 1), attempt=f"{attempt + 1}/{KUCOIN_MAX_RETRIES}")
+        kucoin_rate_limiter.pause(delay)
+    return response
+
 # --- FUNCIONES DE UTILIDAD CSV ---
+CSV_HEADER = ['timestamp', 'symbol', 'recommendation', 'prev_recommendation', 'metric_type', 'metric_value', 'details']
+
 def ensure_csv_exists():
     if not os.path.exists(CSV_FILE):
         with open(CSV_FILE, mode='w', newline='', encoding='utf-8') as file:
             writer = csv.writer(file)
-            writer.writerow(['timestamp', 'symbol', 'recommendation', 'prev_recommendation', 'metric_type', 'metric_value', 'details'])
+            writer.writerow(CSV_HEADER)
     
     if not os.path.exists(LAST_REC_FILE):
         with open(LAST_REC_FILE, mode='w', newline='', encoding='utf-8') as file:
@@ -38,44 +568,39 @@ def ensure_csv_exists():
 
 ensure_csv_exists()
 
-# Función para obtener la última recomendación guardada de last_recommendations.csv
-def get_last_recommendation_from_file(symbol):
-    if not os.path.exists(LAST_REC_FILE):
-        return None
-    with open(LAST_REC_FILE, mode='r', newline='', encoding='utf-8') as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            if row['symbol'] == symbol:
-                return row
-    return None
-
-# Función para actualizar la última recomendación en last_recommendations.csv
-def update_last_recommendation_file(symbol, timestamp_iso, recommendation, sma_rec, rsi_rec, bb_rec, current_price):
-    rows = []
-    found = False
+# --- ÚLTIMA RECOMENDACIÓN POR SÍMBOLO (EN MEMORIA) ---
+# last_recommendations.csv se carga una sola vez al arrancar en un dict por símbolo.
+# Los cambios se marcan como pendientes y se escriben todos juntos al final de cada barrido,
+# en un fichero temporal que sustituye al original con un rename atómico.
+LAST_REC_FIELDS = ['symbol', 'timestamp', 'recommendation', 'sma_rec', 'rsi_rec', 'bb_rec', 'last_price']
+
+last_recommendations = {}
+last_recommendations_dirty = False
+last_recommendations_lock = threading.Lock()
+
+def load_last_recommendations():
+    global last_recommendations_dirty
+    loaded = {}
     if os.path.exists(LAST_REC_FILE):
         with open(LAST_REC_FILE, mode='r', newline='', encoding='utf-8') as file:
             reader = csv.DictReader(file)
-            rows = list(reader)
-    
-    updated_rows = []
-    for row in rows:
-        if row['symbol'] == symbol:
-            updated_rows.append({
-                'symbol': symbol,
-                'timestamp': timestamp_iso,
-                'recommendation': recommendation,
-                'sma_rec': sma_rec,
-                'rsi_rec': rsi_rec,
-                'bb_rec': bb_rec,
-                'last_price': current_price
-            })
-            found = True
-        else:
-            updated_rows.append(row)
-    
-    if not found:
-        updated_rows.append({
+            for row in reader:
+                loaded[row['symbol']] = row
+    with last_recommendations_lock:
+        last_recommendations.clear()
+        last_recommendations.update(loaded)
+        last_recommendations_dirty = False
+
+load_last_recommendations()
+
+def get_last_recommendation(symbol):
+    with last_recommendations_lock:
+        return last_recommendations.get(symbol)
+
+def set_last_recommendation(symbol, timestamp_iso, recommendation, sma_rec, rsi_rec, bb_rec, current_price):
+    global last_recommendations_dirty
+    with last_recommendations_lock:
+        last_recommendations[symbol] = {
             'symbol': symbol,
             'timestamp': timestamp_iso,
             'recommendation': recommendation,
@@ -83,89 +608,971 @@ def update_last_recommendation_file(symbol, timestamp_iso, recommendation, sma_r
             'rsi_rec': rsi_rec,
             'bb_rec': bb_rec,
             'last_price': current_price
-        })
-    
-    with open(LAST_REC_FILE, mode='w', newline='', encoding='utf-8') as file:
-        writer = csv.DictWriter(file, fieldnames=['symbol', 'timestamp', 'recommendation', 'sma_rec', 'rsi_rec', 'bb_rec', 'last_price'])
-        writer.writeheader()
-        writer.writerows(updated_rows)
+        }
+        last_recommendations_dirty = True
+
+# Escribe last_recommendations.csv completo si hubo cambios (una vez por barrido)
+def flush_last_recommendations():
+    global last_recommendations_dirty
+    with last_recommendations_lock:
+        if not last_recommendations_dirty:
+            return
+        rows = list(last_recommendations.values())
+        last_recommendations_dirty = False
+    tmp_file = f"{LAST_REC_FILE}.tmp"
+    try:
+        with history_write_metric.time(target='last_recommendations'):
+            with open(tmp_file, mode='w', newline='', encoding='utf-8') as file:
+                writer = csv.DictWriter(file, fieldnames=LAST_REC_FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_file, LAST_REC_FILE)
+    except OSError as e:
+        with last_recommendations_lock:
+            last_recommendations_dirty = True
+        log_event(logging.ERROR, 'file_write_error', path=LAST_REC_FILE, error=e)
+
+# --- ÍNDICE DE OPORTUNIDADES (INCREMENTAL) ---
+# Cada vez que el barrido (o el snapshot del líder) cambia el análisis de un símbolo, el símbolo se mueve
+# entre los conjuntos buy/sell/hold/error y se recoloca en los rankings, en vez de recorrer toda la cache
+# en cada petición. 'version' sube cuando cambia algún conjunto y 'revision' con cualquier cambio de valores.
+# Los cuerpos de /get_current_opportunities se serializan una vez por versión y se sirven tal cual.
+OPPORTUNITY_RECS = ('buy', 'sell', 'hold', 'error')
+OPPORTUNITY_RANKED_RECS = ('buy', 'sell')
+OPPORTUNITY_SORTS = ('rsi', 'bb')
+
+# Puntuación de una oportunidad (mayor = más fuerte), None si no hay datos:
+#   rsi: puntos que el RSI se ha pasado del umbral (por debajo de 30 en compras, por encima de 70 en ventas)
+#   bb:  % del precio por fuera de la banda de Bollinger (inferior en compras, superior en ventas)
+def opportunity_scores(rec, close, rsi, bb_upper, bb_lower):
+    if rec == 'buy':
+        rsi_score = 30 - rsi
+        bb_score = (bb_lower - close) / close * 100 if close else float('nan')
+    elif rec == 'sell':
+        rsi_score = rsi - 70
+        bb_score = (close - bb_upper) / close * 100 if close else float('nan')
+    else:
+        return {}
+    return {sort: score for sort, score in (('rsi', rsi_score), ('bb', bb_score)) if score == score}
+
+class OpportunityIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self.revision = 0
+        self.entries = {} # symbol -> {'rec', 'etag', 'close', 'rsi', 'bb_upper', 'bb_lower', 'scores'}
+        self.members = {rec: {} for rec in OPPORTUNITY_RECS} # dicts como conjuntos ordenados
+        self.rankings = {(rec, sort): [] for rec in OPPORTUNITY_RANKED_RECS for sort in OPPORTUNITY_SORTS} # [(-score, symbol)] ordenadas
+        self._payload = None # (version, cuerpo)
+        self._ranked_payloads = {} # (sort, limit, rec) -> cuerpo, válidos para self._ranked_revision
+        self._ranked_revision = None
+
+    def _remove(self, symbol, entry):
+        self.members[entry['rec']].pop(symbol, None)
+        for sort, score in entry['scores'].items():
+            ranking = self.rankings[(entry['rec'], sort)]
+            position = bisect.bisect_left(ranking, (-score, symbol))
+            if position < len(ranking) and ranking[position] == (-score, symbol):
+                del ranking[position]
+
+    def update(self, symbol, rec, etag, close, rsi, bb_upper, bb_lower):
+        rec = rec if rec in OPPORTUNITY_RECS else 'error'
+        with self._lock:
+            previous = self.entries.get(symbol)
+            if previous is not None and etag is not None and previous['etag'] == etag:
+                return False
+            entry = {'rec': rec, 'etag': etag, 'close': close, 'rsi': rsi, 'bb_upper': bb_upper, 'bb_lower': bb_lower,
+                     'scores': opportunity_scores(rec, close, rsi, bb_upper, bb_lower)}
+            if previous is not None:
+                self._remove(symbol, previous)
+            self.entries[symbol] = entry
+            self.members[rec][symbol] = None
+            for sort, score in entry['scores'].items():
+                bisect.insort(self.rankings[(rec, sort)], (-score, symbol))
+            if previous is None or previous['rec'] != rec:
+                self.version += 1
+            self.revision += 1
+            return True
+
+    # Último punto de un análisis de la cache (arrays vacíos -> NaN)
+    def update_from_analysis(self, symbol, analysis, etag):
+        last = {key: analysis[key][-1] if len(analysis[key]) else float('nan') for key in ('closes', 'rsi_data', 'bb_upper', 'bb_lower')}
+        return self.update(symbol, analysis['overall_rec'], etag, last['closes'], last['rsi_data'], last['bb_upper'], last['bb_lower'])
+
+    def get_etag(self, symbol):
+        with self._lock:
+            entry = self.entries.get(symbol)
+            return entry['etag'] if entry is not None else None
+
+    def symbols(self):
+        with self._lock:
+            return list(self.entries)
+
+    def discard(self, symbol):
+        with self._lock:
+            entry = self.entries.pop(symbol, None)
+            if entry is None:
+                return
+            self._remove(symbol, entry)
+            self.version += 1
+            self.revision += 1
+
+    # Cuerpo de /get_current_opportunities sin ranking: se reconstruye solo si cambió algún conjunto
+    def get_payload(self):
+        with self._lock:
+            if self._payload is None or self._payload[0] != self.version:
+                data = {rec: list(self.members[rec]) for rec in OPPORTUNITY_RECS}
+                data['version'] = self.version
+                body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+                self._payload = (self.version, {'etag': hashlib.sha1(body).hexdigest(), 'body': body, 'data': data})
+            return self._payload[1]
+
+    # Top 'limit' (todos si es None) de compras y/o ventas ordenados por 'sort', con sus valores
+    def get_ranked_payload(self, sort, limit=None, rec=None):
+        key = (sort, limit, rec)
+        with self._lock:
+            if self._ranked_revision != self.revision:
+                self._ranked_payloads = {}
+                self._ranked_revision = self.revision
+            payload = self._ranked_payloads.get(key)
+            if payload is None:
+                data = {'version': self.version, 'sort': sort}
+                for ranked_rec in ((rec,) if rec else OPPORTUNITY_RANKED_RECS):
+                    ranking = self.rankings[(ranked_rec, sort)]
+                    data[ranked_rec] = [self._describe(symbol) for _, symbol in (ranking[:limit] if limit is not None else ranking)]
+                body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+                payload = {'etag': hashlib.sha1(body).hexdigest(), 'body': body}
+                self._ranked_payloads[key] = payload
+            return payload
+
+    def _describe(self, symbol):
+        entry = self.entries[symbol]
+        return {
+            'symbol': symbol,
+            'close': entry['close'],
+            'rsi': entry['rsi'] if entry['rsi'] == entry['rsi'] else None,
+            'rsi_distance': entry['scores'].get('rsi'),
+            'bb_breakout_pct': entry['scores'].get('bb')
+        }
+
+    def get_stats(self):
+        with self._lock:
+            stats = {rec: len(self.members[rec]) for rec in OPPORTUNITY_RECS}
+            stats.update(version=self.version, revision=self.revision)
+            return stats
+
+opportunity_index = OpportunityIndex()
+
+# --- HISTORIAL INDEXADO (SQLITE / WAL) ---
+# data.csv sigue siendo el log de escritura; las consultas de /get_recommendations van contra SQLite,
+# con índices (symbol, ts) y (ts) para paginar por cursor sin leer todo el historial.
+HISTORY_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS recommendations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    recommendation TEXT,
+    prev_recommendation TEXT,
+    metric_type TEXT,
+    metric_value REAL,
+    details TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_recommendations_symbol_ts ON recommendations (symbol, ts);
+CREATE INDEX IF NOT EXISTS idx_recommendations_ts ON recommendations (ts);
+CREATE TABLE IF NOT EXISTS symbol_demand (
+    symbol TEXT PRIMARY KEY,
+    requested_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_symbol_demand_requested_at ON symbol_demand (requested_at);
+CREATE TABLE IF NOT EXISTS forced_analysis (
+    symbol TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    requested_at TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_forced_analysis_status ON forced_analysis (status);
+"""
+
+# Contadores por hora y símbolo (más una fila global con symbol '*'), actualizados por un trigger en la misma
+# transacción que inserta las filas del historial: las ventanas de 24h/7d/30d se leen sumando como mucho
+# 30 * 24 buckets en vez de recorrer el historial. Los buckets más viejos que la ventana mayor se borran.
+STATS_ALL_SYMBOLS = '*'
+STATS_BUCKET_SQL = f"{{ts}} / {STATS_BUCKET_SECONDS * 1000000} * {STATS_BUCKET_SECONDS}" # ts en microsegundos -> inicio del bucket (segundos)
+# Aporte de una fila ({row}) a cada contador; flips = cambio entre buy/sell/hold respecto a la anterior guardada
+STATS_COUNTER_SQL = {
+    'hits': "CASE WHEN {row}.metric_type = 'Acierto' THEN 1 ELSE 0 END",
+    'risks': "CASE WHEN {row}.metric_type = 'Riesgo' THEN 1 ELSE 0 END",
+    'metric_sum': "COALESCE({row}.metric_value, 0)",
+    'flips': "CASE WHEN {row}.recommendation IN ('buy', 'sell', 'hold') AND {row}.prev_recommendation IN ('buy', 'sell', 'hold') "
+             "AND {row}.recommendation != {row}.prev_recommendation THEN 1 ELSE 0 END",
+    'buys': "CASE WHEN {row}.recommendation = 'buy' THEN 1 ELSE 0 END",
+    'sells': "CASE WHEN {row}.recommendation = 'sell' THEN 1 ELSE 0 END",
+    'holds': "CASE WHEN {row}.recommendation = 'hold' THEN 1 ELSE 0 END"
+}
+STATS_COUNTERS = tuple(STATS_COUNTER_SQL)
+
+RECOMMENDATION_STATS_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS recommendation_stats (
+    symbol TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    hits INTEGER NOT NULL,
+    risks INTEGER NOT NULL,
+    metric_sum REAL NOT NULL,
+    flips INTEGER NOT NULL,
+    buys INTEGER NOT NULL,
+    sells INTEGER NOT NULL,
+    holds INTEGER NOT NULL,
+    PRIMARY KEY (symbol, bucket)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_recommendation_stats_bucket ON recommendation_stats (bucket);
+CREATE TRIGGER IF NOT EXISTS trg_recommendations_stats AFTER INSERT ON recommendations
+BEGIN
+    INSERT INTO recommendation_stats (symbol, bucket, total, {', '.join(STATS_COUNTERS)})
+    SELECT target.symbol, {STATS_BUCKET_SQL.format(ts='NEW.ts')}, 1, {', '.join(expression.format(row='NEW') for expression in STATS_COUNTER_SQL.values())}
+    FROM (SELECT NEW.symbol AS symbol UNION ALL SELECT '{STATS_ALL_SYMBOLS}') AS target
+    WHERE 1
+    ON CONFLICT (symbol, bucket) DO UPDATE SET total = total + 1, {', '.join(f'{name} = {name} + excluded.{name}' for name in STATS_COUNTERS)};
+END;
+"""
+
+HISTORY_COLUMNS = ['timestamp', 'symbol', 'recommendation', 'prev_recommendation', 'metric_type', 'metric_value', 'details']
+
+history_db_local = threading.local()
+
+# Una conexión por hilo (sqlite3 no permite compartirlas entre hilos)
+def get_history_db():
+    conn = getattr(history_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(HISTORY_DB_FILE, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        history_db_local.conn = conn
+    return conn
+
+def parse_iso_timestamp(timestamp_str):
+    return datetime.fromisoformat(timestamp_str.replace('Z', '+00:00')).replace(tzinfo=timezone.utc)
+
+# Microsegundos desde epoch (entero, para indexar y comparar sin volver a parsear el ISO)
+def datetime_to_micros(dt):
+    return (dt - datetime(1970, 1, 1, tzinfo=timezone.utc)) // timedelta(microseconds=1)
+
+def timestamp_to_micros(timestamp_str):
+    return datetime_to_micros(parse_iso_timestamp(timestamp_str))
+
+def history_row_to_values(row):
+    timestamp_str, symbol, recommendation, prev_recommendation, metric_type, metric_value_str, details = row[:7]
+    return (timestamp_to_micros(timestamp_str), timestamp_str, symbol, recommendation, prev_recommendation, metric_type, float(metric_value_str), details)
+
+def get_stats_cutoff_bucket(now=None):
+    now = time.time() if now is None else now
+    return int(now - STATS_RETENTION_SECONDS) // STATS_BUCKET_SECONDS * STATS_BUCKET_SECONDS
+
+# Las filas nuevas (no las repetidas que ignora INSERT OR IGNORE) suman en recommendation_stats por el trigger
+def insert_history_rows(rows):
+    conn = get_history_db()
+    with conn:
+        cursor = conn.executemany(
+            'INSERT OR IGNORE INTO recommendations (ts, timestamp, symbol, recommendation, prev_recommendation, metric_type, metric_value, details) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [history_row_to_values(row) for row in rows]
+        )
+        inserted = cursor.rowcount
+        conn.execute('DELETE FROM recommendation_stats WHERE bucket < ?', (get_stats_cutoff_bucket(),))
+    return inserted
+
+# Recalcula los agregados desde el historial en una sola pasada (GROUP BY sobre la tabla, sin cargarla
+# en memoria); la fila global se obtiene de los propios agregados por símbolo.
+def rebuild_recommendation_stats():
+    cutoff = get_stats_cutoff_bucket()
+    columns = ', '.join(STATS_COUNTERS)
+    sums = ', '.join(f"SUM({name})" for name in STATS_COUNTERS)
+    row_values = ', '.join(f"{expression.format(row='r')} AS {name}" for name, expression in STATS_COUNTER_SQL.items())
+    conn = get_history_db()
+    with conn:
+        conn.execute('DELETE FROM recommendation_stats')
+        conn.execute(
+            f"INSERT INTO recommendation_stats (symbol, bucket, total, {columns}) "
+            f"SELECT symbol, bucket, COUNT(*), {sums} FROM ("
+            f"SELECT symbol, {STATS_BUCKET_SQL.format(ts='ts')} AS bucket, {row_values} FROM recommendations AS r WHERE ts >= ?"
+            f") GROUP BY symbol, bucket",
+            (cutoff * 1000000,)
+        )
+        conn.execute(
+            f"INSERT INTO recommendation_stats (symbol, bucket, total, {columns}) "
+            f"SELECT ?, bucket, SUM(total), {sums} FROM recommendation_stats WHERE symbol != ? GROUP BY bucket",
+            (STATS_ALL_SYMBOLS, STATS_ALL_SYMBOLS)
+        )
+    return conn.execute('SELECT COUNT(*) FROM recommendation_stats WHERE symbol != ?', (STATS_ALL_SYMBOLS,)).fetchone()[0]
+
+# Tasas de cada ventana para un símbolo (o todos): una sola consulta sobre los buckets de la ventana mayor
+def get_recommendation_stats(symbol=STATS_ALL_SYMBOLS, windows=tuple(STATS_WINDOWS)):
+    now = int(time.time())
+    starts = {window: (now - STATS_WINDOWS[window]) // STATS_BUCKET_SECONDS * STATS_BUCKET_SECONDS for window in windows}
+    columns = ('total',) + STATS_COUNTERS
+    selects = [f'SUM(CASE WHEN bucket >= ? THEN {column} ELSE 0 END)' for window in windows for column in columns]
+    params = [starts[window] for window in windows for _ in columns]
+    row = get_history_db().execute(
+        f"SELECT {', '.join(selects)} FROM recommendation_stats WHERE symbol = ? AND bucket >= ?",
+        params + [symbol, min(starts.values())]
+    ).fetchone()
+    result = {}
+    for i, window in enumerate(windows):
+        values = dict(zip(columns, (value or 0 for value in row[i * len(columns):(i + 1) * len(columns)])))
+        total = values['total']
+        result[window] = {
+            'total': total,
+            'hit_rate': round(values['hits'] / total, 4) if total else None,
+            'risk_rate': round(values['risks'] / total, 4) if total else None,
+            'avg_metric_value': round(values['metric_sum'] / total, 2) if total else None,
+            'flip_rate': round(values['flips'] / total, 4) if total else None,
+            'flips': values['flips'],
+            'recommendations': {'buy': values['buys'], 'sell': values['sells'], 'hold': values['holds']}
+        }
+    return result
+
+# Filas del historial desde threshold_ts (microsegundos) sin recorrer la ventana: las horas completas
+# salen de recommendation_stats y solo la hora parcial del principio se cuenta en recommendations.
+def count_recent_recommendations(threshold_ts, symbol=None):
+    conn = get_history_db()
+    first_full_bucket = -(-threshold_ts // (STATS_BUCKET_SECONDS * 1000000)) * STATS_BUCKET_SECONDS
+    full = conn.execute(
+        'SELECT COALESCE(SUM(total), 0) FROM recommendation_stats WHERE symbol = ? AND bucket >= ?',
+        (symbol or STATS_ALL_SYMBOLS, first_full_bucket)
+    ).fetchone()[0]
+    where = 'ts >= ? AND ts < ?'
+    params = [threshold_ts, first_full_bucket * 1000000]
+    if symbol is not None:
+        where += ' AND symbol = ?'
+        params.append(symbol)
+    partial = conn.execute(f'SELECT COUNT(*) FROM recommendations WHERE {where}', params).fetchone()[0]
+    return full + partial
+
+# Importa un data.csv existente en streaming, por bloques. Es idempotente: las filas ya
+# importadas (mismo símbolo y timestamp) se ignoran.
+def import_history_csv(path, batch_size=5000):
+    imported = 0
+    skipped = 0
+    batch = []
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, mode='rt', newline='', encoding='utf-8') as file:
+        reader = csv.reader(file)
+        next(reader, None)
+        for row in reader:
+            try:
+                if len(row) < 7:
+                    raise ValueError('wrong length')
+                history_row_to_values(row)
+            except (ValueError, IndexError) as e:
+                log_event(logging.WARNING, 'history_row_skipped', path=path, row=','.join(row), error=e)
+                skipped += 1
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                imported += insert_history_rows(batch)
+                batch = []
+    if batch:
+        imported += insert_history_rows(batch)
+    return imported, skipped
+
+# Al importar el módulo (en cada worker) solo se crea el esquema, que es instantáneo e idempotente
+def init_history_db():
+    get_history_db().executescript(HISTORY_DB_SCHEMA + RECOMMENDATION_STATS_SCHEMA)
+
+init_history_db()
+
+# Trabajo pesado de puesta en marcha, solo en el proceso líder (una vez, y sin retrasar el arranque de
+# los workers): importar un data.csv existente si la base de datos está vacía y, en una base de datos
+# anterior a los agregados, calcularlos con el historial que ya tiene
+def bootstrap_history_db():
+    conn = get_history_db()
+    is_empty = conn.execute('SELECT 1 FROM recommendations LIMIT 1').fetchone() is None
+    if is_empty and os.path.exists(CSV_FILE) and os.path.getsize(CSV_FILE) > 0:
+        imported, skipped = import_history_csv(CSV_FILE)
+        if imported:
+            print(f"[{datetime.now().isoformat()}] Imported {imported} rows from {CSV_FILE} into {HISTORY_DB_FILE} ({skipped} skipped).")
+        return
+    has_stats = conn.execute('SELECT 1 FROM recommendation_stats LIMIT 1').fetchone() is not None
+    has_recent_history = conn.execute('SELECT 1 FROM recommendations WHERE ts >= ? LIMIT 1', (get_stats_cutoff_bucket() * 1000000,)).fetchone() is not None
+    if has_recent_history and not has_stats:
+        buckets = rebuild_recommendation_stats()
+        print(f"[{datetime.now().isoformat()}] Built {buckets} recommendation stats buckets from {HISTORY_DB_FILE}.")
+
+@app.cli.command('import-history')
+@click.argument('path', default=CSV_FILE)
+def import_history_command(path):
+    """Importa un data.csv (o un segmento rotado .csv.gz) en la base de datos del historial (usar con RUN_BACKGROUND_JOBS=0)."""
+    imported, skipped = import_history_csv(path)
+    click.echo(f"Importadas {imported} filas nuevas desde {path} ({skipped} filas mal formadas ignoradas).")
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recalcula los agregados de aciertos/riesgos/cambios desde el historial de la base de datos (usar con RUN_BACKGROUND_JOBS=0)."""
+    buckets = rebuild_recommendation_stats()
+    click.echo(f"Recalculados {buckets} buckets por símbolo de {STATS_BUCKET_SECONDS // 60} minutos (últimos {STATS_RETENTION_SECONDS // 86400} días).")
+
+# Cursor de paginación: "<ts>:<id>" de la última fila de la página anterior
+def encode_history_cursor(row):
+    return f"{row['ts']}:{row['id']}"
+
+def decode_history_cursor(cursor):
+    ts, row_id = cursor.split(':')
+    return int(ts), int(row_id)
+
+# --- ESCRITURA POR LOTES DEL HISTORIAL (data.csv) ---
+# Acumula las filas de todo el barrido y las escribe con una sola apertura, una sola escritura
+# y un solo fsync; las mismas filas se insertan en SQLite en una única transacción.
+class HistoryWriter:
+    def __init__(self, path, fsync=HISTORY_FSYNC, rotate_daily=HISTORY_ROTATE_DAILY, max_bytes=HISTORY_ROTATE_MAX_BYTES):
+        self.path = path
+        self.fsync = fsync
+        self.rotate_daily = rotate_daily
+        self.max_bytes = max_bytes
+        self.pending = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def append(self, row):
+        with self._lock:
+            self.pending.append(row)
+
+    def flush(self):
+        with self._lock:
+            rows, self.pending = self.pending, []
+        if not rows:
+            return 0
+        with self._write_lock, history_write_metric.time(target='csv'):
+            self.rotate_if_needed(datetime.now(timezone.utc))
+            with open(self.path, mode='a', newline='', encoding='utf-8') as file:
+                writer = csv.writer(file)
+                writer.writerows(rows)
+                file.flush()
+                if self.fsync:
+                    os.fsync(file.fileno())
+        with history_write_metric.time(target='db'):
+            insert_history_rows(rows)
+        return len(rows)
+
+    # Día (UTC) de la primera fila del fichero activo, o None si solo tiene la cabecera
+    def first_row_day(self):
+        with open(self.path, mode='r', newline='', encoding='utf-8') as file:
+            reader = csv.reader(file)
+            next(reader, None)
+            for row in reader:
+                try:
+                    return parse_iso_timestamp(row[0]).date()
+                except (ValueError, IndexError):
+                    continue
+        return None
+
+    def rotate_if_needed(self, now_dt):
+        if not os.path.exists(self.path):
+            ensure_csv_exists()
+            return
+        too_big = self.max_bytes and os.path.getsize(self.path) >= self.max_bytes
+        first_day = self.first_row_day() if self.rotate_daily else None
+        new_day = first_day is not None and first_day != now_dt.date()
+        if too_big or new_day:
+            self.rotate(now_dt)
+
+    # Renombra el fichero activo (atómico), crea uno nuevo con cabecera y comprime el rotado en segundo plano
+    # El nombre lleva microsegundos y, si aun así ya existe (o su .gz), un contador: os.replace
+    # machacaría un segmento anterior que quizá todavía no se ha comprimido
+    def rotate(self, now_dt):
+        base, ext = os.path.splitext(self.path)
+        stem = f"{base}-{now_dt.strftime('%Y%m%d-%H%M%S-%f')}"
+        rotated_path = f"{stem}{ext}"
+        counter = 1
+        while os.path.exists(rotated_path) or os.path.exists(f"{rotated_path}.gz"):
+            rotated_path = f"{stem}-{counter}{ext}"
+            counter += 1
+        os.replace(self.path, rotated_path)
+        ensure_csv_exists()
+        threading.Thread(target=compress_history_segment, args=(rotated_path,), daemon=True).start()
+        print(f"[{datetime.now().isoformat()}] Rotated {self.path} to {rotated_path}.gz")
+
+def compress_history_segment(path):
+    try:
+        with open(path, mode='rb') as source, gzip.open(f"{path}.gz.tmp", mode='wb') as target:
+            shutil.copyfileobj(source, target)
+        os.replace(f"{path}.gz.tmp", f"{path}.gz")
+        os.remove(path)
+    except OSError as e:
+        log_event(logging.ERROR, 'file_compress_error', path=path, error=e)
+
+history_writer = HistoryWriter(CSV_FILE)
 
 # --- NUEVA FUNCIÓN: Obtener TODOS los símbolos de KuCoin ---
 async def get_all_kucoin_symbols():
     # CORREGIDO: Endpoint para obtener todos los símbolos de mercado
-    url = "https://api.kucoin.com/api/v1/symbols" 
+    url = f"{KUCOIN_API_BASE}/api/v1/symbols" 
     print(f"[{datetime.now().isoformat()}] Fetching all symbols from KuCoin API: {url}")
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, timeout=15.0) 
-            response.raise_for_status() 
-            data = response.json()
-            
-            # La respuesta de este endpoint es {'code': '200000', 'data': [...]}
-            if not data or not data.get('data') or not isinstance(data['data'], list):
-                raise ValueError("API de KuCoin para símbolos devolvió respuesta inválida o sin datos.")
-            
-            filtered_symbols = []
-            for item in data['data']: # Iterar directamente sobre la lista de símbolos
-                if item.get('enableTrading') and item.get('baseCurrency') and item.get('quoteCurrency'):
-                    if item['quoteCurrency'] == 'USDT' or item['quoteCurrency'] == 'USDC':
-                        filtered_symbols.append(f"{item['baseCurrency']}-{item['quoteCurrency']}")
-            
-            filtered_symbols = sorted(list(set(filtered_symbols)))
-            print(f"[{datetime.now().isoformat()}] Fetched {len(filtered_symbols)} symbols from KuCoin.")
-            print(f"[{datetime.now().isoformat()}] First 10 symbols: {filtered_symbols[:10]}")
-            return filtered_symbols
+        client = get_http_client()
+        response = await get_with_backoff(client, url, timeout=15.0) 
+        response.raise_for_status() 
+        data = response.json()
+        
+        # La respuesta de este endpoint es {'code': '200000', 'data': [...]}
+        if not data or not data.get('data') or not isinstance(data['data'], list):
+            raise ValueError("API de KuCoin para símbolos devolvió respuesta inválida o sin datos.")
+        
+        filtered_symbols = []
+        for item in data['data']: # Iterar directamente sobre la lista de símbolos
+            if item.get('enableTrading') and item.get('baseCurrency') and item.get('quoteCurrency'):
+                if item['quoteCurrency'] == 'USDT' or item['quoteCurrency'] == 'USDC':
+                    filtered_symbols.append(f"{item['baseCurrency']}-{item['quoteCurrency']}")
+        
+        filtered_symbols = sorted(list(set(filtered_symbols)))
+        print(f"[{datetime.now().isoformat()}] Fetched {len(filtered_symbols)} symbols from KuCoin.")
+        print(f"[{datetime.now().isoformat()}] First 10 symbols: {filtered_symbols[:10]}")
+        return filtered_symbols
 
     except httpx.HTTPStatusError as e:
-        print(f"Error HTTP al obtener símbolos de KuCoin: {e.response.status_code} - {e.response.text}")
+        log_event(logging.ERROR, 'kucoin_http_error', endpoint='symbols', status=e.response.status_code, body=e.response.text[:200])
         return []
     except httpx.RequestError as e:
-        print(f"Error de red al obtener símbolos de KuCoin: {e}")
+        log_event(logging.ERROR, 'kucoin_network_error', endpoint='symbols', error=e)
         return []
     except ValueError as e:
-        print(f"Error de datos de KuCoin para símbolos: {e}")
+        log_event(logging.ERROR, 'kucoin_data_error', endpoint='symbols', error=e)
         return []
     except Exception as e:
-        print(f"Error inesperado al obtener símbolos de KuCoin: {e}")
+        log_event(logging.ERROR, 'kucoin_unexpected_error', endpoint='symbols', error=e)
         return []
 
 
+# Volumen de 24h (en la moneda de cotización) de todos los pares, en una sola petición a allTickers
+async def get_kucoin_volumes():
+    url = f"{KUCOIN_API_BASE}/api/v1/market/allTickers"
+    try:
+        client = get_http_client()
+        response = await get_with_backoff(client, url, timeout=15.0)
+        response.raise_for_status()
+        data = response.json()
+
+        # La respuesta es {'code': '200000', 'data': {'time': ..., 'ticker': [...]}}
+        if not data or not data.get('data') or not isinstance(data['data'].get('ticker'), list):
+            raise ValueError("API de KuCoin para tickers devolvió respuesta inválida o sin datos.")
+
+        volumes = {}
+        for item in data['data']['ticker']:
+            if item.get('symbol') and item.get('volValue') is not None:
+                volumes[item['symbol']] = float(item['volValue'])
+        return volumes
+
+    except httpx.HTTPStatusError as e:
+        log_event(logging.ERROR, 'kucoin_http_error', endpoint='allTickers', status=e.response.status_code, body=e.response.text[:200])
+        return {}
+    except httpx.RequestError as e:
+        log_event(logging.ERROR, 'kucoin_network_error', endpoint='allTickers', error=e)
+        return {}
+    except ValueError as e:
+        log_event(logging.ERROR, 'kucoin_data_error', endpoint='allTickers', error=e)
+        return {}
+    except Exception as e:
+        log_event(logging.ERROR, 'kucoin_unexpected_error', endpoint='allTickers', error=e)
+        return {}
+
+
+# --- UNIVERSO DE SÍMBOLOS (CACHE CON TTL) ---
+# La lista filtrada de símbolos se guarda en memoria y en SYMBOLS_CACHE_FILE. get() la devuelve al
+# momento; si ha caducado lanza un refresco en segundo plano (stale-while-revalidate) y solo espera
+# a KuCoin cuando no hay ninguna lista. Cada refresco actualiza SYMBOLS_TO_MONITOR en el sitio:
+# entran los nuevos listados y los pares deslistados se quitan junto con su estado en memoria.
+class SymbolUniverse:
+    def __init__(self, cache_file=SYMBOLS_CACHE_FILE, ttl=SYMBOLS_CACHE_TTL):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.symbols = []
+        self.symbol_set = frozenset()
+        self.fetched_at = None
+        self._refresh_task = None
+
+    def load(self):
+        try:
+            with open(self.cache_file, mode='r', encoding='utf-8') as file:
+                data = json.load(file)
+            self.symbols = list(data['symbols'])
+            self.fetched_at = parse_iso_timestamp(data['fetched_at'])
+            print(f"[{datetime.now().isoformat()}] Loaded {len(self.symbols)} symbols from {self.cache_file} (fetched at {data['fetched_at']}).")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log_event(logging.ERROR, 'file_read_error', path=self.cache_file, error=e)
+        if self.symbols:
+            self.apply(self.symbols)
+
+    def save(self):
+        tmp_file = f"{self.cache_file}.tmp"
+        try:
+            with open(tmp_file, mode='w', encoding='utf-8') as file:
+                json.dump({'fetched_at': self.fetched_at.isoformat().replace('+00:00', 'Z'), 'symbols': self.symbols}, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            log_event(logging.ERROR, 'file_write_error', path=self.cache_file, error=e)
+
+    def is_stale(self):
+        return self.fetched_at is None or datetime.now(timezone.utc) - self.fetched_at >= self.ttl
+
+    # Sustituye SYMBOLS_TO_MONITOR por la nueva lista y libera lo que quedaba de los pares deslistados
+    def apply(self, symbols):
+        removed = set(SYMBOLS_TO_MONITOR) - set(symbols)
+        added = set(symbols) - set(SYMBOLS_TO_MONITOR)
+        SYMBOLS_TO_MONITOR[:] = symbols
+        self.symbol_set = frozenset(symbols)
+        for symbol in removed:
+            for store in kline_stores.values():
+                store.discard(symbol)
+            for timeframe in ANALYSIS_TIMEFRAMES:
+                timeframe_analysis_cache.pop((symbol, timeframe), None)
+            with indicator_engines_lock:
+                indicator_engines.pop(symbol, None)
+            analysis_fingerprints.pop(symbol, None)
+            current_analysis_cache.pop(symbol, None)
+            analysis_response_cache.pop(symbol, None)
+            opportunity_index.discard(symbol)
+        if removed:
+            mark_analysis_snapshot_dirty()
+        if added or removed:
+            print(f"[{datetime.now().isoformat()}] Symbol universe updated: {len(symbols)} symbols ({len(added)} added, {len(removed)} removed).")
+
+    async def refresh(self):
+        symbols = await single_flight(('symbol_universe',), get_all_kucoin_symbols)
+        if not symbols:
+            # get_all_kucoin_symbols devuelve [] si falla: se sigue con la lista anterior
+            log_event(logging.WARNING, 'symbol_universe_refresh_failed', cached_symbols=len(self.symbols))
+            return self.symbols
+        self.symbols = symbols
+        self.fetched_at = datetime.now(timezone.utc)
+        self.save()
+        self.apply(symbols)
+        return symbols
+
+    # Llamar desde el loop de fondo
+    async def get(self):
+        if not self.symbols:
+            return await self.refresh()
+        if self.is_stale():
+            self._start_refresh()
+        return self.symbols
+
+    # Desde cualquier hilo (rutas de Flask): programa el refresco en el loop de fondo sin esperarlo
+    def schedule_refresh(self):
+        worker.start().call_soon_threadsafe(self._start_refresh)
+
+    # En el loop de fondo: como mucho un refresco en curso
+    def _start_refresh(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.get_running_loop().create_task(self.refresh())
+
+    # Para validar símbolos que llegan en la URL. Sin lista todavía (primer arranque) no se puede comprobar
+    # y se acepta cualquiera.
+    def is_known(self, symbol):
+        return not self.symbol_set or symbol in self.symbol_set
+
+    def get_stats(self):
+        return {
+            'symbols': len(self.symbols),
+            'fetched_at': self.fetched_at.isoformat().replace('+00:00', 'Z') if self.fetched_at else None,
+            'stale': self.is_stale(),
+            'ttl_seconds': self.ttl.total_seconds()
+        }
+
+symbol_universe = SymbolUniverse()
+symbol_universe.load()
+
+
 # --- FUNCIONES DE OBTENCIÓN DE DATOS (KUCOIN API para Klines) ---
-async def get_kucoin_klines(symbol, interval=KUCOIN_INTERVAL, limit=KUCOIN_LIMIT):
+# Devuelve las velas en orden ascendente como tuplas (timestamp_ms, open, close, high, low, volume).
+# Con start_at (segundos) KuCoin solo devuelve las velas desde ese momento (incluida la que empieza en start_at)
+# y con end_at hasta ese momento; como mucho KUCOIN_MAX_CANDLES_PER_REQUEST velas por petición.
+async def get_kucoin_candles(symbol, interval=KUCOIN_INTERVAL, start_at=None, allow_empty=False, end_at=None):
     kucoin_symbol = symbol 
-    url = f"https://api.kucoin.com/api/v1/market/candles?symbol={kucoin_symbol}&type={interval}&limit={limit}"
+    url = f"{KUCOIN_API_BASE}/api/v1/market/candles?symbol={kucoin_symbol}&type={interval}"
+    if start_at is not None:
+        url += f"&startAt={int(start_at)}"
+    if end_at is not None:
+        url += f"&endAt={int(end_at)}"
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, timeout=10.0) 
-            response.raise_for_status() 
-            
-            data = response.json()
-            
-            if not data or not data.get('data') or not isinstance(data['data'], list) or len(data['data']) == 0:
-                raise ValueError(f"API de KuCoin para {kucoin_symbol} devolvió respuesta válida pero sin datos de velas.")
-            
-            formatted_prices = []
-            for kline in data['data']:
-                formatted_prices.append({
-                    'x': int(kline[0]) * 1000, 
-                    'y': float(kline[2])      
-                })
-            
-            return formatted_prices[::-1] 
+        client = get_http_client()
+        response = await get_with_backoff(client, url, timeout=10.0) 
+        response.raise_for_status() 
+        
+        data = response.json()
+        
+        if not data or not isinstance(data.get('data'), list):
+            raise ValueError(f"API de KuCoin para {kucoin_symbol} devolvió respuesta inválida.")
+        if len(data['data']) == 0 and not allow_empty:
+            raise ValueError(f"API de KuCoin para {kucoin_symbol} devolvió respuesta válida pero sin datos de velas.")
+        
+        candles = []
+        for kline in data['data']:
+            candles.append((
+                int(kline[0]) * 1000,
+                float(kline[1]),
+                float(kline[2]),
+                float(kline[3]),
+                float(kline[4]),
+                float(kline[5])
+            ))
+        
+        return candles[::-1] 
 
     except httpx.HTTPStatusError as e:
-        print(f"Error HTTP de KuCoin para {kucoin_symbol}: {e.response.status_code} - {e.response.text}")
+        log_event(logging.WARNING, 'kucoin_http_error', symbol=kucoin_symbol, status=e.response.status_code, body=e.response.text[:200])
         return None
     except httpx.RequestError as e:
-        print(f"Error de red al conectar con KuCoin para {kucoin_symbol}: {e}")
+        log_event(logging.WARNING, 'kucoin_network_error', symbol=kucoin_symbol, error=e)
         return None
     except ValueError as e:
-        print(f"Error de datos de KuCoin para {kucoin_symbol}: {e}")
+        upstream_errors_metric.inc(kind='data')
+        log_event(logging.WARNING, 'kucoin_data_error', symbol=kucoin_symbol, error=e)
         return None
     except Exception as e:
-        print(f"Error inesperado al obtener datos de KuCoin para {kucoin_symbol}: {e}")
+        upstream_errors_metric.inc(kind='unexpected')
+        log_event(logging.ERROR, 'kucoin_unexpected_error', symbol=kucoin_symbol, error=e)
+        return None
+
+# Primer 'startAt' para descargar solo las últimas 'limit' velas (KuCoin ignora el parámetro limit)
+def get_window_start(interval=KUCOIN_INTERVAL, limit=KUCOIN_LIMIT):
+    interval_seconds = KUCOIN_INTERVAL_SECONDS[interval]
+    return (int(time.time()) // interval_seconds - (limit - 1)) * interval_seconds
+
+
+# --- ALMACÉN INCREMENTAL DE VELAS ---
+# Klines en formato columnar: array('q') de timestamps en ms y array('d') de cierres
+KlineColumns = namedtuple('KlineColumns', ['timestamps', 'closes'])
+# Velas OHLCV en columnas: arrays de numpy del mismo largo, timestamps (ms) en int64 y el resto en float64
+CANDLE_FIELDS = 6 # (timestamp_ms, open, close, high, low, volume)
+CandleColumns = namedtuple('CandleColumns', ['timestamps', 'opens', 'closes', 'highs', 'lows', 'volumes'])
+
+# Velas en tuplas (como las devuelve get_kucoin_candles) -> CandleColumns
+def candles_to_columns(candles):
+    values = np.array([candle[1:] for candle in candles], dtype=np.float64).reshape(len(candles), CANDLE_FIELDS - 1)
+    timestamps = np.fromiter((candle[0] for candle in candles), dtype=np.int64, count=len(candles))
+    return CandleColumns(timestamps, *np.ascontiguousarray(values.T))
+
+def slice_candles(candles, start=None, stop=None):
+    return CandleColumns(*(column[start:stop] for column in candles))
+
+# Ventana de un símbolo en arrays de tamaño fijo ('limit'): las velas ocupan los primeros 'count' huecos,
+# en orden. Al llenarse, las nuevas desplazan la ventana (un memmove por barrido, sin objetos por vela).
+class CandleBuffer:
+    __slots__ = ('timestamps', 'values', 'count')
+
+    def __init__(self, limit):
+        self.timestamps = np.empty(limit, dtype=np.int64)
+        self.values = np.empty((CANDLE_FIELDS - 1, limit), dtype=np.float64) # open, close, high, low, volume
+        self.count = 0
+
+    # Copia de la ventana (los arrays del buffer se reescriben en el siguiente barrido)
+    def columns(self):
+        count = self.count
+        return CandleColumns(self.timestamps[:count].copy(), *self.values[:, :count].copy())
+
+    def extend(self, candles):
+        limit = len(self.timestamps)
+        added = len(candles.timestamps)
+        if added >= limit:
+            candles = slice_candles(candles, added - limit)
+            added = limit
+        keep = min(self.count, limit - added)
+        if keep < self.count:
+            self.timestamps[:keep] = self.timestamps[self.count - keep:self.count]
+            self.values[:, :keep] = self.values[:, self.count - keep:self.count]
+        self.timestamps[keep:keep + added] = candles.timestamps
+        self.values[:, keep:keep + added] = candles[1:]
+        self.count = keep + added
+
+    # Sustituye la última vela por la vela 'position' de 'candles'
+    def revise_last(self, candles, position):
+        self.timestamps[self.count - 1] = candles.timestamps[position]
+        self.values[:, self.count - 1] = [column[position] for column in candles[1:]]
+
+# Guarda las últimas 'limit' velas de cada símbolo en columnas de tamaño fijo (CandleBuffer).
+# En cada barrido solo se piden a KuCoin las velas desde la última guardada: esa última vela
+# (la que seguía abierta) se reemplaza en su sitio y las nuevas se añaden al final.
+class KlineStore:
+    def __init__(self, interval=KUCOIN_INTERVAL, limit=KUCOIN_LIMIT):
+        self.interval = interval
+        self.interval_seconds = KUCOIN_INTERVAL_SECONDS[interval]
+        self.limit = limit
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    # Desde dónde pedir velas nuevas (en segundos), o None si hay que descargar la ventana completa
+    def get_start_at(self, symbol):
+        last_start = self.get_last_start(symbol)
+        if last_start is None:
+            return None
+        last_start //= 1000
+        # Si el hueco es mayor que la ventana no merece la pena fusionar: se descarga todo de nuevo
+        if time.time() - last_start >= self.limit * self.interval_seconds:
+            return None
+        return last_start
+
+    # candles: CandleColumns ascendentes
+    def replace(self, symbol, candles):
+        buffer = CandleBuffer(self.limit)
+        buffer.extend(candles)
+        with self._lock:
+            self._buffers[symbol] = buffer
+
+    # Fusiona velas nuevas (CandleColumns ascendentes). Devuelve (velas revisadas, velas añadidas).
+    def merge(self, symbol, new_candles):
+        revised = 0
+        timestamps = new_candles.timestamps
+        with self._lock:
+            buffer = self._buffers.get(symbol)
+            if buffer is None:
+                buffer = self._buffers[symbol] = CandleBuffer(self.limit)
+            first = 0
+            if buffer.count:
+                last_start = buffer.timestamps[buffer.count - 1]
+                first = int(np.searchsorted(timestamps, last_start))
+                if first < len(timestamps) and timestamps[first] == last_start:
+                    buffer.revise_last(new_candles, first)
+                    revised = 1
+                    first += 1
+            appended = len(timestamps) - first
+            if appended > 0:
+                buffer.extend(slice_candles(new_candles, first))
+        return revised, max(appended, 0)
+
+    # Ventana OHLCV (copia), o None si no hay velas
+    def get_columns(self, symbol):
+        with self._lock:
+            buffer = self._buffers.get(symbol)
+            return buffer.columns() if buffer is not None and buffer.count else None
+
+    # Ventana en columnas: timestamps (ms) y cierres, que es lo que usan los indicadores y la cache
+    def get_klines(self, symbol):
+        with self._lock:
+            buffer = self._buffers.get(symbol)
+            if buffer is None:
+                return KlineColumns(array('q'), array('d'))
+            count = buffer.count
+            return KlineColumns(array('q', buffer.timestamps[:count].tobytes()), array('d', buffer.values[1, :count].tobytes()))
+
+    def discard(self, symbol):
+        with self._lock:
+            self._buffers.pop(symbol, None)
+
+    # Copia de todas las ventanas (para el snapshot en disco)
+    def snapshot(self):
+        with self._lock:
+            return {symbol: buffer.columns() for symbol, buffer in self._buffers.items() if buffer.count}
+
+    def has_symbol(self, symbol):
+        with self._lock:
+            buffer = self._buffers.get(symbol)
+            return buffer is not None and buffer.count > 0
+
+    # Inicio (ms) de la última vela guardada, o None
+    def get_last_start(self, symbol):
+        with self._lock:
+            buffer = self._buffers.get(symbol)
+            return int(buffer.timestamps[buffer.count - 1]) if buffer is not None and buffer.count else None
+
+    # Huella del contenido de la ventana: número de velas y timestamp, cierre y volumen de la última.
+    # Las anteriores ya están cerradas, así que si la huella no cambia la ventana tampoco.
+    def get_fingerprint(self, symbol):
+        with self._lock:
+            buffer = self._buffers.get(symbol)
+            if buffer is None or not buffer.count:
+                return None
+            last = buffer.count - 1
+            return (buffer.count, int(buffer.timestamps[last]), float(buffer.values[1, last]), float(buffer.values[4, last]))
+
+# Agrupa velas ascendentes (CandleColumns) en velas de 'interval' (alineadas a múltiplos del intervalo en
+# UTC, como KuCoin): open de la primera, close de la última, máximo de high, mínimo de low y suma del volumen
+def resample_candles(candles, interval):
+    if not len(candles.timestamps):
+        return candles
+    interval_ms = KUCOIN_INTERVAL_SECONDS[interval] * 1000
+    starts = candles.timestamps - candles.timestamps % interval_ms
+    first = np.flatnonzero(np.concatenate(([True], starts[1:] != starts[:-1])))
+    last = np.append(first[1:], len(starts)) - 1
+    return CandleColumns(
+        starts[first], candles.opens[first], candles.closes[last],
+        np.maximum.reduceat(candles.highs, first), np.minimum.reduceat(candles.lows, first), np.add.reduceat(candles.volumes, first)
+    )
+
+# Un almacén por temporalidad. El de la base guarda al menos dos velas de la temporalidad más larga,
+# para poder reconstruir siempre entera la vela abierta de cada una.
+kline_stores = {}
+for _timeframe in (KUCOIN_BASE_INTERVAL,) + ANALYSIS_TIMEFRAMES:
+    if _timeframe not in kline_stores:
+        _ratio = max(KUCOIN_INTERVAL_SECONDS[interval] for interval in ANALYSIS_TIMEFRAMES) // KUCOIN_INTERVAL_SECONDS[_timeframe]
+        kline_stores[_timeframe] = KlineStore(_timeframe, max(KUCOIN_LIMIT, 2 * _ratio) if _timeframe == KUCOIN_BASE_INTERVAL else KUCOIN_LIMIT)
+base_kline_store = kline_stores[KUCOIN_BASE_INTERVAL]
+kline_store = kline_stores[KUCOIN_INTERVAL] # Temporalidad principal
+
+# Copia de las ventanas de todas las temporalidades, por símbolo (para el snapshot en disco)
+def snapshot_kline_stores():
+    candles_by_symbol = {}
+    for interval, store in kline_stores.items():
+        for symbol, candles in store.snapshot().items():
+            candles_by_symbol.setdefault(symbol, {})[interval] = candles
+    return candles_by_symbol
+
+# Pide a KuCoin las velas que le faltan a un almacén (la ventana completa si no tiene nada o el hueco es grande)
+async def fetch_into_store(store, symbol):
+    start_at = store.get_start_at(symbol)
+    if start_at is None:
+        candles = await get_kucoin_candles(symbol, store.interval, start_at=get_window_start(store.interval, store.limit))
+        if candles is None:
+            return False
+        store.replace(symbol, candles_to_columns(candles))
+    else:
+        candles = await get_kucoin_candles(symbol, store.interval, start_at=start_at, allow_empty=True)
+        if candles is None:
+            return False
+        store.merge(symbol, candles_to_columns(candles))
+    return True
+
+# Rehace desde la base (CandleColumns) las velas de 'store' a partir de su última vela guardada (la abierta).
+# Devuelve False si la base no la cubre entera y hay que pedirla a KuCoin: almacén vacío, hueco largo o falta
+# alguna vela base desde el inicio de la abierta (KuCoin no devuelve velas sin operaciones y la agregada saldría parcial).
+def resample_into_store(store, symbol, base_candles):
+    last_start = store.get_last_start(symbol)
+    if last_start is None or base_candles is None or base_candles.timestamps[0] > last_start:
+        return False
+    first = int(np.searchsorted(base_candles.timestamps, last_start))
+    timestamps = base_candles.timestamps[first:]
+    if not len(timestamps) or timestamps[0] != last_start or np.any(np.diff(timestamps) != KUCOIN_INTERVAL_SECONDS[KUCOIN_BASE_INTERVAL] * 1000):
+        return False
+    store.merge(symbol, resample_candles(slice_candles(base_candles, first), store.interval))
+    return True
+
+# Actualiza el almacén base con las velas nuevas del símbolo (una sola petición) y, a partir de él, el resto de
+# temporalidades; solo se descargan directamente las que no tienen todavía historia suficiente (arranque en frío,
+# que el planificador cuenta con get_symbol_request_cost) o a las que les falta alguna vela base.
+# Devuelve la ventana completa de la temporalidad principal (o None si falla).
+async def refresh_symbol_klines(symbol):
+    if not await fetch_into_store(base_kline_store, symbol):
         return None
+    base_candles = base_kline_store.get_columns(symbol)
+    for interval, store in kline_stores.items():
+        if store is base_kline_store or resample_into_store(store, symbol, base_candles):
+            continue
+        if not await fetch_into_store(store, symbol) and store is kline_store:
+            return None
+    return kline_store.get_klines(symbol)
+
+# Peticiones que costará refrescar un símbolo: la de la base más una por cada temporalidad aún sin velas
+def get_symbol_request_cost(symbol):
+    return 1 + sum(1 for store in kline_stores.values() if store is not base_kline_store and not store.has_symbol(symbol))
 
 
 # --- FUNCIONES DE CÁLCULO DE INDICADORES (No cambian) ---
@@ -245,6 +1652,373 @@ def calculate_rsi(data, period):
             rsi_values.append({'y': 100 - (100 / (1 + rs))})
     return rsi_values
 
+# --- INDICADORES INCREMENTALES (STREAMING) ---
+# Versiones con estado de calculate_sma / calculate_bollinger_bands / calculate_rsi.
+# Cada vela nueva (append) o cada revisión de la vela abierta (revise) cuesta O(1);
+# to_array() devuelve la serie de la ventana actual como array('d'), con NaN donde las funciones
+# originales devuelven None.
+NAN = float('nan')
+
+def nan_padded(count, values):
+    result = array('d', [NAN]) * count
+    result.extend(values)
+    return result
+
+INDICATOR_RESYNC_EVERY = 1000 # Recalcular sumas desde la ventana cada N actualizaciones (evita deriva de float)
+
+class StreamingSMA:
+    def __init__(self, period, maxlen=KUCOIN_LIMIT):
+        self.period = period
+        self.window = deque(maxlen=period)
+        self.total = 0.0
+        self.values = deque(maxlen=maxlen)
+        self.updates = 0
+
+    def append(self, value):
+        if len(self.window) == self.period:
+            self.total -= self.window[0]
+        self.window.append(value)
+        self.total += value
+        self._tick()
+        self.values.append(self.total / self.period if len(self.window) == self.period else None)
+
+    def revise(self, value):
+        self.total += value - self.window[-1]
+        self.window[-1] = value
+        self._tick()
+        self.values[-1] = self.total / self.period if len(self.window) == self.period else None
+
+    def _tick(self):
+        self.updates += 1
+        if self.updates % INDICATOR_RESYNC_EVERY == 0:
+            self.total = sum(self.window)
+
+    def to_array(self):
+        length = len(self.values)
+        if length < self.period:
+            return nan_padded(length, ())
+        return nan_padded(self.period - 1, islice(self.values, self.period - 1, None))
+
+
+# Bandas de Bollinger con varianza móvil de Welford (media y M2 de la ventana)
+class StreamingBollinger:
+    def __init__(self, period, std_dev_multiplier, maxlen=KUCOIN_LIMIT):
+        self.period = period
+        self.std_dev_multiplier = std_dev_multiplier
+        self.window = deque(maxlen=period)
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.values = deque(maxlen=maxlen) # (media, desviación) o None
+        self.updates = 0
+
+    def append(self, value):
+        if len(self.window) == self.period:
+            self._replace(self.window[0], value)
+            self.window.append(value)
+        else:
+            self.window.append(value)
+            delta = value - self.mean
+            self.mean += delta / len(self.window)
+            self.m2 += delta * (value - self.mean)
+        self._tick()
+        self.values.append(self._current())
+
+    def revise(self, value):
+        old_value = self.window[-1]
+        self._replace(old_value, value)
+        self.window[-1] = value
+        self._tick()
+        self.values[-1] = self._current()
+
+    # Sustituye un valor de la ventana por otro sin cambiar su tamaño
+    def _replace(self, old_value, new_value):
+        old_mean = self.mean
+        self.mean += (new_value - old_value) / len(self.window)
+        self.m2 += (new_value - old_value) * (new_value - self.mean + old_value - old_mean)
+
+    def _tick(self):
+        self.updates += 1
+        if self.updates % INDICATOR_RESYNC_EVERY == 0:
+            self.mean = sum(self.window) / len(self.window)
+            self.m2 = sum((x - self.mean) ** 2 for x in self.window)
+
+    def _current(self):
+        if len(self.window) < self.period:
+            return None
+        return (self.mean, (max(self.m2, 0.0) / self.period) ** 0.5)
+
+    def to_array(self):
+        length = len(self.values)
+        if length < self.period:
+            return {band: nan_padded(length, ()) for band in ('middle', 'upper', 'lower')}
+        middle = nan_padded(self.period - 1, ())
+        upper = nan_padded(self.period - 1, ())
+        lower = nan_padded(self.period - 1, ())
+        for mean, std_dev in islice(self.values, self.period - 1, None):
+            middle.append(mean)
+            upper.append(mean + (std_dev * self.std_dev_multiplier))
+            lower.append(mean - (std_dev * self.std_dev_multiplier))
+        return {'middle': middle, 'upper': upper, 'lower': lower}
+
+
+# RSI con suavizado de Wilder: arrastra avg_gain/avg_loss de una vela a la siguiente.
+# Para revisar la vela abierta se guarda el estado anterior a la última actualización.
+# calculate_rsi siembra las medias con las primeras 'period' diferencias de la ventana, así que cuando
+# la ventana se desplaza (vela nueva con la ventana llena) toda la serie cambia: se vuelve a sembrar
+# recorriendo la ventana, O(ventana) una vez por vela nueva; las revisiones de la vela abierta siguen en O(1).
+# Así el resultado coincide exactamente con calculate_rsi sobre la misma ventana.
+class StreamingRSI:
+    def __init__(self, period, maxlen=KUCOIN_LIMIT):
+        self.period = period
+        self.closes = deque(maxlen=maxlen)
+        self.values = deque(maxlen=maxlen)
+        # Estado: (último cierre, nº de diferencias, suma ganancias, suma pérdidas, avg_gain, avg_loss)
+        self.state = (None, 0, 0, 0, None, None)
+        self.previous_state = None
+
+    def append(self, value):
+        slides = len(self.closes) == self.closes.maxlen
+        self.closes.append(value)
+        if slides:
+            self._reseed()
+            return
+        self.previous_state = self.state
+        self.state, rsi_value = self._step(self.state, value)
+        self.values.append(rsi_value)
+
+    def revise(self, value):
+        self.closes[-1] = value
+        self.state, rsi_value = self._step(self.previous_state, value)
+        self.values[-1] = rsi_value
+
+    def _reseed(self):
+        state = (None, 0, 0, 0, None, None)
+        previous_state = None
+        self.values.clear()
+        for close in self.closes:
+            previous_state = state
+            state, rsi_value = self._step(state, close)
+            self.values.append(rsi_value)
+        self.previous_state, self.state = previous_state, state
+
+    def _step(self, state, value):
+        last_close, diffs, gain_sum, loss_sum, avg_gain, avg_loss = state
+        if last_close is None:
+            return (value, 0, 0, 0, None, None), None
+        diff = value - last_close
+        gain = diff if diff > 0 else 0
+        loss = abs(diff) if diff < 0 else 0
+        diffs += 1
+        if diffs < self.period:
+            return (value, diffs, gain_sum + gain, loss_sum + loss, None, None), None
+        if diffs == self.period:
+            avg_gain = (gain_sum + gain) / self.period
+            avg_loss = (loss_sum + loss) / self.period
+        else:
+            avg_gain = ((avg_gain * (self.period - 1)) + gain) / self.period
+            avg_loss = ((avg_loss * (self.period - 1)) + loss) / self.period
+        if avg_loss == 0:
+            rsi_value = 100.0
+        else:
+            rs = avg_gain / avg_loss
+            rsi_value = 100 - (100 / (1 + rs))
+        return (value, diffs, 0, 0, avg_gain, avg_loss), rsi_value
+
+    def to_array(self):
+        length = len(self.values)
+        if length < self.period + 1:
+            return nan_padded(length, ())
+        return nan_padded(self.period, islice(self.values, self.period, None))
+
+
+# Conjunto de indicadores de un símbolo. update() recibe la ventana actual (timestamps y cierres) y solo
+# procesa lo que cambió desde la última llamada: revisa la última vela vista y añade las nuevas.
+class IndicatorEngine:
+    def __init__(self, maxlen=KUCOIN_LIMIT):
+        self.maxlen = maxlen
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.sma_short = StreamingSMA(20, self.maxlen)
+        self.sma_long = StreamingSMA(50, self.maxlen)
+        self.bollinger = StreamingBollinger(20, 2, self.maxlen)
+        self.rsi = StreamingRSI(14, self.maxlen)
+        self.last_timestamp = None
+
+    def _indicators(self):
+        return (self.sma_short, self.sma_long, self.bollinger, self.rsi)
+
+    def update(self, timestamps, closes):
+        with self._lock:
+            start = None
+            if self.last_timestamp is not None:
+                for i in range(len(timestamps) - 1, -1, -1):
+                    if timestamps[i] == self.last_timestamp:
+                        start = i
+                        break
+                    if timestamps[i] < self.last_timestamp:
+                        break
+            if start is None:
+                # Primera vez o la ventana ya no contiene la última vela vista: recalcular desde cero
+                self.reset()
+                new_closes = closes
+            else:
+                for indicator in self._indicators():
+                    indicator.revise(closes[start])
+                new_closes = closes[start + 1:]
+            for close in new_closes:
+                for indicator in self._indicators():
+                    indicator.append(close)
+            if len(timestamps):
+                self.last_timestamp = timestamps[-1]
+            return {
+                'sma_short': self.sma_short.to_array(),
+                'sma_long': self.sma_long.to_array(),
+                'bb_bands': self.bollinger.to_array(),
+                'rsi_data': self.rsi.to_array()
+            }
+
+indicator_engines = {}
+indicator_engines_lock = threading.Lock()
+
+def get_indicator_engine(symbol):
+    with indicator_engines_lock:
+        engine = indicator_engines.get(symbol)
+        if engine is None:
+            engine = indicator_engines[symbol] = IndicatorEngine()
+        return engine
+
+
+# --- INDICADORES VECTORIZADOS (NUMPY, POR LOTES) ---
+# Mismos cálculos que calculate_sma / calculate_bollinger_bands / calculate_rsi pero sobre una matriz
+# (símbolos x velas) de cierres, todos los símbolos a la vez. Las posiciones sin valor quedan en NaN.
+def calculate_sma_batch(closes, period):
+    result = np.full(closes.shape, np.nan)
+    if closes.shape[1] >= period:
+        windows = np.lib.stride_tricks.sliding_window_view(closes, period, axis=1)
+        result[:, period - 1:] = windows.sum(axis=2) / period
+    return result
+
+def calculate_bollinger_bands_batch(closes, period, std_dev_multiplier):
+    middle = np.full(closes.shape, np.nan)
+    std_dev = np.full(closes.shape, np.nan)
+    if closes.shape[1] >= period:
+        windows = np.lib.stride_tricks.sliding_window_view(closes, period, axis=1)
+        mean = windows.sum(axis=2) / period
+        middle[:, period - 1:] = mean
+        std_dev[:, period - 1:] = np.sqrt(((windows - mean[:, :, None]) ** 2).sum(axis=2) / period)
+    return {
+        'middle': middle,
+        'upper': middle + std_dev * std_dev_multiplier,
+        'lower': middle - std_dev * std_dev_multiplier
+    }
+
+def rsi_from_averages(avg_gain, avg_loss):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(avg_loss == 0, 100.0, 100 - (100 / (1 + avg_gain / avg_loss)))
+
+# El suavizado de Wilder es recursivo en el tiempo, así que se recorre vela a vela
+# pero cada paso actualiza todos los símbolos a la vez.
+def calculate_rsi_batch(closes, period):
+    result = np.full(closes.shape, np.nan)
+    if closes.shape[1] < period + 1:
+        return result
+    diffs = np.diff(closes, axis=1)
+    gains = np.where(diffs > 0, diffs, 0.0)
+    losses = np.where(diffs < 0, -diffs, 0.0)
+
+    avg_gain = gains[:, :period].sum(axis=1) / period
+    avg_loss = losses[:, :period].sum(axis=1) / period
+    result[:, period] = rsi_from_averages(avg_gain, avg_loss)
+
+    for i in range(period, diffs.shape[1]):
+        avg_gain = ((avg_gain * (period - 1)) + gains[:, i]) / period
+        avg_loss = ((avg_loss * (period - 1)) + losses[:, i]) / period
+        result[:, i + 1] = rsi_from_averages(avg_gain, avg_loss)
+    return result
+
+def calculate_indicators_batch(closes, sma_short_period=20, sma_long_period=50, bb_period=20, bb_std_dev=2, rsi_period=14):
+    closes = np.asarray(closes, dtype=float)
+    return {
+        'sma_short': calculate_sma_batch(closes, sma_short_period),
+        'sma_long': calculate_sma_batch(closes, sma_long_period),
+        'bb_bands': calculate_bollinger_bands_batch(closes, bb_period, bb_std_dev),
+        'rsi_data': calculate_rsi_batch(closes, rsi_period)
+    }
+
+# Versión vectorizada de get_combined_signals: devuelve listas de 'buy'/'sell'/'hold'/'N/A' (una por símbolo)
+def get_combined_signals_batch(indicators, closes, rsi_upper=70, rsi_lower=30):
+    closes = np.asarray(closes, dtype=float)
+    sma_short = indicators['sma_short']
+    sma_long = indicators['sma_long']
+    last_short, prev_short = sma_short[:, -1], sma_short[:, -2]
+    last_long, prev_long = sma_long[:, -1], sma_long[:, -2]
+    sma_na = np.isnan(prev_short) | np.isnan(prev_long)
+    sma_rec = np.select(
+        [sma_na, (prev_short <= prev_long) & (last_short > last_long), (prev_short >= prev_long) & (last_short < last_long)],
+        ['N/A', 'buy', 'sell'], 'hold')
+
+    last_rsi = indicators['rsi_data'][:, -1]
+    rsi_rec = np.select([np.isnan(last_rsi), last_rsi > rsi_upper, last_rsi < rsi_lower], ['N/A', 'sell', 'buy'], 'hold')
+
+    last_upper = indicators['bb_bands']['upper'][:, -1]
+    last_lower = indicators['bb_bands']['lower'][:, -1]
+    last_price = closes[:, -1]
+    bb_rec = np.select([np.isnan(last_upper), last_price > last_upper, last_price < last_lower], ['N/A', 'sell', 'buy'], 'hold')
+
+    buy_count = (sma_rec == 'buy').astype(int) + (rsi_rec == 'buy') + (bb_rec == 'buy')
+    sell_count = (sma_rec == 'sell').astype(int) + (rsi_rec == 'sell') + (bb_rec == 'sell')
+    overall = np.select([(buy_count >= 2) & (sell_count == 0), (sell_count >= 2) & (buy_count == 0)], ['buy', 'sell'], 'hold')
+    return {'sma': sma_rec.tolist(), 'rsi': rsi_rec.tolist(), 'bb': bb_rec.tolist(), 'overall': overall.tolist()}
+
+# Señal combinada en cada vela y no solo en la última (para el backtest): 1 compra, -1 venta, 0 mantener.
+# Mismas reglas que get_combined_signals_batch; las comparaciones con NaN dan False, como 'N/A'.
+def get_combined_signals_series(indicators, closes, rsi_upper=70, rsi_lower=30):
+    closes = np.asarray(closes, dtype=float)
+    sma_short = indicators['sma_short']
+    sma_long = indicators['sma_long']
+    sma_buy = np.zeros(closes.shape, dtype=bool)
+    sma_sell = np.zeros(closes.shape, dtype=bool)
+    with np.errstate(invalid='ignore'):
+        sma_buy[:, 1:] = (sma_short[:, :-1] <= sma_long[:, :-1]) & (sma_short[:, 1:] > sma_long[:, 1:])
+        sma_sell[:, 1:] = (sma_short[:, :-1] >= sma_long[:, :-1]) & (sma_short[:, 1:] < sma_long[:, 1:])
+        rsi = indicators['rsi_data']
+        bb_upper = indicators['bb_bands']['upper']
+        bb_lower = indicators['bb_bands']['lower']
+        buy_count = sma_buy.astype(np.int8) + (rsi < rsi_lower) + (closes < bb_lower)
+        sell_count = sma_sell.astype(np.int8) + (rsi > rsi_upper) + (closes > bb_upper)
+    return np.select([(buy_count >= 2) & (sell_count == 0), (sell_count >= 2) & (buy_count == 0)], [1, -1], 0).astype(np.int8)
+
+# Fila de la matriz -> array('d') compacto para la cache (copia los bytes, sin pasar por objetos float)
+def batch_row_to_array(row):
+    values = array('d')
+    values.frombytes(np.ascontiguousarray(row, dtype=float).tobytes())
+    return values
+
+def calculate_indicators_for_symbol(closes):
+    batch = calculate_indicators_batch(np.frombuffer(closes, dtype=float)[None, :])
+    return {
+        'sma_short': batch_row_to_array(batch['sma_short'][0]),
+        'sma_long': batch_row_to_array(batch['sma_long'][0]),
+        'bb_bands': {band: batch_row_to_array(batch['bb_bands'][band][0]) for band in ('middle', 'upper', 'lower')},
+        'rsi_data': batch_row_to_array(batch['rsi_data'][0])
+    }
+
+# Señales de un solo símbolo a partir de series columnares (misma lógica que get_combined_signals)
+def get_combined_signals_for_symbol(indicators, closes):
+    def as_row(values):
+        return np.frombuffer(values, dtype=float)[None, :]
+    batch = {
+        'sma_short': as_row(indicators['sma_short']),
+        'sma_long': as_row(indicators['sma_long']),
+        'bb_bands': {band: as_row(indicators['bb_bands'][band]) for band in ('middle', 'upper', 'lower')},
+        'rsi_data': as_row(indicators['rsi_data'])
+    }
+    signals = get_combined_signals_batch(batch, as_row(closes))
+    return {key: values[0] for key, values in signals.items()}
+
+
 # --- Lógica de Señales Combinadas ---
 def get_combined_signals(sma_short, sma_long, rsi, bollinger_bands, closing_prices):
     sma_rec = 'hold'
@@ -320,336 +2094,1448 @@ def get_combined_signals(sma_short, sma_long, rsi, bollinger_bands, closing_pric
     return {'sma': sma_rec, 'rsi': rsi_rec, 'bb': bb_rec, 'overall': overall_recommendation}
 
 
-# --- TAREA PROGRAMADA PARA OBTENER Y ANALIZAR DATOS ---
-async def scheduled_analysis_job(symbols):
-    print(f"[{datetime.now().isoformat()}] Scheduled job started for {len(symbols)} symbols.")
-    for symbol in symbols:
+# --- ANÁLISIS EN FORMATO COLUMNAR ---
+# current_analysis_cache guarda por símbolo arrays tipados (array('q') / array('d')) con un único
+# vector de timestamps compartido por todas las series; NaN marca los puntos sin valor.
+# La forma antigua de lista de dicts {'x','y'} solo se construye al serializar la respuesta.
+ANALYSIS_SERIES = ('sma_short', 'sma_long', 'bb_middle', 'bb_upper', 'bb_lower', 'rsi_data')
+ANALYSIS_FORMATS = ('chart', 'columnar')
+
+def build_analysis_entry(combined_signals, klines, indicators):
+    return {
+        'overall_rec': combined_signals['overall'],
+        'sma': combined_signals['sma'],
+        'rsi': combined_signals['rsi'],
+        'bb': combined_signals['bb'],
+        'timestamps': klines.timestamps,
+        'closes': klines.closes,
+        'sma_short': indicators['sma_short'],
+        'sma_long': indicators['sma_long'],
+        'bb_middle': indicators['bb_bands']['middle'],
+        'bb_upper': indicators['bb_bands']['upper'],
+        'bb_lower': indicators['bb_bands']['lower'],
+        'rsi_data': indicators['rsi_data']
+    }
+
+EMPTY_ANALYSIS = build_analysis_entry(
+    {'overall': 'hold', 'sma': 'N/A', 'rsi': 'N/A', 'bb': 'N/A'},
+    KlineColumns(array('q'), array('d')),
+    {'sma_short': array('d'), 'sma_long': array('d'), 'bb_bands': {'middle': array('d'), 'upper': array('d'), 'lower': array('d')}, 'rsi_data': array('d')}
+)
+
+# Forma original del endpoint: velas como {'x': timestamp, 'y': cierre} e indicadores como {'y': valor} o None
+def analysis_to_chart(entry):
+    timestamps = entry['timestamps']
+
+    def points(values):
+        return [None if value != value else {'y': value} for value in values]
+
+    return {
+        'overall_rec': entry['overall_rec'],
+        'sma': entry['sma'],
+        'rsi': entry['rsi'],
+        'bb': entry['bb'],
+        'klines': [{'x': x, 'y': close} for x, close in zip(timestamps, entry['closes'])],
+        'sma_short': points(entry['sma_short']),
+        'sma_long': points(entry['sma_long']),
+        'bb_bands': {band: points(entry[f'bb_{band}']) for band in ('middle', 'upper', 'lower')},
+        'rsi_data': points(entry['rsi_data'])
+    }
+
+# Forma columnar (?format=columnar): un vector por serie, null donde no hay valor
+def analysis_to_columnar(entry):
+    def column(values):
+        return [None if value != value else value for value in values]
+
+    result = {key: entry[key] for key in ('overall_rec', 'sma', 'rsi', 'bb')}
+    result['timestamps'] = list(entry['timestamps'])
+    result['closes'] = list(entry['closes'])
+    for key in ANALYSIS_SERIES:
+        result[key] = column(entry[key])
+    return result
+
+ANALYSIS_SERIALIZERS = {'chart': analysis_to_chart, 'columnar': analysis_to_columnar}
+
+
+# --- RESPUESTAS PRE-SERIALIZADAS DE /get_latest_analysis ---
+# El barrido serializa el análisis de cada símbolo una sola vez (JSON y, opcionalmente, gzip)
+# con su ETag; el endpoint sirve esos bytes tal cual y responde 304 si el cliente ya los tiene.
+# Por símbolo se guarda una respuesta por formato: 'chart' se genera en el barrido y 'columnar'
+# la primera vez que se pide (se descarta en cuanto el barrido vuelve a analizar el símbolo).
+analysis_response_cache = {}
+
+def serialize_analysis(entry, response_format='chart'):
+    body = json.dumps(ANALYSIS_SERIALIZERS[response_format](entry), separators=(',', ':')).encode('utf-8')
+    return {
+        'etag': hashlib.sha1(body).hexdigest(),
+        'body': body,
+        'gzip': gzip.compress(body, ANALYSIS_RESPONSE_GZIP_LEVEL) if ANALYSIS_RESPONSE_GZIP else None
+    }
+
+def build_analysis_response(symbol, analysis):
+    entry = serialize_analysis(analysis)
+    analysis_response_cache[symbol] = {'chart': entry}
+    return entry
+
+# El líder solo reescribe el snapshot si el análisis de algún símbolo cambió desde la última publicación
+# (un tick en el que todas las ventanas siguen igual no toca el disco). Se marca aquí y al deslistar pares.
+analysis_snapshot_dirty = False
+
+def mark_analysis_snapshot_dirty():
+    global analysis_snapshot_dirty
+    analysis_snapshot_dirty = True
+
+# Guarda el análisis de un símbolo en la cache, con su respuesta serializada, y lo recoloca en el índice
+def set_analysis_entry(symbol, analysis):
+    mark_analysis_snapshot_dirty()
+    current_analysis_cache[symbol] = analysis
+    entry = build_analysis_response(symbol, analysis)
+    opportunity_index.update_from_analysis(symbol, analysis, entry['etag'])
+
+def get_analysis_response(symbol, response_format='chart', timeframe=KUCOIN_INTERVAL):
+    if timeframe != KUCOIN_INTERVAL:
+        return get_timeframe_analysis_response(symbol, timeframe, response_format)
+    if not leader_lock.is_leader:
+        # Proceso seguidor: lo publicado por el líder manda; la cache local solo cubre fetches en vivo
+        entry = analysis_snapshot.get_response(symbol, response_format)
+        if entry is not None:
+            return entry
+    analysis = current_analysis_cache.get(symbol)
+    if analysis is None:
+        return None
+    responses = analysis_response_cache.get(symbol)
+    if responses is None:
+        responses = analysis_response_cache.setdefault(symbol, {})
+    entry = responses.get(response_format)
+    if entry is None:
+        entry = serialize_analysis(analysis, response_format)
+        responses[response_format] = entry
+    return entry
+
+# --- ANÁLISIS DE LAS DEMÁS TEMPORALIDADES ---
+# Las temporalidades distintas de la principal se analizan cuando se piden, con las mismas señales
+# combinadas, a partir de las velas ya agrupadas (el líder, de sus almacenes; los seguidores, del snapshot).
+# El resultado se guarda hasta que cambia la última vela, así que cada ventana se calcula una vez.
+# Si el símbolo ya está analizado pero la temporalidad aún no junta MIN_REQUIRED_KLINES velas (pares
+# recién listados, 1day), se sirve EMPTY_ANALYSIS ya serializado: ir a KuCoin no traería más velas.
+timeframe_analysis_cache = {} # (symbol, timeframe) -> (última vela, análisis, respuestas por formato)
+empty_analysis_responses = {} # formato -> respuesta de EMPTY_ANALYSIS
+
+def get_empty_analysis_response(response_format='chart'):
+    entry = empty_analysis_responses.get(response_format)
+    if entry is None:
+        entry = empty_analysis_responses.setdefault(response_format, serialize_analysis(EMPTY_ANALYSIS, response_format))
+    return entry
+
+def has_base_analysis(symbol):
+    return symbol in current_analysis_cache or (not leader_lock.is_leader and symbol in analysis_snapshot.get_index())
+
+def get_timeframe_candles(symbol, timeframe):
+    if not leader_lock.is_leader:
+        candles = analysis_snapshot.read_candles(symbol, timeframe)
+        if candles is not None:
+            return candles
+    return kline_stores[timeframe].get_columns(symbol)
+
+def get_timeframe_analysis_response(symbol, timeframe, response_format='chart'):
+    candles = get_timeframe_candles(symbol, timeframe)
+    if candles is None or len(candles.timestamps) < MIN_REQUIRED_KLINES:
+        # Sin análisis de ningún tipo se devuelve None para que el endpoint lo analice en vivo
+        return get_empty_analysis_response(response_format) if has_base_analysis(symbol) else None
+    candles = slice_candles(candles, -KUCOIN_LIMIT)
+    last_candle = tuple(column[-1].item() for column in candles)
+    cached = timeframe_analysis_cache.get((symbol, timeframe))
+    if cached is None or cached[0] != last_candle:
+        klines = KlineColumns(array('q', candles.timestamps.tobytes()), array('d', candles.closes.tobytes()))
+        indicators = calculate_indicators_for_symbol(klines.closes)
+        combined_signals = get_combined_signals_for_symbol(indicators, klines.closes)
+        cached = (last_candle, build_analysis_entry(combined_signals, klines, indicators), {})
+        timeframe_analysis_cache[(symbol, timeframe)] = cached
+    responses = cached[2]
+    entry = responses.get(response_format)
+    if entry is None:
+        entry = serialize_analysis(cached[1], response_format)
+        responses[response_format] = entry
+    return entry
+
+def serve_analysis_response(entry):
+    if request.if_none_match.contains(entry['etag']):
+        response = Response(status=304)
+    elif entry['gzip'] is not None and request.accept_encodings['gzip']:
+        response = Response(entry['gzip'], mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(entry['body'], mimetype='application/json')
+    response.set_etag(entry['etag'])
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache' # El navegador revalida siempre con If-None-Match
+    return response
+
+
+# --- SNAPSHOT DEL ANÁLISIS COMPARTIDO ENTRE PROCESOS ---
+# Tras cada barrido el proceso líder publica current_analysis_cache en ANALYSIS_SNAPSHOT_FILE y lo
+# sustituye de forma atómica (os.replace). Formato:
+#   MAGIC + longitud de la cabecera (8 bytes) + cabecera JSON + datos
+#   cabecera: por símbolo, señales, ETag, nº de velas y offsets de sus arrays, de sus velas y de sus cuerpos JSON/gzip
+#   datos: por símbolo, timestamps y series (8 bytes por valor), las velas OHLCV de cada temporalidad en
+#   columnas (timestamp, open, close, high, low, volume) y los cuerpos ya serializados de 'chart'
+# Los seguidores no copian nada en memoria: hacen mmap del fichero y sirven los bytes del cuerpo
+# directamente. Al arrancar, el líder lo usa para rellenar su cache sin recalcular ni reserializar y
+# para sembrar los almacenes de velas, así que tras un reinicio solo se piden a KuCoin las velas que faltan.
+ANALYSIS_SNAPSHOT_MAGIC = b'CTSNAP4\n'
+ANALYSIS_SNAPSHOT_COLUMNS = ('closes',) + ANALYSIS_SERIES
+
+# candles_by_symbol: symbol -> {temporalidad: CandleColumns} (ver snapshot_kline_stores)
+def save_analysis_snapshot(analysis_by_symbol, responses_by_symbol, candles_by_symbol=None, path=ANALYSIS_SNAPSHOT_FILE):
+    candles_by_symbol = candles_by_symbol or {}
+    index = {}
+    bodies = {}
+    offset = 0
+    for symbol, entry in analysis_by_symbol.items():
+        response = (responses_by_symbol.get(symbol) or {}).get('chart') or serialize_analysis(entry)
+        length = len(entry['timestamps'])
+        meta = {'overall_rec': entry['overall_rec'], 'sma': entry['sma'], 'rsi': entry['rsi'], 'bb': entry['bb'], 'length': length, 'offset': offset, 'etag': response['etag']}
+        offset += length * 8 * (1 + len(ANALYSIS_SNAPSHOT_COLUMNS))
+        meta['candles'] = {}
+        for interval, candles in candles_by_symbol.get(symbol, {}).items():
+            meta['candles'][interval] = (offset, len(candles.timestamps))
+            offset += len(candles.timestamps) * 8 * CANDLE_FIELDS
+        # Con gzip solo se guarda el cuerpo comprimido (casi todos los clientes lo aceptan; al resto se
+        # le descomprime al servir), así el snapshot ocupa varias veces menos
+        if response['gzip'] is not None:
+            meta['gzip_offset'], meta['gzip_length'] = offset, len(response['gzip'])
+            offset += len(response['gzip'])
+        else:
+            meta['body_offset'], meta['body_length'] = offset, len(response['body'])
+            offset += len(response['body'])
+        index[symbol] = meta
+        bodies[symbol] = response
+    created_at = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+    header = json.dumps({'created_at': created_at, 'symbols': index}, separators=(',', ':')).encode('utf-8')
+    tmp_file = f"{path}.tmp"
+    try:
+        with open(tmp_file, mode='wb') as file:
+            file.write(ANALYSIS_SNAPSHOT_MAGIC)
+            file.write(len(header).to_bytes(8, 'little'))
+            file.write(header)
+            for symbol in index:
+                entry = analysis_by_symbol[symbol]
+                file.write(entry['timestamps'].tobytes())
+                for column in ANALYSIS_SNAPSHOT_COLUMNS:
+                    file.write(entry[column].tobytes())
+                for candles in candles_by_symbol.get(symbol, {}).values():
+                    for column in candles:
+                        file.write(column.tobytes())
+                file.write(bodies[symbol]['gzip'] if bodies[symbol]['gzip'] is not None else bodies[symbol]['body'])
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, path)
+    except OSError as e:
+        log_event(logging.ERROR, 'file_write_error', path=path, error=e)
+        return False
+    print(f"[{datetime.now().isoformat()}] Analysis snapshot published: {len(index)} symbols, {offset // (1024 * 1024)} MB.")
+    return True
+
+# Respuesta guardada solo comprimida: el cuerpo sin comprimir se genera si algún cliente lo pide
+class LazyBodyResponse(dict):
+    def __init__(self, etag, gzip_body):
+        super().__init__(etag=etag, gzip=gzip_body)
+
+    def __missing__(self, key):
+        if key != 'body':
+            raise KeyError(key)
+        self['body'] = gzip.decompress(self['gzip'])
+        return self['body']
+
+# Vista de solo lectura (mmap) del último snapshot publicado. refresh() solo vuelve a mapear si el
+# fichero ha cambiado; las peticiones en curso siguen usando el mapeo anterior hasta que terminan.
+class AnalysisSnapshot:
+    def __init__(self, path=ANALYSIS_SNAPSHOT_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._state = None # (mmap, base, index)
+        self._key = None
+        self._columnar = {} # symbol -> respuesta 'columnar' de este snapshot, construida bajo demanda
+        self.created_at = None
+        self.loaded_at = None
+
+    def refresh(self):
         try:
-            print(f"[{datetime.now().isoformat()}] Analyzing {symbol}...")
-            klines_data = await get_kucoin_klines(symbol) 
-            
-            min_required_klines = max(20, 50, 14) + 1 
-            if not klines_data or len(klines_data) < min_required_klines:
-                print(f"[{datetime.now().isoformat()}] Insufficient data for {symbol}. Needed {min_required_klines}, got {len(klines_data) if klines_data else 0}. Skipping analysis.")
-                current_overall_rec = 'hold'
-                individual_recs = {'sma': 'N/A', 'rsi': 'N/A', 'bb': 'N/A'}
-                current_price = klines_data[-1]['y'] if klines_data and len(klines_data) > 0 else 0.0
-            else:
-                closing_prices = [p['y'] for p in klines_data]
-                current_price = closing_prices[-1]
+            with open(self.path, mode='rb') as file:
+                stat = os.fstat(file.fileno())
+                key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+                if key == self._key:
+                    return False
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            log_event(logging.ERROR, 'snapshot_map_error', path=self.path, error=e)
+            return False
+        try:
+            if mapped[:len(ANALYSIS_SNAPSHOT_MAGIC)] != ANALYSIS_SNAPSHOT_MAGIC:
+                raise ValueError(f"{self.path} is not an analysis snapshot")
+            header_start = len(ANALYSIS_SNAPSHOT_MAGIC) + 8
+            header_length = int.from_bytes(mapped[len(ANALYSIS_SNAPSHOT_MAGIC):header_start], 'little')
+            header = json.loads(mapped[header_start:header_start + header_length])
+        except (ValueError, KeyError) as e:
+            log_event(logging.ERROR, 'file_read_error', path=self.path, error=e)
+            return False
+        with self._lock:
+            self._state = (mapped, header_start + header_length, header['symbols'])
+            self._key = key
+            self._columnar = {}
+            self.created_at = header['created_at']
+            self.loaded_at = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+        print(f"[{datetime.now().isoformat()}] Mapped analysis snapshot from {self.created_at}: {len(header['symbols'])} symbols.")
+        return True
+
+    def symbols(self):
+        state = self._state
+        return list(state[2]) if state else []
+
+    def read_entry(self, symbol):
+        state = self._state
+        meta = state[2].get(symbol) if state else None
+        if meta is None:
+            return None
+        mapped, base, _ = state
+        position = base + meta['offset']
+        size = meta['length'] * 8
+        entry = {key: meta[key] for key in ('overall_rec', 'sma', 'rsi', 'bb')}
+        entry['timestamps'] = array('q')
+        entry['timestamps'].frombytes(mapped[position:position + size])
+        for column in ANALYSIS_SNAPSHOT_COLUMNS:
+            position += size
+            entry[column] = array('d')
+            entry[column].frombytes(mapped[position:position + size])
+        return entry
+
+    # Último valor de cada columna del análisis, sin copiar las series (NaN si están vacías)
+    def read_last(self, symbol):
+        state = self._state
+        meta = state[2].get(symbol) if state else None
+        if meta is None:
+            return None
+        mapped, base, _ = state
+        size = meta['length'] * 8
+        position = base + meta['offset'] + size
+        last = {}
+        for column in ANALYSIS_SNAPSHOT_COLUMNS:
+            last[column] = struct.unpack_from('<d', mapped, position + size - 8)[0] if size else float('nan')
+            position += size
+        return last
+
+    # Velas OHLCV guardadas del símbolo en una temporalidad (CandleColumns, copiadas del mmap), o None
+    def read_candles(self, symbol, interval=KUCOIN_INTERVAL):
+        state = self._state
+        meta = state[2].get(symbol) if state else None
+        if meta is None or not meta['candles'].get(interval, (0, 0))[1]:
+            return None
+        mapped, base, _ = state
+        offset, length = meta['candles'][interval]
+        position = base + offset
+        columns = []
+        for dtype in (np.int64,) + (np.float64,) * (CANDLE_FIELDS - 1):
+            columns.append(np.frombuffer(mapped, dtype=dtype, count=length, offset=position).copy())
+            position += length * 8
+        return CandleColumns(*columns)
+
+    def get_response(self, symbol, response_format='chart'):
+        state = self._state
+        meta = state[2].get(symbol) if state else None
+        if meta is None:
+            return None
+        if response_format == 'chart':
+            mapped, base, _ = state
+            if 'gzip_offset' not in meta:
+                body_start = base + meta['body_offset']
+                return {'etag': meta['etag'], 'body': mapped[body_start:body_start + meta['body_length']], 'gzip': None}
+            gzip_start = base + meta['gzip_offset']
+            return LazyBodyResponse(meta['etag'], mapped[gzip_start:gzip_start + meta['gzip_length']])
+        with self._lock:
+            columnar = self._columnar
+        response = columnar.get(symbol)
+        if response is None:
+            response = columnar[symbol] = serialize_analysis(self.read_entry(symbol), response_format)
+        return response
+
+    def get_index(self):
+        state = self._state
+        return state[2] if state else {}
+
+    def get_stats(self):
+        state = self._state
+        return {'created_at': self.created_at, 'loaded_at': self.loaded_at, 'symbols': len(state[2]) if state else 0}
+
+analysis_snapshot = AnalysisSnapshot()
+
+# Copia el snapshot en current_analysis_cache (solo el líder necesita tenerlo en memoria, para
+# seguir barriendo a partir de ahí); los cuerpos 'chart' ya serializados se reutilizan tal cual y las
+# velas siembran los almacenes (get_start_at pedirá solo lo que falte desde la última vela guardada).
+def load_analysis_snapshot():
+    analysis_snapshot.refresh()
+    loaded = 0
+    for symbol in analysis_snapshot.symbols():
+        if symbol in current_analysis_cache:
+            continue
+        current_analysis_cache[symbol] = analysis_snapshot.read_entry(symbol)
+        analysis_response_cache[symbol] = {'chart': analysis_snapshot.get_response(symbol)}
+        opportunity_index.update_from_analysis(symbol, current_analysis_cache[symbol], analysis_response_cache[symbol]['chart']['etag'])
+        for interval, store in kline_stores.items():
+            if not store.has_symbol(symbol):
+                candles = analysis_snapshot.read_candles(symbol, interval)
+                if candles is not None:
+                    store.replace(symbol, candles)
+        loaded += 1
+    if loaded:
+        print(f"[{datetime.now().isoformat()}] Loaded {loaded} symbols from the analysis snapshot into memory.")
+    return loaded
+
+# Copias de la cache, las respuestas y los almacenes de velas, hechas en el hilo que escribe (no en el loop
+# de fondo, que mientras tanto atiende rutas de Flask). La marca se quita antes de copiar: lo que cambie
+# durante la escritura vuelve a marcarla y sale en la siguiente publicación.
+analysis_snapshot_published_at = 0.0 # time.monotonic() de la copia del último snapshot publicado
+
+def write_analysis_snapshot():
+    global analysis_snapshot_dirty, analysis_snapshot_published_at
+    copied_at = time.monotonic()
+    analysis_snapshot_dirty = False
+    if not save_analysis_snapshot(dict(current_analysis_cache), dict(analysis_response_cache), snapshot_kline_stores()):
+        mark_analysis_snapshot_dirty()
+        return False
+    analysis_snapshot_published_at = copied_at
+    return True
+
+# Solo en el líder. Devuelve True si se publicó un snapshot nuevo.
+async def publish_analysis_snapshot():
+    if not analysis_snapshot_dirty:
+        return False
+    return await asyncio.to_thread(write_analysis_snapshot)
+
+
+# --- ELECCIÓN DE LÍDER ENTRE PROCESOS ---
+# Con varios workers de gunicorn solo uno barre: el que consigue el flock de SWEEPER_LOCK_FILE.
+# El lock se libera solo si el proceso muere, y entonces otro worker lo coge en su siguiente intento.
+class LeaderLock:
+    def __init__(self, path=SWEEPER_LOCK_FILE):
+        self.path = path
+        self.is_leader = False
+        self._file = None
+
+    def try_acquire(self):
+        if self.is_leader:
+            return True
+        if fcntl is None:
+            self.is_leader = True
+            return True
+        file = open(self.path, mode='a+', encoding='utf-8')
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+        file.seek(0)
+        file.truncate()
+        file.write(f"{os.getpid()}\n")
+        file.flush()
+        self._file = file # Se mantiene abierto mientras viva el proceso
+        self.is_leader = True
+        return True
+
+leader_lock = LeaderLock()
+
+
+# Proceso seguidor: recoloca en el índice de oportunidades solo los símbolos cuyo ETag cambió en el snapshot
+# Lee el índice solo con sus métodos (que toman su lock) y la cache a partir de una copia de sus claves
+def sync_opportunity_index():
+    index = analysis_snapshot.get_index()
+    for symbol, meta in index.items():
+        if opportunity_index.get_etag(symbol) == meta['etag']:
+            continue
+        last = analysis_snapshot.read_last(symbol)
+        opportunity_index.update(symbol, meta['overall_rec'], meta['etag'], last['closes'], last['rsi_data'], last['bb_upper'], last['bb_lower'])
+    cached_symbols = set(current_analysis_cache)
+    for symbol in opportunity_index.symbols():
+        if symbol not in index and symbol not in cached_symbols:
+            opportunity_index.discard(symbol)
+
+# Demanda compartida: los seguidores apuntan en history.db qué símbolos piden sus clientes para que
+# el barrido del líder los trate como nivel "demand" (como mucho una escritura por símbolo y minuto).
+# Solo se apuntan símbolos del universo, así que la tabla y demand_published_at no crecen con
+# símbolos inventados; el líder borra las filas que ya han salido de DEMAND_WINDOW.
+demand_published_at = {}
+demand_publish_lock = threading.Lock()
+
+def record_client_demand(symbol):
+    if not symbol_universe.is_known(symbol):
+        return
+    sweep_planner.record_demand(symbol) # Pasa al nivel "demand" del barrido
+    if not leader_lock.is_leader:
+        publish_demand(symbol)
+
+def publish_demand(symbol):
+    now = time.time()
+    with demand_publish_lock:
+        if now - demand_published_at.get(symbol, 0) < DEMAND_PUBLISH_INTERVAL:
+            return
+        for published_symbol, published_at in list(demand_published_at.items()):
+            if now - published_at >= DEMAND_PUBLISH_INTERVAL:
+                del demand_published_at[published_symbol]
+        demand_published_at[symbol] = now
+    try:
+        conn = get_history_db()
+        with conn:
+            conn.execute('INSERT INTO symbol_demand (symbol, requested_at) VALUES (?, ?) ON CONFLICT(symbol) DO UPDATE SET requested_at = excluded.requested_at', (symbol, now))
+    except sqlite3.Error as e:
+        log_event(logging.WARNING, 'demand_publish_error', symbol=symbol, error=e)
+
+# Solo la llama el líder: de paso borra la demanda caducada
+def read_shared_demand():
+    try:
+        cutoff = time.time() - DEMAND_WINDOW.total_seconds()
+        conn = get_history_db()
+        with conn:
+            conn.execute('DELETE FROM symbol_demand WHERE requested_at < ?', (cutoff,))
+        return {row['symbol']: row['requested_at'] for row in conn.execute('SELECT symbol, requested_at FROM symbol_demand WHERE requested_at >= ?', (cutoff,))}
+    except sqlite3.Error as e:
+        log_event(logging.ERROR, 'demand_read_error', error=e)
+        return {}
+
+
+# --- CANAL PUSH (SERVER-SENT EVENTS) ---
+# Cada cliente de /stream tiene su cola; al terminar un barrido (o, en los seguidores, al mapear un
+# snapshot nuevo) se compara el estado de cada símbolo con el anterior y solo se envía lo que cambió:
+#   analysis:            señales y último punto de cada serie de los símbolos suscritos que cambiaron
+#   opportunity_changes: símbolos que cambian de buy/sell/hold
+#   sweep:               fin de un barrido con cambios (el historial puede tener filas nuevas)
+# Cada evento se formatea una sola vez y se comparte entre todas las colas.
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+class StreamSubscriber:
+    def __init__(self, symbols):
+        self.symbols = symbols
+        self.queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+class AnalysisEventHub:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.subscribers = set()
+        self.last_state = None # symbol -> (etag, overall_rec, sma, rsi, bb)
+        self.events_sent = 0
+        self.clients_dropped = 0
+
+    def subscribe(self, symbols):
+        with self._lock:
+            if len(self.subscribers) >= STREAM_MAX_CLIENTS:
+                return None
+            subscriber = StreamSubscriber(symbols)
+            self.subscribers.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers.discard(subscriber)
+
+    def subscribed_symbols(self):
+        with self._lock:
+            return set().union(*(subscriber.symbols for subscriber in self.subscribers)) if self.subscribers else set()
+
+    # symbol=None: evento para todos los clientes; si no, solo para los suscritos a ese símbolo
+    def publish(self, event, symbol=None):
+        with self._lock:
+            subscribers = [subscriber for subscriber in self.subscribers if symbol is None or symbol in subscriber.symbols]
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(event)
+                self.events_sent += 1
+            except queue.Full:
+                # Cliente demasiado lento: se le cierra el stream (EventSource reconecta y recibe el estado completo)
+                self.unsubscribe(subscriber)
+                self.clients_dropped += 1
+                try:
+                    subscriber.queue.get_nowait()
+                    subscriber.queue.put_nowait(None)
+                except (queue.Empty, queue.Full):
+                    pass
+
+    def get_stats(self):
+        with self._lock:
+            return {'clients': len(self.subscribers), 'events_sent': self.events_sent, 'clients_dropped': self.clients_dropped}
+
+event_hub = AnalysisEventHub()
+
+# Estado resumido por símbolo desde el punto de vista de este proceso (líder: su cache; seguidor: el snapshot)
+def collect_analysis_state():
+    state = {}
+    for symbol, analysis in list(current_analysis_cache.items()):
+        chart = (analysis_response_cache.get(symbol) or {}).get('chart')
+        state[symbol] = (chart['etag'] if chart else None, analysis['overall_rec'], analysis['sma'], analysis['rsi'], analysis['bb'])
+    if not leader_lock.is_leader:
+        for symbol, meta in analysis_snapshot.get_index().items():
+            state[symbol] = (meta['etag'], meta['overall_rec'], meta['sma'], meta['rsi'], meta['bb'])
+    return state
+
+def get_analysis_entry(symbol):
+    if not leader_lock.is_leader:
+        entry = analysis_snapshot.read_entry(symbol)
+        if entry is not None:
+            return entry
+    return current_analysis_cache.get(symbol)
+
+# Delta de un símbolo: señales y el último punto de cada serie (NaN -> null)
+def build_analysis_delta(symbol, etag):
+    entry = get_analysis_entry(symbol)
+    if entry is None or not len(entry['timestamps']):
+        return None
+    last = {'x': entry['timestamps'][-1], 'close': entry['closes'][-1]}
+    for key in ANALYSIS_SERIES:
+        value = entry[key][-1]
+        last[key] = None if value != value else value
+    delta = {key: entry[key] for key in ('overall_rec', 'sma', 'rsi', 'bb')}
+    delta.update(symbol=symbol, etag=etag, last=last)
+    return delta
+
+def notify_analysis_updates():
+    state = collect_analysis_state()
+    previous = event_hub.last_state
+    event_hub.last_state = state
+    if previous is None or not event_hub.subscribers:
+        return
+    changed = [symbol for symbol, value in state.items() if previous.get(symbol) != value]
+    subscribed = event_hub.subscribed_symbols()
+    for symbol in changed:
+        if symbol in subscribed:
+            delta = build_analysis_delta(symbol, state[symbol][0])
+            if delta is not None:
+                event_hub.publish(format_sse('analysis', delta), symbol)
+    rec_changes = {symbol: value[1] for symbol, value in state.items() if previous.get(symbol, (None, None))[1] != value[1]}
+    if rec_changes:
+        event_hub.publish(format_sse('opportunity_changes', rec_changes))
+    if changed:
+        event_hub.publish(format_sse('sweep', {'finished_at': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'), 'changed': len(changed)}))
+
+
+# --- SINGLE-FLIGHT ---
+# Agrupa las llamadas concurrentes con la misma clave: la primera ejecuta la corrutina y el resto
+# espera su resultado (o su excepción). El resultado se comparte con un concurrent.futures.Future,
+# así que también funciona si alguna llamada llega desde un loop distinto del de fondo.
+inflight_calls = {}
+inflight_calls_lock = threading.Lock()
+
+async def single_flight(key, coro_factory):
+    with inflight_calls_lock:
+        future = inflight_calls.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = concurrent.futures.Future()
+            inflight_calls[key] = future
+    if not is_leader:
+        return await asyncio.wrap_future(future)
+    try:
+        result = await coro_factory()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with inflight_calls_lock:
+            inflight_calls.pop(key, None)
+
+# Descarga y análisis en vivo de un símbolo que no está en la cache (símbolo recién listado, etc.).
+# Devuelve False si no hay velas suficientes.
+async def analyze_symbol_live(symbol):
+    klines = await refresh_symbol_klines(symbol)
+    if not klines or len(klines.closes) < MIN_REQUIRED_KLINES:
+        return False
+    await asyncio.to_thread(set_live_analysis_entry, symbol, klines)
+    return True
+
+def set_live_analysis_entry(symbol, klines):
+    indicators = calculate_indicators_for_symbol(klines.closes)
+    combined_signals = get_combined_signals_for_symbol(indicators, klines.closes)
+    set_analysis_entry(symbol, build_analysis_entry(combined_signals, klines, indicators))
+
+
+# --- PLANIFICACIÓN DEL BARRIDO POR NIVELES ---
+# Decide qué símbolos se refrescan en cada tick sin pasarse del presupuesto de peticiones:
+#   demand: pedidos por clientes en /get_latest_analysis durante los últimos DEMAND_WINDOW
+#   volume: los VOLUME_TIER_SIZE pares de mayor volumen de 24h
+#   tail:   el resto, por turnos (orden alfabético) para completar una vuelta cada TAIL_REFRESH_INTERVAL
+# El presupuesto va en peticiones: 'cost' da las de cada símbolo (por defecto 1), así que los símbolos en frío
+# (que aún tienen que descargar cada temporalidad) caben menos por tick y su arranque se reparte entre varios.
+class SweepPlanner:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.demand = {} # symbol -> time.monotonic() de la última petición
+        self.volumes = {}
+        self.volumes_updated_at = None
+        self.tail_cursor = None # Último símbolo de la cola refrescado
+        self.last_plan = {}
+
+    def record_demand(self, symbol):
+        with self._lock:
+            self.demand[symbol] = time.monotonic()
+
+    # Demanda publicada por otros procesos (epoch en segundos)
+    def merge_demand(self, demand):
+        offset = time.monotonic() - time.time()
+        with self._lock:
+            for symbol, requested_at in demand.items():
+                self.demand[symbol] = max(self.demand.get(symbol, 0), requested_at + offset)
+
+    def set_volumes(self, volumes):
+        with self._lock:
+            self.volumes = volumes
+            self.volumes_updated_at = time.monotonic()
+
+    def volumes_stale(self):
+        with self._lock:
+            return self.volumes_updated_at is None or time.monotonic() - self.volumes_updated_at >= VOLUME_REFRESH_INTERVAL.total_seconds()
+
+    # Toma candidatos en orden mientras quepan en 'allowance' peticiones; se para en el primero que no cabe
+    # para no adelantarlo (si es el primero del nivel entra igual, o un símbolo caro no cabría nunca).
+    @staticmethod
+    def _take(candidates, allowance, cost):
+        picked, spent = [], 0
+        for symbol in candidates:
+            symbol_cost = cost(symbol)
+            if allowance <= 0 or (picked and spent + symbol_cost > allowance):
+                break
+            picked.append(symbol)
+            spent += symbol_cost
+        return picked, spent
+
+    def plan(self, symbols, budget, tick_seconds, cost=lambda symbol: 1):
+        now = time.monotonic()
+        with self._lock:
+            demand_cutoff = now - DEMAND_WINDOW.total_seconds()
+            self.demand = {symbol: seen for symbol, seen in self.demand.items() if seen >= demand_cutoff}
+            universe = set(symbols)
+
+            hot = sorted((symbol for symbol in self.demand if symbol in universe), key=lambda symbol: -self.demand[symbol])
+            hot_set = set(hot)
+            by_volume = sorted((symbol for symbol in universe if symbol not in hot_set and symbol in self.volumes), key=lambda symbol: -self.volumes[symbol])[:VOLUME_TIER_SIZE]
+            volume_set = set(by_volume)
+            tail = sorted(symbol for symbol in universe if symbol not in hot_set and symbol not in volume_set)
+
+            # La cola necesita como mucho lo justo para dar la vuelta a tiempo; parte del presupuesto se le reserva
+            tail_quota = min(len(tail), math.ceil(len(tail) * tick_seconds / TAIL_REFRESH_INTERVAL.total_seconds()))
+            tail_reserved = min(tail_quota, int(budget * SWEEP_TAIL_MIN_SHARE))
+            remaining = budget - tail_reserved
+            hot, spent = self._take(hot, remaining, cost)
+            remaining -= spent
+            by_volume, spent = self._take(by_volume, remaining, cost)
+            remaining -= spent
+
+            picked_tail = []
+            if tail and tail_quota:
+                start = bisect.bisect_right(tail, self.tail_cursor) if self.tail_cursor is not None else 0
+                picked_tail, spent = self._take((tail[start:] + tail[:start])[:tail_quota], tail_reserved + remaining, cost)
+                remaining -= spent
+                if picked_tail:
+                    self.tail_cursor = picked_tail[-1]
+
+            self.last_plan = {
+                'planned_at': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'),
+                'budget': budget,
+                'requests': budget - tail_reserved - remaining,
+                'universe': len(universe),
+                'demand': len(hot),
+                'volume': len(by_volume),
+                'tail': len(picked_tail),
+                'tail_size': len(tail),
+                'tail_cursor': self.tail_cursor,
+                'volumes_known': len(self.volumes)
+            }
+        return hot + by_volume + picked_tail
 
-                sma_short = calculate_sma(closing_prices, 20)
-                sma_long = calculate_sma(closing_prices, 50)
-                bollinger_bands = calculate_bollinger_bands(closing_prices, 20, 2)
-                rsi = calculate_rsi(closing_prices, 14)
+    def get_stats(self):
+        with self._lock:
+            return dict(self.last_plan, hot_symbols=len(self.demand))
 
-                combined_signals = get_combined_signals(sma_short, sma_long, rsi, bollinger_bands, closing_prices)
-                current_overall_rec = combined_signals['overall']
-                individual_recs = {'sma': combined_signals['sma'], 'rsi': combined_signals['rsi'], 'bb': combined_signals['bb']}
-            
-            # Actualizar la cache con los resultados completos para este símbolo
-            current_analysis_cache[symbol] = {
-                'overall_rec': current_overall_rec,
-                'sma': individual_recs['sma'],
-                'rsi': individual_recs['rsi'],
-                'bb': individual_recs['bb'],
-                'klines': klines_data, 
-                'sma_short': sma_short,
-                'sma_long': sma_long,
-                'bb_bands': bollinger_bands,
-                'rsi_data': rsi
-            }
+sweep_planner = SweepPlanner()
 
-            # Decidir si guardar la recomendación (lógica de 1 hora / 3% de cambio)
-            last_rec_info = get_last_recommendation_from_file(symbol)
-            
-            should_save = False
-            now_dt = datetime.now(timezone.utc)
-            
-            if last_rec_info:
-                last_saved_timestamp = datetime.fromisoformat(last_rec_info['timestamp'].replace('Z', '+00:00')).replace(tzinfo=timezone.utc)
-                last_saved_price = float(last_rec_info.get('last_price', 0.0))
-                
-                has_time_passed = (now_dt - last_saved_timestamp) >= SAVE_REC_TO_BACKEND_INTERVAL
-                
-                has_significant_price_change = False
-                if last_saved_price != 0.0 and current_price is not None and current_price != 0:
-                    percentage_change = abs(current_price - last_saved_price) / last_saved_price
-                    has_significant_price_change = percentage_change >= PRICE_CHANGE_THRESHOLD
-                    print(f"  {symbol}: % cambio precio: {(percentage_change*100):.2f}% (Umbral: {PRICE_CHANGE_THRESHOLD*100:.0f}%), Tiempo pasado: {has_time_passed}")
-                else: 
-                     has_significant_price_change = True 
-
-                if has_time_passed or has_significant_price_change:
-                    should_save = True
-            else: # Primera recomendación para este símbolo
-                should_save = True
-                print(f"  {symbol}: Primera recomendación, guardando.")
-
-            if should_save:
-                last_prev_rec = last_rec_info.get('recommendation', 'N/A') if last_rec_info else 'N/A'
-                last_prev_sma_rec = last_rec_info.get('sma_rec', 'N/A') if last_rec_info else 'N/A'
-                last_prev_rsi_rec = last_rec_info.get('rsi_rec', 'N/A') if last_rec_info else 'N/A'
-                last_prev_bb_rec = last_rec_info.get('bb_rec', 'N/A') if last_rec_info else 'N/A'
-                
-                metric_type = 'N/A'
-                metric_value = 0.0
-                details = ""
-
-                if last_prev_rec != 'N/A' and current_overall_rec != 'N/A':
-                    if current_overall_rec == last_prev_rec:
-        match_count = 0
-        if individual_recs['sma'] == last_prev_sma_rec and individual_recs['sma'] != 'N/A': match_count += 1
-        if individual_recs['rsi'] == last_prev_rsi_rec and individual_recs['rsi'] != 'N/A': match_count += 1
-        if individual_recs['bb'] == last_prev_bb_rec and individual_recs['bb'] != 'N/A': match_count += 1
-        metric_value = (match_count / 3) * 100 if match_count > 0 else 0
-
-        if match_count >= 2:
-            metric_type = 'Acierto'
-            details = f"Rec. mantenida. Indicadores coincidentes: {match_count}/3."
-        else:
-            metric_type = 'N/A'
-            details = f"Rec. mantenida pero pocos indicadores coinciden ({match_count}/3)."
-                        details = f"Rec. mantenida. Indicadores coincidentes: {match_count}/3."
-                    else:
-                        metric_type = 'Riesgo'
-                        change_count = 0
-                        if individual_recs['sma'] != last_prev_sma_rec and individual_recs['sma'] != 'N/A': change_count += 1
-                        if individual_recs['rsi'] != last_prev_rsi_rec and individual_recs['rsi'] != 'N/A': change_count += 1
-                        if individual_recs['bb'] != last_prev_bb_rec and individual_recs['bb'] != 'N/A': change_count += 1
-                        metric_value = (change_count / 3) * 100 if change_count > 0 else 0
-                        details = f"Rec. cambió de '{last_prev_rec}' a '{current_overall_rec}'. Indicadores cambiantes: {change_count}/3."
+def get_sweep_request_budget():
+    if SWEEP_REQUEST_BUDGET > 0:
+        return SWEEP_REQUEST_BUDGET
+    return max(1, int(KUCOIN_RATE_LIMIT * ANALYSIS_INTERVAL.total_seconds() * SWEEP_BUDGET_RATE_SHARE))
+
+
+# --- TAREA PROGRAMADA PARA OBTENER Y ANALIZAR DATOS ---
+# Etapa de descarga: como mucho 'max_concurrency' peticiones en vuelo (además del token bucket).
+# Devuelve (symbol, klines) a medida que van terminando para poder analizar mientras se descarga el resto.
+async def fetch_klines_concurrently(symbols, max_concurrency=KUCOIN_MAX_CONCURRENCY):
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch_one(symbol):
+        async with semaphore:
+            with symbol_fetch_metric.time():
+                return symbol, await refresh_symbol_klines(symbol)
+
+    for next_result in asyncio.as_completed([fetch_one(symbol) for symbol in symbols]):
+        yield await next_result
+
+# Analiza un símbolo ya descargado, actualiza la cache y guarda la recomendación si corresponde.
+# Si ya vienen calculados (barrido por lotes), se usan los indicadores y señales recibidos.
+def analyze_symbol(symbol, klines, indicators=None, combined_signals=None):
+    min_required_klines = MIN_REQUIRED_KLINES 
+    if not klines or len(klines.closes) < min_required_klines:
+        log_event(logging.INFO, 'insufficient_data', symbol=symbol, needed=min_required_klines, got=len(klines.closes) if klines else 0)
+        return
+
+    current_price = klines.closes[-1]
+
+    # Indicadores incrementales: solo se procesan las velas nuevas o revisadas desde el último barrido
+    if indicators is None:
+        with indicator_metric.time(backend='streaming'):
+            indicators = get_indicator_engine(symbol).update(klines.timestamps, klines.closes)
+    if combined_signals is None:
+        combined_signals = get_combined_signals_for_symbol(indicators, klines.closes)
+    current_overall_rec = combined_signals['overall']
+    individual_recs = {'sma': combined_signals['sma'], 'rsi': combined_signals['rsi'], 'bb': combined_signals['bb']}
+    
+    # Actualizar la cache con los resultados completos para este símbolo
+    set_analysis_entry(symbol, build_analysis_entry(combined_signals, klines, indicators))
+
+    # Decidir si guardar la recomendación (lógica de 1 hora / 3% de cambio)
+    last_rec_info = get_last_recommendation(symbol)
+    
+    should_save = False
+    now_dt = datetime.now(timezone.utc)
+    
+    if last_rec_info:
+        last_saved_timestamp = datetime.fromisoformat(last_rec_info['timestamp'].replace('Z', '+00:00')).replace(tzinfo=timezone.utc)
+        last_saved_price = float(last_rec_info.get('last_price', 0.0))
+        
+        has_time_passed = (now_dt - last_saved_timestamp) >= SAVE_REC_TO_BACKEND_INTERVAL
+        
+        has_significant_price_change = False
+        if last_saved_price != 0.0 and current_price is not None and current_price != 0:
+            percentage_change = abs(current_price - last_saved_price) / last_saved_price
+            has_significant_price_change = percentage_change >= PRICE_CHANGE_THRESHOLD
+            log_event(logging.DEBUG, 'price_change', symbol=symbol, change_pct=round(percentage_change * 100, 2), threshold_pct=PRICE_CHANGE_THRESHOLD * 100, time_passed=has_time_passed)
+        else: 
+             has_significant_price_change = True 
+
+        if has_time_passed or has_significant_price_change:
+            should_save = True
+    else: # Primera recomendación para este símbolo
+        should_save = True
+        log_event(logging.DEBUG, 'first_recommendation', symbol=symbol)
+
+    if should_save:
+        last_prev_rec = last_rec_info.get('recommendation', 'N/A') if last_rec_info else 'N/A'
+        last_prev_sma_rec = last_rec_info.get('sma_rec', 'N/A') if last_rec_info else 'N/A'
+        last_prev_rsi_rec = last_rec_info.get('rsi_rec', 'N/A') if last_rec_info else 'N/A'
+        last_prev_bb_rec = last_rec_info.get('bb_rec', 'N/A') if last_rec_info else 'N/A'
+        
+        metric_type = 'N/A'
+        metric_value = 0.0
+        details = ""
+
+        if last_prev_rec != 'N/A' and current_overall_rec != 'N/A':
+            if current_overall_rec == last_prev_rec:
+                match_count = 0
+                if individual_recs['sma'] == last_prev_sma_rec and individual_recs['sma'] != 'N/A': match_count += 1
+                if individual_recs['rsi'] == last_prev_rsi_rec and individual_recs['rsi'] != 'N/A': match_count += 1
+                if individual_recs['bb'] == last_prev_bb_rec and individual_recs['bb'] != 'N/A': match_count += 1
+                metric_value = (match_count / 3) * 100 if match_count > 0 else 0
+
+                if match_count >= 2:
+                    metric_type = 'Acierto'
+                    details = f"Rec. mantenida. Indicadores coincidentes: {match_count}/3."
                 else:
-                    details = "Primera recomendación para el símbolo o datos insuficientes para comparar."
-
-                with open(CSV_FILE, mode='a', newline='', encoding='utf-8') as file:
-                    writer = csv.writer(file)
-                    writer.writerow([
-                        now_dt.isoformat().replace('+00:00', 'Z'), # Formato ISO para JS
-                        symbol,
-                        current_overall_rec,
-                        last_prev_rec,
-                        metric_type,
-                        round(metric_value, 2),
-                        details
-                    ])
-                
-                update_last_recommendation_file(symbol, now_dt.isoformat().replace('+00:00', 'Z'), current_overall_rec, individual_recs['sma'], individual_recs['rsi'], individual_recs['bb'], current_price)
-                print(f"[{datetime.now().isoformat()}] Saved new entry for {symbol}: {current_overall_rec}, Price: {current_price}")
+                    metric_type = 'N/A'
+                    details = f"Rec. mantenida pero pocos indicadores coinciden ({match_count}/3)."
             else:
-                print(f"[{datetime.now().isoformat()}] Skipping save for {symbol}: No significant change or time not passed.")
-
-        except Exception as e:
-            print(f"[{datetime.now().isoformat()}] Error in scheduled analysis for {symbol}: {e}")
+                metric_type = 'Riesgo'
+                change_count = 0
+                if individual_recs['sma'] != last_prev_sma_rec and individual_recs['sma'] != 'N/A': change_count += 1
+                if individual_recs['rsi'] != last_prev_rsi_rec and individual_recs['rsi'] != 'N/A': change_count += 1
+                if individual_recs['bb'] != last_prev_bb_rec and individual_recs['bb'] != 'N/A': change_count += 1
+                metric_value = (change_count / 3) * 100 if change_count > 0 else 0
+                details = f"Rec. cambió de '{last_prev_rec}' a '{current_overall_rec}'. Indicadores cambiantes: {change_count}/3."
+        else:
+            details = "Primera recomendación para el símbolo o datos insuficientes para comparar."
+
+        history_row = [
+            now_dt.isoformat().replace('+00:00', 'Z'), # Formato ISO para JS
+            symbol,
+            current_overall_rec,
+            last_prev_rec,
+            metric_type,
+            round(metric_value, 2),
+            details
+        ]
+        history_writer.append(history_row) # Se escribe al final del barrido junto al resto
+        
+        set_last_recommendation(symbol, now_dt.isoformat().replace('+00:00', 'Z'), current_overall_rec, individual_recs['sma'], individual_recs['rsi'], individual_recs['bb'], current_price)
+        recommendations_saved_metric.inc(recommendation=current_overall_rec)
+        log_event(logging.DEBUG, 'recommendation_saved', symbol=symbol, recommendation=current_overall_rec, price=current_price)
+    else:
+        log_event(logging.DEBUG, 'recommendation_unchanged', symbol=symbol)
+
+
+# Huella (KlineStore.get_fingerprint) de la ventana con la que se analizó por última vez cada símbolo.
+# Si tras la descarga sigue igual, el análisis, la cache y la regla de guardado darían lo mismo: se salta.
+analysis_fingerprints = {}
+last_sweep_stats = {'symbols': 0, 'analyzed': 0, 'skipped': 0, 'failed': 0}
+
+# Separa los símbolos descargados cuya ventana no ha cambiado desde su último análisis.
+# La huella se apunta antes de analizar; si el análisis falla, record_analysis_error la borra.
+# Con force=True (análisis forzados) no se salta nada, pero las huellas se siguen apuntando.
+# Devuelve (changed, failed): las descargas fallidas (klines None) van aparte y no se analizan.
+def filter_changed_klines(fetched, force=False):
+    changed = []
+    failed = []
+    for symbol, klines in fetched:
+        if klines is None:
+            failed.append(symbol)
+            continue
+        fingerprint = kline_store.get_fingerprint(symbol)
+        if not force and fingerprint is not None and analysis_fingerprints.get(symbol) == fingerprint:
+            continue
+        if fingerprint is not None:
+            analysis_fingerprints[symbol] = fingerprint
+        changed.append((symbol, klines))
+    return changed, failed
+
+def record_analysis_error(symbol, error):
+    analysis_fingerprints.pop(symbol, None)
+    log_event(logging.ERROR, 'analysis_error', symbol=symbol, error=error)
+
+# Barrido por lotes: agrupa los símbolos por número de velas, apila los cierres en una matriz
+# y calcula indicadores y señales de todo el grupo en una sola pasada vectorizada.
+def analyze_symbols_batch(fetched):
+    groups = {}
+    for symbol, klines in fetched:
+        if not klines or len(klines.closes) < MIN_REQUIRED_KLINES:
+            try:
+                analyze_symbol(symbol, klines)
+            except Exception as e:
+                record_analysis_error(symbol, e)
+            continue
+        groups.setdefault(len(klines.closes), []).append((symbol, klines))
+
+    for group in groups.values():
+        closes = np.array([np.frombuffer(klines.closes, dtype=float) for _, klines in group])
+        with indicator_metric.time(backend='numpy'):
+            batch = calculate_indicators_batch(closes)
+            signals = get_combined_signals_batch(batch, closes)
+        for i, (symbol, klines) in enumerate(group):
+            try:
+                log_event(logging.DEBUG, 'analyzing', symbol=symbol)
+                indicators = {
+                    'sma_short': batch_row_to_array(batch['sma_short'][i]),
+                    'sma_long': batch_row_to_array(batch['sma_long'][i]),
+                    'bb_bands': {band: batch_row_to_array(batch['bb_bands'][band][i]) for band in ('middle', 'upper', 'lower')},
+                    'rsi_data': batch_row_to_array(batch['rsi_data'][i])
+                }
+                combined_signals = {key: signals[key][i] for key in ('sma', 'rsi', 'bb', 'overall')}
+                analyze_symbol(symbol, klines, indicators, combined_signals)
+            except Exception as e:
+                record_analysis_error(symbol, e)
+
+
+# Las descargas son del loop de fondo; el análisis, la serialización (JSON + gzip) y la escritura del
+# historial van a hilos con asyncio.to_thread para no bloquear el loop, que también atiende a las rutas
+# de Flask (worker.run) mientras dura el barrido.
+async def scheduled_analysis_job(symbols, force=False):
+    print(f"[{datetime.now().isoformat()}] Scheduled job started for {len(symbols)} symbols.")
+    started_at = time.monotonic()
+    analyzed = 0
+    failed = 0
+    try:
+        if ANALYSIS_BACKEND == 'numpy':
+            fetched, failed_symbols = filter_changed_klines([result async for result in fetch_klines_concurrently(symbols)], force)
+            analyzed = len(fetched)
+            failed = len(failed_symbols)
+            await asyncio.to_thread(analyze_symbols_batch, fetched)
+        else:
+            async for symbol, klines in fetch_klines_concurrently(symbols):
+                changed, failed_symbols = filter_changed_klines([(symbol, klines)], force)
+                failed += len(failed_symbols)
+                if not changed:
+                    continue
+                analyzed += 1
+                try:
+                    log_event(logging.DEBUG, 'analyzing', symbol=symbol)
+                    await asyncio.to_thread(analyze_symbol, symbol, klines)
+                except Exception as e:
+                    record_analysis_error(symbol, e)
+    finally:
+        try:
+            await asyncio.to_thread(history_writer.flush)
+        finally:
+            await asyncio.to_thread(flush_last_recommendations)
+            sweep_duration_metric.observe(time.monotonic() - started_at)
+    skipped = len(symbols) - analyzed - failed
+    sweep_skipped_metric.inc(skipped)
+    sweep_failed_metric.inc(failed)
+    last_sweep_stats.update(symbols=len(symbols), analyzed=analyzed, skipped=skipped, failed=failed)
+    print(f"[{datetime.now().isoformat()}] Scheduled job finished for {len(symbols)} symbols in {time.monotonic() - started_at:.1f}s ({skipped} unchanged, skipped; {failed} failed).")
 
 # --- RUTAS DE LA API ---
 
+# Tiempo de respuesta por ruta (la regla, no la URL, para no crear una serie por símbolo)
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.perf_counter()
+
+@app.after_request
+def observe_request_duration(response):
+    started_at = g.pop('request_started_at', None)
+    if started_at is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        http_request_metric.observe(time.perf_counter() - started_at, route=route, method=request.method, status=response.status_code)
+    return response
+
 # Endpoint para obtener las recomendaciones (con paginación)
+# Paginación por cursor (keyset): la primera página va sin cursor y las siguientes con el 'next_cursor'
+# de la anterior, así el coste depende solo del tamaño de página y no del tamaño del historial.
+# 'page' junto a un cursor solo numera la página en la respuesta; 'page' sin cursor se mantiene por
+# compatibilidad (OFFSET, recorre las páginas anteriores). total_items sale de recommendation_stats.
 @app.route('/get_recommendations', methods=['GET'])
 def get_recommendations():
     # AÑADIDO: Parámetro de símbolo para filtrar
     symbol_filter = request.args.get('symbol', default=None, type=str)
-    page = request.args.get('page', default=1, type=int)
-    limit = request.args.get('limit', default=20, type=int) 
+    page = max(1, request.args.get('page', default=1, type=int))
+    limit = max(1, request.args.get('limit', default=20, type=int))
+    cursor = request.args.get('cursor', default=None, type=str)
 
-    recommendations = []
     current_time_utc = datetime.now(timezone.utc) 
-    threshold_time_utc = current_time_utc - timedelta(hours=24) # Usamos 24 horas para el historial que se muestra
+    threshold_time_utc = current_time_utc - HISTORY_WINDOW # Usamos 24 horas para el historial que se muestra
+    threshold_ts = datetime_to_micros(threshold_time_utc)
 
-    try:
-        all_recommendations = [] 
-        with open(CSV_FILE, mode='r', encoding='utf-8') as file:
-            reader = csv.reader(file)
-            header = next(reader, None) 
-
-            for row in reader:
-                if len(row) >= 7: 
-                    try:
-                        timestamp_str, symbol, recommendation, prev_recommendation, metric_type, metric_value_str, details = row[:7]
-                        entry_timestamp = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00')).replace(tzinfo=timezone.utc)
-                        
-                        # AÑADIDO: Lógica de filtrado por símbolo
-                        if (symbol_filter is None or symbol == symbol_filter) and entry_timestamp >= threshold_time_utc:
-                            all_recommendations.append({
-                                'timestamp': timestamp_str,
-                                'symbol': symbol,
-                                'recommendation': recommendation,
-                                'prev_recommendation': prev_recommendation,
-                                'metric_type': metric_type,
-                                'metric_value': float(metric_value_str), 
-                                'details': details
-                            })
-                    except ValueError as ve:
-                        print(f"Skipping malformed row (parsing error): {row} - {ve}")
-                    except IndexError as ie:
-                        print(f"Skipping malformed row (index error): {row} - {ie}")
-                else:
-                    print(f"Skipping malformed row (wrong length): {row}")
+    cursor_position = None
+    if cursor:
+        try:
+            cursor_position = decode_history_cursor(cursor)
+        except ValueError:
+            return jsonify({'message': f'Invalid cursor: {cursor}'}), 400
 
-        all_recommendations.sort(key=lambda x: datetime.fromisoformat(x['timestamp'].replace('Z', '+00:00')).replace(tzinfo=timezone.utc), reverse=True)
-        
-        start_index = (page - 1) * limit
-        end_index = start_index + limit
-        paginated_recommendations = all_recommendations[start_index:end_index]
-        
-        total_pages = (len(all_recommendations) + limit - 1) // limit 
+    try:
+        where = 'ts >= ?'
+        params = [threshold_ts]
+        if symbol_filter is not None:
+            where += ' AND symbol = ?'
+            params.append(symbol_filter)
+
+        conn = get_history_db()
+        total_items = count_recent_recommendations(threshold_ts, symbol_filter)
+
+        query = f'SELECT id, ts, {", ".join(HISTORY_COLUMNS)} FROM recommendations WHERE {where}'
+        query_params = list(params)
+        if cursor_position is not None:
+            query += ' AND (ts, id) < (?, ?)'
+            query_params.extend(cursor_position)
+        query += ' ORDER BY ts DESC, id DESC LIMIT ?'
+        query_params.append(limit)
+        if cursor_position is None and page > 1:
+            # Compatibilidad con clientes que solo mandan 'page'
+            query += ' OFFSET ?'
+            query_params.append((page - 1) * limit)
+        rows = conn.execute(query, query_params).fetchall()
+
+        paginated_recommendations = [{column: row[column] for column in HISTORY_COLUMNS} for row in rows]
+        total_pages = (total_items + limit - 1) // limit 
 
         return jsonify({
             'recommendations': paginated_recommendations,
-            'total_items': len(all_recommendations),
+            'total_items': total_items,
             'total_pages': total_pages,
-            'current_page': page
+            'current_page': page,
+            'next_cursor': encode_history_cursor(rows[-1]) if len(rows) == limit else None
         }), 200
 
-    except FileNotFoundError:
-        return jsonify({'recommendations': [], 'total_items': 0, 'total_pages': 0, 'current_page': page}), 200
     except Exception as e:
-        print(f"Error getting recommendations: {e}")
+        log_event(logging.ERROR, 'route_error', route='get_recommendations', error=e)
         return jsonify({'message': f'Internal server error: {str(e)}'}), 500
 
+# Endpoint con los agregados del historial: tasas de Acierto/Riesgo, metric_value medio y frecuencia de cambios
+# buy/sell/hold en las ventanas de 24h/7d/30d (?window= para una sola), global o de un ?symbol=
+@app.route('/get_recommendation_stats', methods=['GET'])
+def get_recommendation_stats_route():
+    symbol = request.args.get('symbol', default=None, type=str)
+    window = request.args.get('window', default=None, type=str)
+    if window is not None and window not in STATS_WINDOWS:
+        return jsonify({'message': f'Invalid window: {window}. Use one of: {", ".join(STATS_WINDOWS)}'}), 400
+    if symbol == STATS_ALL_SYMBOLS:
+        return jsonify({'message': f'Invalid symbol: {symbol}'}), 400
+    try:
+        windows = get_recommendation_stats(symbol or STATS_ALL_SYMBOLS, (window,) if window else tuple(STATS_WINDOWS))
+    except sqlite3.Error as e:
+        log_event(logging.ERROR, 'route_error', route='get_recommendation_stats', error=e)
+        return jsonify({'message': f'Internal server error: {str(e)}'}), 500
+    return jsonify({'symbol': symbol, 'bucket_seconds': STATS_BUCKET_SECONDS, 'windows': windows}), 200
+
 # Endpoint para obtener la lista de símbolos disponibles dinámicamente
 @app.route('/get_available_symbols', methods=['GET'])
-async def get_available_symbols():
+def get_available_symbols():
     try:
-        symbols = await get_all_kucoin_symbols() 
+        # La lista en memoria se sirve directamente desde el hilo de la petición; si ha caducado se refresca
+        # en segundo plano. Solo se espera al loop de fondo si todavía no hay ninguna (primer arranque sin caché).
+        symbols = symbol_universe.symbols
+        if not symbols:
+            symbols = worker.run(symbol_universe.get())
+        elif symbol_universe.is_stale():
+            symbol_universe.schedule_refresh()
         return jsonify(symbols), 200
     except Exception as e:
-        print(f"Error fetching available symbols: {e}")
+        log_event(logging.ERROR, 'route_error', route='get_available_symbols', error=e)
         return jsonify({'message': f'Error fetching available symbols: {str(e)}'}), 500
 
 
+# Endpoint con los contadores del cliente HTTP hacia KuCoin (latencia, conexiones y handshakes TLS)
+@app.route('/get_http_stats', methods=['GET'])
+def get_http_stats_route():
+    return jsonify(get_http_stats()), 200
+
+# Métricas de este proceso en formato de texto de Prometheus
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# Endpoint con el reparto del último tick del barrido entre niveles (demand / volume / tail)
+@app.route('/get_sweep_stats', methods=['GET'])
+def get_sweep_stats():
+    return jsonify(dict(sweep_planner.get_stats(), universe_cache=symbol_universe.get_stats(), snapshot=analysis_snapshot.get_stats(), stream=event_hub.get_stats(), opportunities=opportunity_index.get_stats(), last_sweep=last_sweep_stats, is_leader=leader_lock.is_leader, pid=os.getpid())), 200
+
+
 # Endpoint para obtener las señales actuales y datos de Klines para el gráfico
+# ?format=chart (por defecto, listas de {'x','y'}) o ?format=columnar (un vector por serie)
+# ?timeframe=15min|1hour|4hour|1day (ANALYSIS_TIMEFRAMES; por defecto KUCOIN_INTERVAL)
 @app.route('/get_latest_analysis/<symbol>', methods=['GET'])
-async def get_latest_analysis(symbol):
-    print(f"[{datetime.now().isoformat()}] Frontend requested latest analysis for {symbol}")
+def get_latest_analysis(symbol):
+    log_event(logging.DEBUG, 'analysis_requested', symbol=symbol)
+    response_format = request.args.get('format', default='chart', type=str)
+    if response_format not in ANALYSIS_FORMATS:
+        return jsonify({'message': f'Invalid format: {response_format}. Use one of: {", ".join(ANALYSIS_FORMATS)}'}), 400
+    timeframe = request.args.get('timeframe', default=KUCOIN_INTERVAL, type=str)
+    if timeframe not in ANALYSIS_TIMEFRAMES:
+        return jsonify({'message': f'Invalid timeframe: {timeframe}. Use one of: {", ".join(ANALYSIS_TIMEFRAMES)}'}), 400
+    record_client_demand(symbol)
     
-    if symbol in current_analysis_cache and current_analysis_cache[symbol].get('klines'):
-        print(f"[{datetime.now().isoformat()}] Serving from cache for {symbol}.")
-        return jsonify(current_analysis_cache[symbol]), 200
+    cached_response = get_analysis_response(symbol, response_format, timeframe)
+    if cached_response is not None:
+        analysis_cache_metric.inc(result='hit')
+        log_event(logging.DEBUG, 'analysis_cache_hit', symbol=symbol, timeframe=timeframe)
+        return serve_analysis_response(cached_response)
     
-    print(f"[{datetime.now().isoformat()}] Cache miss for {symbol}, trying to fetch live. (This should be rare if scheduler runs)")
+    # Poco habitual si el barrido está al día: se descarga y analiza en vivo
+    analysis_cache_metric.inc(result='miss')
+    log_event(logging.INFO, 'analysis_cache_miss', symbol=symbol, timeframe=timeframe)
     try:
-        klines_data = await get_kucoin_klines(symbol) 
+        # Las peticiones simultáneas del mismo símbolo comparten una única descarga y análisis
+        analyzed = worker.run(single_flight(('live_analysis', symbol), lambda: analyze_symbol_live(symbol)))
+        live_response = get_analysis_response(symbol, response_format, timeframe) if analyzed else None
         
-        min_required_klines = max(20, 50, 14) + 1 
-        if not klines_data or len(klines_data) < min_required_klines:
-            print(f"[{datetime.now().isoformat()}] Insufficient data for {symbol} on live fetch for frontend. Returning empty.")
-            return jsonify({
-                'overall_rec': 'hold', 'sma': 'N/A', 'rsi': 'N/A', 'bb': 'N/A',
-                'klines': [], 'sma_short': [], 'sma_long': [], 'bb_bands': {'middle':[],'upper':[],'lower':[]}, 'rsi_data': []
-            }), 200
+        if live_response is None:
+            log_event(logging.INFO, 'live_analysis_insufficient_data', symbol=symbol)
+            return jsonify(ANALYSIS_SERIALIZERS[response_format](EMPTY_ANALYSIS)), 200
         
-        closing_prices = [p['y'] for p in klines_data]
-
-        sma_short = calculate_sma(closing_prices, 20)
-        sma_long = calculate_sma(closing_prices, 50)
-        bollinger_bands = calculate_bollinger_bands(closing_prices, 20, 2)
-        rsi = calculate_rsi(closing_prices, 14)
-        combined_signals = get_combined_signals(sma_short, sma_long, rsi, bollinger_bands, closing_prices)
-
-        response_data = {
-            'overall_rec': combined_signals['overall'],
-            'sma': combined_signals['sma'],
-            'rsi': combined_signals['rsi'],
-            'bb': combined_signals['bb'],
-            'klines': klines_data,
-            'sma_short': sma_short,
-            'sma_long': sma_long,
-            'bb_bands': bollinger_bands,
-            'rsi_data': rsi
-        }
-        current_analysis_cache[symbol] = response_data
-        
-        return jsonify(response_data), 200
+        return serve_analysis_response(live_response)
     except Exception as e:
-        print(f"[{datetime.now().isoformat()}] Error serving live analysis for {symbol}: {e}")
+        log_event(logging.ERROR, 'live_analysis_error', symbol=symbol, error=e)
         return jsonify({'message': f'Error fetching live data: {str(e)}'}), 500
 
 
-# --- Lógica de Programación de Tareas ---
-scheduler = BackgroundScheduler()
+# Sin parámetros: listas buy/sell/hold/error del índice (cuerpo ya construido).
+# Con ?sort=rsi|bb: compras y ventas ordenadas por la fuerza de la señal, con sus valores;
+# &limit=N se queda con las N primeras y &rec=buy|sell con uno solo de los lados.
+@app.route('/get_current_opportunities', methods=['GET'])
+def get_current_opportunities():
+    sort = request.args.get('sort', default=None, type=str)
+    if sort is None:
+        payload = opportunity_index.get_payload()
+    else:
+        limit = request.args.get('limit', default=None, type=int)
+        rec = request.args.get('rec', default=None, type=str)
+        if sort not in OPPORTUNITY_SORTS:
+            return jsonify({'message': f"Invalid sort '{sort}'. Use one of: {', '.join(OPPORTUNITY_SORTS)}."}), 400
+        if rec is not None and rec not in OPPORTUNITY_RANKED_RECS:
+            return jsonify({'message': f"Invalid rec '{rec}'. Use one of: {', '.join(OPPORTUNITY_RANKED_RECS)}."}), 400
+        if limit is not None and limit < 1:
+            return jsonify({'message': 'limit must be a positive integer.'}), 400
+        payload = opportunity_index.get_ranked_payload(sort, limit, rec)
+    if request.if_none_match.contains(payload['etag']):
+        response = Response(status=304)
+    else:
+        response = Response(payload['body'], mimetype='application/json')
+    response.set_etag(payload['etag'])
+    return response
+
+# Canal push: /stream?symbols=BTC-USDT,ETH-USDT (text/event-stream). Al conectar se envían las
+# oportunidades completas; después solo los cambios (ver AnalysisEventHub). Cada conexión ocupa un
+# hilo, así que con gunicorn hay que usar workers con hilos (ver gunicorn.conf.py), que además fija
+# STREAM_MAX_CLIENTS por debajo del número de hilos.
+@app.route('/stream', methods=['GET'])
+def stream():
+    symbols = frozenset(symbol for symbol in request.args.get('symbols', default='', type=str).split(',') if symbol)
+    subscriber = event_hub.subscribe(symbols)
+    if subscriber is None:
+        return jsonify({'message': 'Too many stream clients, use polling.'}), 503
+
+    # Los símbolos que alguien está mirando siguen en el nivel "demand" del barrido
+    def touch_demand():
+        for symbol in symbols:
+            record_client_demand(symbol)
+
+    touch_demand()
+
+    def generate():
+        try:
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+            yield format_sse('opportunities', opportunity_index.get_payload()['data'])
+            while True:
+                try:
+                    event = subscriber.queue.get(timeout=STREAM_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    touch_demand()
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    return
+                yield event
+        finally:
+            event_hub.unsubscribe(subscriber)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    # Si el servidor cierra la respuesta sin llegar a recorrerla (cliente desconectado antes del primer
+    # trozo), el finally del generador no se ejecuta: close() libera la plaza igualmente
+    response.call_on_close(lambda: event_hub.unsubscribe(subscriber))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Sin buffer en proxies (nginx / Render)
+    return response
+
+# --- ANÁLISIS FORZADO EN SEGUNDO PLANO ---
+# POST /force_analysis/<symbol> encola el análisis y responde al momento (202); el estado se consulta
+# con GET /force_analysis/<symbol>. Si ya hay uno pendiente para el símbolo no se lanza otro.
+# La cola y el estado están en history.db (tabla forced_analysis), como la demanda compartida: cualquier
+# worker acepta la petición y contesta al GET, pero solo analiza el líder, que es el único que escribe el
+# historial, last_recommendations.csv y el snapshot. Si la petición le llega al líder la lanza al momento;
+# si llega a un seguidor, el líder la recoge en su siguiente vuelta (cada SNAPSHOT_POLL_SECONDS).
+# Un análisis forzado no reescribe el snapshot: lo marca como pendiente y la misma vuelta lo publica como
+# mucho cada FORCED_ANALYSIS_PUBLISH_INTERVAL (o antes, si lo hace el barrido), así una ráfaga de
+# peticiones es una sola escritura. El trabajo sigue en 'running' hasta que el snapshot que lo incluye
+# está publicado, y entonces pasa a 'done': todos los workers ya sirven el resultado.
+def utc_now_iso():
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+def get_forced_analysis(symbol):
+    row = get_history_db().execute('SELECT status, requested_at, started_at, finished_at, error FROM forced_analysis WHERE symbol = ?', (symbol,)).fetchone()
+    return dict(row) if row else None
+
+def enqueue_forced_analysis(symbol):
+    conn = get_history_db()
+    with conn:
+        conn.execute(
+            "INSERT INTO forced_analysis (symbol, status, requested_at) VALUES (?, 'queued', ?) "
+            "ON CONFLICT(symbol) DO UPDATE SET status = 'queued', requested_at = excluded.requested_at, started_at = NULL, finished_at = NULL, error = NULL "
+            "WHERE forced_analysis.status NOT IN ('queued', 'running')",
+            (symbol, utc_now_iso())
+        )
+    return get_forced_analysis(symbol)
+
+# Pasa el análisis de 'queued' a 'running'; False si ya lo reclamó otra llamada
+def claim_forced_analysis(symbol):
+    conn = get_history_db()
+    with conn:
+        cursor = conn.execute("UPDATE forced_analysis SET status = 'running', started_at = ? WHERE symbol = ? AND status = 'queued'", (utc_now_iso(), symbol))
+    return cursor.rowcount == 1
+
+def finish_forced_analysis(symbol, status, error=None):
+    conn = get_history_db()
+    with conn:
+        conn.execute('UPDATE forced_analysis SET status = ?, finished_at = ?, error = ? WHERE symbol = ?', (status, utc_now_iso(), error, symbol))
+
+def read_queued_forced_analyses():
+    return [row['symbol'] for row in get_history_db().execute("SELECT symbol FROM forced_analysis WHERE status = 'queued' ORDER BY requested_at")]
+
+# Un líder nuevo recupera lo que el anterior dejó a medias al morir
+def requeue_interrupted_forced_analyses():
+    conn = get_history_db()
+    with conn:
+        conn.execute("UPDATE forced_analysis SET status = 'queued', started_at = NULL WHERE status = 'running'")
+
+forced_analyses_unpublished = {} # symbol -> time.monotonic() al terminar su análisis (solo en el líder)
+
+# Solo en el líder
+async def run_forced_analysis(symbol):
+    try:
+        # Mismo lock que el barrido: si hay uno en curso, el análisis sigue en 'queued' hasta que termine
+        async with get_sweep_lock():
+            if not await asyncio.to_thread(claim_forced_analysis, symbol):
+                return
+            previous = current_analysis_cache.get(symbol)
+            await scheduled_analysis_job([symbol], force=True) # Se pidió explícitamente: aunque la ventana no haya cambiado
+            if current_analysis_cache.get(symbol) is previous:
+                # scheduled_analysis_job ya registró el motivo (descarga fallida o velas insuficientes)
+                await asyncio.to_thread(finish_forced_analysis, symbol, 'error', 'No analysis was produced (fetch failed or insufficient data).')
+                return
+            forced_analyses_unpublished[symbol] = time.monotonic()
+        notify_analysis_updates()
+    except Exception as e:
+        log_event(logging.ERROR, 'forced_analysis_error', symbol=symbol, error=e)
+        await asyncio.to_thread(finish_forced_analysis, symbol, 'error', str(e))
+
+# Publica el snapshot si hay análisis forzados que aún no están en él (respetando el intervalo mínimo)
+# y pasa a 'done' los que ya lo están
+async def publish_forced_analyses():
+    if not forced_analyses_unpublished:
+        return
+    pending = any(finished_at > analysis_snapshot_published_at for finished_at in forced_analyses_unpublished.values())
+    if pending and time.monotonic() - analysis_snapshot_published_at >= FORCED_ANALYSIS_PUBLISH_INTERVAL:
+        async with get_sweep_lock():
+            await publish_analysis_snapshot()
+    published = [symbol for symbol, finished_at in forced_analyses_unpublished.items() if finished_at <= analysis_snapshot_published_at]
+    for symbol in published:
+        del forced_analyses_unpublished[symbol]
+        await asyncio.to_thread(finish_forced_analysis, symbol, 'done')
+
+forced_analysis_queue_task = None # Referencia fuerte a la tarea (el loop solo guarda una débil)
+
+async def run_forced_analysis_queue():
+    while True:
+        await asyncio.sleep(SNAPSHOT_POLL_SECONDS)
+        try:
+            symbols = await asyncio.to_thread(read_queued_forced_analyses)
+        except sqlite3.Error as e:
+            log_event(logging.ERROR, 'forced_queue_read_error', error=e)
+            continue
+        for symbol in symbols:
+            await run_forced_analysis(symbol)
+        try:
+            await publish_forced_analyses()
+        except sqlite3.Error as e:
+            log_event(logging.ERROR, 'forced_queue_finish_error', error=e)
 
-# SYMBOLS_TO_MONITOR será populado dinámicamente al inicio
-# Para asegurar que el scheduler tenga una lista desde el primer momento, se poblará aquí.
-# Si el fetch falla, la lista puede quedar vacía, pero el scheduler seguirá intentando.
+@app.route('/force_analysis/<symbol>', methods=['POST'])
+def force_analysis(symbol):
+    if not symbol_universe.is_known(symbol):
+        return jsonify({'message': f'Unknown symbol: {symbol}'}), 404
+    if not leader_lock.is_leader and not RUN_BACKGROUND_JOBS:
+        return jsonify({'message': 'No sweeper process is running (RUN_BACKGROUND_JOBS=0); forced analysis is unavailable.'}), 503
+    try:
+        job = enqueue_forced_analysis(symbol)
+    except sqlite3.Error as e:
+        log_event(logging.ERROR, 'route_error', route='force_analysis', symbol=symbol, error=e)
+        return jsonify({'message': f'Internal server error: {str(e)}'}), 500
+    if leader_lock.is_leader and job['status'] == 'queued':
+        worker.submit(run_forced_analysis(symbol))
+    return jsonify(dict(job, symbol=symbol)), 202
 
-# Esto se ejecuta una vez cuando la aplicación Flask se inicia
-if not scheduler.running:
-    scheduler.start()
-    print("Scheduler started upon module load.")
-    print("Running initial scheduled job to populate cache and start analysis.")
-    
-    # Primero, poblar SYMBOLS_TO_MONITOR
-    # Esto es síncrono para asegurar que la lista esté antes de agregar el job.
+@app.route('/force_analysis/<symbol>', methods=['GET'])
+def force_analysis_status(symbol):
     try:
-        # Se necesita un loop de eventos para llamar a una función async fuera de una ruta.
-        # Esto solo se ejecuta una vez al inicio del servidor.
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        symbols_from_api = loop.run_until_complete(get_all_kucoin_symbols())
-        SYMBOLS_TO_MONITOR.extend(symbols_from_api) # Rellenar la lista global
+        job = get_forced_analysis(symbol)
+    except sqlite3.Error as e:
+        log_event(logging.ERROR, 'route_error', route='force_analysis_status', symbol=symbol, error=e)
+        return jsonify({'message': f'Internal server error: {str(e)}'}), 500
+    if job is None:
+        return jsonify({'message': f'No forced analysis requested for {symbol}'}), 404
+    return jsonify(dict(job, symbol=symbol)), 200
+
 
+# --- Lógica de Programación de Tareas ---
+# El barrido periódico es una tarea del loop de fondo (no hay APScheduler ni un loop nuevo por tick).
+# El primer barrido (calentamiento) recorre todo el universo; los siguientes siguen el plan de SweepPlanner.
+# Ticks a ritmo fijo: si un barrido dura más que el intervalo, los ticks perdidos se saltan en vez
+# de encadenar barridos, y nunca hay dos barridos completos a la vez sobre los mismos ficheros.
+# sweep_lock serializa barridos y análisis forzados: ambos escriben data.csv, history.db y
+# last_recommendations.csv. Un tick que llega con un análisis forzado en curso espera a que acabe
+# (es de un solo símbolo) en vez de saltarse.
+sweep_lock = None # asyncio.Lock creado dentro del loop de fondo
+sweep_task = None
+
+# Solo se llama desde corrutinas del loop de fondo (un único hilo), así que no hace falta otro lock
+def get_sweep_lock():
+    global sweep_lock
+    if sweep_lock is None:
+        sweep_lock = asyncio.Lock()
+    return sweep_lock
+
+async def run_sweep(full=False):
+    async with get_sweep_lock():
+        # Si la lista ha caducado se refresca en segundo plano y el tick sigue con la actual;
+        # si no hay ninguna (el fetch inicial falló) se reintenta aquí en cada tick
+        await symbol_universe.get()
         if not SYMBOLS_TO_MONITOR:
             print("[CRITICAL] No symbols loaded from KuCoin. Scheduled job will not run effectively.")
+            return
+        if full:
+            symbols = list(SYMBOLS_TO_MONITOR)
         else:
-            print(f"[{datetime.now().isoformat()}] Initial SYMBOLS_TO_MONITOR populated with {len(SYMBOLS_TO_MONITOR)} symbols.")
-
-            # Añadir la tarea programada DESPUÉS de que SYMBOLS_TO_MONITOR esté poblado
-            scheduler.add_job(
-                lambda: asyncio.run(scheduled_analysis_job(SYMBOLS_TO_MONITOR)), 
-                'interval',
-                minutes=2, 
-                id='full_crypto_analysis',
-                max_instances=1 
-            )
-            
-            # Ejecutar la tarea programada al inicio para poblar la cache lo antes posible
-            # Se ejecuta solo si hay símbolos para evitar errores.
-            if SYMBOLS_TO_MONITOR:
-                loop.run_until_complete(scheduled_analysis_job(SYMBOLS_TO_MONITOR))
-
-    except Exception as e:
-        print(f"[{datetime.now().isoformat()}] Error during initial scheduler setup or symbol fetch: {e}")
-        print("Scheduler might not be fully operational or symbols list is empty.")
+            sweep_planner.merge_demand(await asyncio.to_thread(read_shared_demand))
+            if sweep_planner.volumes_stale():
+                volumes = await get_kucoin_volumes()
+                if volumes:
+                    sweep_planner.set_volumes(volumes)
+            symbols = sweep_planner.plan(SYMBOLS_TO_MONITOR, get_sweep_request_budget(), ANALYSIS_INTERVAL.total_seconds(), get_symbol_request_cost)
+            plan = sweep_planner.get_stats()
+            print(f"[{datetime.now().isoformat()}] Sweep plan: {plan['demand']} demand + {plan['volume']} volume + {plan['tail']}/{plan['tail_size']} tail (budget {plan['budget']}).")
+        await scheduled_analysis_job(symbols)
+        # Snapshot para que los demás procesos (y el próximo arranque) sirvan sin esperar a un barrido;
+        # si ninguna ventana cambió no hay nada que publicar ni que avisar por el stream
+        if await publish_analysis_snapshot():
+            notify_analysis_updates()
+
+async def run_sweeps_forever(interval_seconds, run_now=True):
+    loop = asyncio.get_running_loop()
+    next_run = loop.time() if run_now else loop.time() + interval_seconds
+    full = True
+    while True:
+        await asyncio.sleep(max(0.0, next_run - loop.time()))
+        try:
+            await run_sweep(full)
+            full = False
+        except Exception as e:
+            log_event(logging.ERROR, 'sweep_error', error=e)
+        next_run += interval_seconds
+        now = loop.time()
+        if next_run < now:
+            skipped = int((now - next_run) // interval_seconds) + 1
+            print(f"[{datetime.now().isoformat()}] Sweep took longer than the interval, skipping {skipped} tick(s).")
+            next_run += skipped * interval_seconds
+
+async def start_sweeps(run_now=True):
+    global sweep_task
+    if sweep_task is not None and not sweep_task.done():
+        return sweep_task # Ya registrado: nunca se duplica el job
+    sweep_task = asyncio.get_running_loop().create_task(run_sweeps_forever(ANALYSIS_INTERVAL.total_seconds(), run_now))
+    return sweep_task
+
+# Arranque en segundo plano: los procesos seguidores vuelven a mapear el snapshot cuando el líder publica
+# uno nuevo e intentan el lock en cada vuelta; el que lo consigue hace el barrido de calentamiento y sigue barriendo.
+async def run_background_jobs():
+    global forced_analysis_queue_task
+    while not leader_lock.try_acquire():
+        if analysis_snapshot.refresh():
+            sync_opportunity_index()
+            notify_analysis_updates()
+        await asyncio.sleep(SNAPSHOT_POLL_SECONDS)
+    print(f"[{datetime.now().isoformat()}] Process {os.getpid()} is the sweeper leader.")
+    await asyncio.to_thread(bootstrap_history_db)
+    await asyncio.to_thread(requeue_interrupted_forced_analyses)
+    await asyncio.to_thread(load_analysis_snapshot) # Lo último que publicó el líder anterior, si lo hubo
+    await start_sweeps(run_now=True)
+    forced_analysis_queue_task = asyncio.get_running_loop().create_task(run_forced_analysis_queue())
+    print(f"[{datetime.now().isoformat()}] Sweep scheduled every {ANALYSIS_INTERVAL.total_seconds():.0f}s on the worker loop.")
+
+# Esto se ejecuta una vez cuando la aplicación Flask se inicia. No bloquea: se sirve lo que haya en
+# el snapshot (posiblemente algo antiguo) mientras el barrido de calentamiento corre en el loop de fondo.
+if RUN_BACKGROUND_JOBS:
+    analysis_snapshot.refresh()
+    sync_opportunity_index()
+    event_hub.last_state = collect_analysis_state()
+    worker.submit(run_background_jobs())
+    print(f"[{datetime.now().isoformat()}] Background jobs started; serving {len(analysis_snapshot.symbols())} symbols from the last snapshot.")
 
 
 if __name__ == '__main__':
     print("Running Flask app in __main__ block (for local development).")
     app.run(debug=True, host='0.0.0.0', port=5000, use_reloader=False)
-
-@app.route('/get_current_opportunities', methods=['GET'])
-def get_current_opportunities():
-    buy, sell, hold, error = [], [], [], []
-    for symbol, analysis in current_analysis_cache.items():
-        try:
-            rec = analysis.get('overall_rec', 'hold')
-            if rec == 'buy':
-                buy.append(symbol)
-            elif rec == 'sell':
-                sell.append(symbol)
-            elif rec == 'hold':
-                hold.append(symbol)
-            else:
-                error.append(symbol)
-        except:
-            error.append(symbol)
-    return jsonify({"buy": buy, "sell": sell, "hold": hold, "error": error}), 200
-
-@app.route('/force_analysis/<symbol>', methods=['POST'])
-def force_analysis(symbol):
-    asyncio.run(scheduled_analysis_job([symbol]))
-    return jsonify({"status": "ok"}), 200
-
-def start_scheduler():
-    from threading import Thread
-
-    async def init_scheduler():
-        global SYMBOLS_TO_MONITOR
-        SYMBOLS_TO_MONITOR = await get_all_kucoin_symbols()
-        print(f"[INIT] Inicializando análisis de {len(SYMBOLS_TO_MONITOR)} criptos.")
-        scheduler.add_job(lambda: asyncio.run(scheduled_analysis_job(SYMBOLS_TO_MONITOR)), 'interval', minutes=5)
-        scheduler.start()
-
-    Thread(target=lambda: asyncio.run(init_scheduler())).start()
-
-start_scheduler()
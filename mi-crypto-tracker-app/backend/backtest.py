@@ -0,0 +1,279 @@
+# Backtest de la estrategia combinada (SMA + RSI + Bollinger) sobre el histórico de velas.
+# La métrica 'Acierto'/'Riesgo' del barrido solo compara cada recomendación con la anterior; aquí se
+# reproduce el histórico completo de cada símbolo con los mismos indicadores y señales
+# (calculate_indicators_batch / get_combined_signals_series) para ver si habrían dado dinero.
+#
+# - Histórico: se descarga de KuCoin una vez (paginado) y se guarda en backtest_candles_<intervalo>.npz;
+#   en las siguientes ejecuciones solo se piden las velas nuevas.
+# - Cálculo: matriz símbolos x velas por grupo de longitud, todo vectorizado con numpy; los símbolos
+#   se reparten en trozos entre un pool de procesos y cada trozo evalúa toda la rejilla de parámetros
+#   (los indicadores con el mismo periodo se calculan una sola vez por trozo).
+# - Estrategia: solo largos (spot). Se compra en la señal 'buy', se vende en la 'sell' y se mantiene la
+#   posición con 'hold'; la orden se ejecuta al cierre de la vela de la señal y se cobra 'fee' por operación.
+#
+# Uso: python backtest.py [--days 90] [--interval 1hour] [--symbols 1000] [--sma-short 10,20] [--sma-long 50,100]
+#                         [--rsi-period 14] [--rsi-bands 70:30,80:20] [--bb-period 20] [--bb-std 2,2.5]
+#                         [--fee 0.001] [--horizon 24] [--workers 4] [--json resultados.json]
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import os
+import time
+
+os.environ.setdefault('RUN_BACKGROUND_JOBS', '0')
+
+import numpy as np
+
+import app
+
+BACKTEST_CANDLES_FILE = 'backtest_candles_{interval}.npz'
+BACKTEST_CHUNK_SIZE = 50 # Símbolos por tarea del pool (acota la memoria de las ventanas de Bollinger)
+
+PARAMETER_FIELDS = ('sma_short', 'sma_long', 'rsi_period', 'rsi_upper', 'rsi_lower', 'bb_period', 'bb_std')
+METRIC_FIELDS = ('total_return', 'buy_and_hold', 'max_drawdown', 'trades', 'buy_signals', 'buy_hits', 'sell_signals', 'sell_hits')
+
+
+# --- HISTÓRICO DE VELAS ---
+# Cierres guardados por símbolo como matriz (n, 2): timestamp en ms y cierre. En COVERAGE_KEY va, por
+# símbolo, desde cuándo (segundos) está descargado (los pares recién listados empiezan más tarde).
+COVERAGE_KEY = '__coverage__'
+
+def load_stored_history(path):
+    if not os.path.exists(path):
+        return {}, {}
+    with np.load(path) as stored:
+        coverage = json.loads(str(stored[COVERAGE_KEY])) if COVERAGE_KEY in stored.files else {}
+        return {symbol: stored[symbol] for symbol in stored.files if symbol != COVERAGE_KEY}, coverage
+
+def save_stored_history(path, history, coverage):
+    tmp_file = f"{path}.tmp.npz"
+    np.savez_compressed(tmp_file, **history, **{COVERAGE_KEY: np.array(json.dumps(coverage))})
+    os.replace(tmp_file, path)
+
+# Descarga las velas cerradas desde 'since' (segundos) en páginas de KUCOIN_MAX_CANDLES_PER_REQUEST;
+# si ya hay histórico que cubre 'since' solo se piden las posteriores a la última vela guardada.
+async def download_history(symbols, interval, since, stored, coverage):
+    interval_seconds = app.KUCOIN_INTERVAL_SECONDS[interval]
+    page_seconds = app.KUCOIN_MAX_CANDLES_PER_REQUEST * interval_seconds
+    now = int(time.time())
+    semaphore = asyncio.Semaphore(app.KUCOIN_MAX_CONCURRENCY)
+
+    async def fetch_one(symbol):
+        existing = stored.get(symbol)
+        if existing is not None and len(existing) and coverage.get(symbol, now) <= since:
+            start = int(existing[-1, 0] // 1000) + interval_seconds
+        else:
+            existing, start = None, since
+        candles = {}
+        async with semaphore:
+            while start < now:
+                # startAt y endAt son inclusivos: cada página son exactamente KUCOIN_MAX_CANDLES_PER_REQUEST velas
+                page = await app.get_kucoin_candles(symbol, interval, start_at=start, end_at=min(start + page_seconds - interval_seconds, now), allow_empty=True)
+                if page is None:
+                    return symbol, existing
+                for candle in page:
+                    if candle[0] // 1000 + interval_seconds <= now: # Fuera la vela que sigue abierta
+                        candles[candle[0]] = candle[2]
+                start += page_seconds
+        new_rows = np.array(sorted(candles.items()), dtype=float).reshape(-1, 2)
+        if existing is None:
+            coverage[symbol] = since
+            return symbol, new_rows
+        return symbol, np.concatenate([existing, new_rows[new_rows[:, 0] > existing[-1, 0]]])
+
+    return dict(await asyncio.gather(*(fetch_one(symbol) for symbol in symbols)))
+
+def get_history(symbols, interval, days, path):
+    stored, coverage = load_stored_history(path)
+    since = (int(time.time()) - int(days * 86400)) // app.KUCOIN_INTERVAL_SECONDS[interval] * app.KUCOIN_INTERVAL_SECONDS[interval]
+    history = app.worker.run(download_history(symbols, interval, since, stored, coverage), timeout=None)
+    stored.update({symbol: rows for symbol, rows in history.items() if rows is not None})
+    save_stored_history(path, stored, coverage)
+    return {symbol: rows[rows[:, 0] // 1000 >= since] for symbol, rows in history.items() if rows is not None}
+
+# Agrupa los símbolos por número de velas (como analyze_symbols_batch) y trocea cada grupo para el pool
+def build_chunks(history, chunk_size=BACKTEST_CHUNK_SIZE):
+    groups = {}
+    for symbol, rows in history.items():
+        if len(rows) > app.MIN_REQUIRED_KLINES:
+            groups.setdefault(len(rows), []).append(symbol)
+    chunks = []
+    for symbols in groups.values():
+        for i in range(0, len(symbols), chunk_size):
+            chunk = symbols[i:i + chunk_size]
+            chunks.append((chunk, np.array([history[symbol][:, 1] for symbol in chunk])))
+    return chunks
+
+
+# --- SIMULACIÓN VECTORIZADA ---
+# Posición (0/1) en cada vela: la última señal no neutra manda (compra -> 1, venta -> 0)
+def positions_from_signals(signals):
+    columns = np.arange(signals.shape[1])
+    last_signal_at = np.maximum.accumulate(np.where(signals != 0, columns, 0), axis=1)
+    last_signal = np.take_along_axis(signals, last_signal_at, axis=1)
+    return (last_signal == 1).astype(float)
+
+def simulate(closes, signals, fee, horizon):
+    positions = positions_from_signals(signals)
+    returns = np.zeros(closes.shape)
+    returns[:, 1:] = closes[:, 1:] / closes[:, :-1] - 1
+    changes = np.abs(np.diff(positions, axis=1, prepend=0.0))
+    strategy_returns = np.zeros(closes.shape)
+    strategy_returns[:, 1:] = positions[:, :-1] * returns[:, 1:]
+    equity = np.cumprod(1 + strategy_returns - changes * fee, axis=1)
+    drawdown = 1 - equity / np.maximum.accumulate(equity, axis=1)
+
+    # Acierto de cada señal: el precio 'horizon' velas después va en la dirección de la señal
+    forward = np.full(closes.shape, np.nan)
+    forward[:, :-horizon] = closes[:, horizon:] / closes[:, :-horizon] - 1
+    with np.errstate(invalid='ignore'):
+        buy_hits = ((signals == 1) & (forward > 0)).sum(axis=1)
+        sell_hits = ((signals == -1) & (forward < 0)).sum(axis=1)
+    return {
+        'total_return': equity[:, -1] - 1,
+        'buy_and_hold': closes[:, -1] / closes[:, 0] - 1,
+        'max_drawdown': drawdown.max(axis=1),
+        'trades': (np.diff(positions, axis=1, prepend=0.0) > 0).sum(axis=1),
+        'buy_signals': (signals == 1).sum(axis=1),
+        'buy_hits': buy_hits,
+        'sell_signals': (signals == -1).sum(axis=1),
+        'sell_hits': sell_hits
+    }
+
+# Tarea del pool: toda la rejilla sobre un trozo de símbolos. Devuelve, por combinación, las métricas por símbolo.
+def backtest_chunk(closes, parameter_grid, fee, horizon):
+    sma = {}
+    rsi = {}
+    bands = {}
+    results = []
+    for params in parameter_grid:
+        for period in (params['sma_short'], params['sma_long']):
+            if period not in sma:
+                sma[period] = app.calculate_sma_batch(closes, period)
+        if params['rsi_period'] not in rsi:
+            rsi[params['rsi_period']] = app.calculate_rsi_batch(closes, params['rsi_period'])
+        if params['bb_period'] not in bands:
+            bands[params['bb_period']] = app.calculate_bollinger_bands_batch(closes, params['bb_period'], 1)
+        middle = bands[params['bb_period']]['middle']
+        std_dev = bands[params['bb_period']]['upper'] - middle
+        indicators = {
+            'sma_short': sma[params['sma_short']],
+            'sma_long': sma[params['sma_long']],
+            'bb_bands': {'middle': middle, 'upper': middle + std_dev * params['bb_std'], 'lower': middle - std_dev * params['bb_std']},
+            'rsi_data': rsi[params['rsi_period']]
+        }
+        signals = app.get_combined_signals_series(indicators, closes, params['rsi_upper'], params['rsi_lower'])
+        results.append(simulate(closes, signals, fee, horizon))
+    return results
+
+def summarize(params, metrics):
+    def ratio(hits, signals):
+        return float(hits.sum() / signals.sum()) if signals.sum() else None
+    return dict(
+        params,
+        symbols=len(metrics['total_return']),
+        mean_return=float(metrics['total_return'].mean()),
+        median_return=float(np.median(metrics['total_return'])),
+        profitable_share=float((metrics['total_return'] > 0).mean()),
+        mean_excess_vs_hold=float((metrics['total_return'] - metrics['buy_and_hold']).mean()),
+        mean_max_drawdown=float(metrics['max_drawdown'].mean()),
+        mean_trades=float(metrics['trades'].mean()),
+        buy_hit_rate=ratio(metrics['buy_hits'], metrics['buy_signals']),
+        sell_hit_rate=ratio(metrics['sell_hits'], metrics['sell_signals'])
+    )
+
+def run_backtest(chunks, parameter_grid, fee, horizon, workers):
+    collected = [{field: [] for field in METRIC_FIELDS} for _ in parameter_grid]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(backtest_chunk, closes, parameter_grid, fee, horizon) for _, closes in chunks]
+        for future in concurrent.futures.as_completed(futures):
+            for i, metrics in enumerate(future.result()):
+                for field in METRIC_FIELDS:
+                    collected[i][field].append(metrics[field])
+    return [summarize(params, {field: np.concatenate(values) for field, values in collected[i].items()}) for i, params in enumerate(parameter_grid)]
+
+
+# --- REJILLA DE PARÁMETROS ---
+def parse_list(value, cast=int):
+    return [cast(item) for item in value.split(',') if item]
+
+# Entero >= 1 para argparse (con horizon=0 no hay ninguna vela posterior con la que medir el acierto)
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be >= 1, got {value}")
+    return number
+
+def build_parameter_grid(args):
+    grid = []
+    rsi_bands = [tuple(float(limit) for limit in band.split(':')) for band in args.rsi_bands.split(',')]
+    for sma_short, sma_long, rsi_period, (rsi_upper, rsi_lower), bb_period, bb_std in itertools.product(
+            parse_list(args.sma_short), parse_list(args.sma_long), parse_list(args.rsi_period), rsi_bands,
+            parse_list(args.bb_period), parse_list(args.bb_std, float)):
+        if sma_short < sma_long:
+            grid.append(dict(zip(PARAMETER_FIELDS, (sma_short, sma_long, rsi_period, rsi_upper, rsi_lower, bb_period, bb_std))))
+    return grid
+
+def select_symbols(args):
+    if args.symbol_list:
+        return args.symbol_list.split(',')
+    symbols = app.worker.run(app.symbol_universe.get())
+    volumes = app.worker.run(app.get_kucoin_volumes())
+    if volumes:
+        symbols = sorted(symbols, key=lambda symbol: volumes.get(symbol, 0.0), reverse=True)
+    return symbols[:args.symbols]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backtest vectorizado de la estrategia combinada SMA/RSI/Bollinger.')
+    parser.add_argument('--days', type=float, default=90)
+    parser.add_argument('--interval', default=app.KUCOIN_INTERVAL, choices=sorted(app.KUCOIN_INTERVAL_SECONDS))
+    parser.add_argument('--symbols', type=int, default=1000, help='Los N símbolos con más volumen')
+    parser.add_argument('--symbol-list', default=None, help='Lista explícita, separada por comas')
+    parser.add_argument('--sma-short', default='20')
+    parser.add_argument('--sma-long', default='50')
+    parser.add_argument('--rsi-period', default='14')
+    parser.add_argument('--rsi-bands', default='70:30', help='Pares sobrecompra:sobreventa separados por comas')
+    parser.add_argument('--bb-period', default='20')
+    parser.add_argument('--bb-std', default='2')
+    parser.add_argument('--fee', type=float, default=0.001, help='Comisión por operación (0.1%% en KuCoin spot)')
+    parser.add_argument('--horizon', type=positive_int, default=24, help='Velas para medir el acierto de cada señal')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--json', default=None, help='Guarda todos los resultados en este fichero')
+    args = parser.parse_args()
+
+    parameter_grid = build_parameter_grid(args)
+    started_at = time.perf_counter()
+    symbols = select_symbols(args)
+    history = get_history(symbols, args.interval, args.days, BACKTEST_CANDLES_FILE.format(interval=args.interval))
+    app.worker.stop() # Lo que queda es solo cálculo: sin hilos vivos al crear el pool
+    chunks = build_chunks(history)
+    loaded_at = time.perf_counter()
+    candles = sum(closes.size for _, closes in chunks)
+    print(f"Histórico: {sum(len(chunk) for chunk, _ in chunks)} símbolos, {candles} velas de {args.interval} en {loaded_at - started_at:.1f}s")
+
+    results = run_backtest(chunks, parameter_grid, args.fee, args.horizon, args.workers)
+    elapsed = time.perf_counter() - loaded_at
+    print(f"{len(parameter_grid)} combinaciones x {candles} velas en {elapsed:.1f}s con {args.workers} procesos")
+
+    results.sort(key=lambda result: result['mean_return'], reverse=True)
+    print(f"{'sma':>8}{'rsi':>14}{'bb':>9}{'ret. medio':>12}{'vs hold':>10}{'% ganan':>9}{'drawdown':>10}{'ops':>7}{'acierto c/v':>14}")
+    for result in results[:args.top]:
+        hits = '/'.join('-' if rate is None else f"{rate:.0%}" for rate in (result['buy_hit_rate'], result['sell_hit_rate']))
+        print(f"{result['sma_short']:>3}/{result['sma_long']:<4}"
+              f"{result['rsi_period']:>4} {result['rsi_upper']:.0f}:{result['rsi_lower']:<3.0f}"
+              f"{result['bb_period']:>5}x{result['bb_std']:<3g}"
+              f"{result['mean_return']:>12.2%}{result['mean_excess_vs_hold']:>10.2%}{result['profitable_share']:>9.0%}"
+              f"{result['mean_max_drawdown']:>10.2%}{result['mean_trades']:>7.1f}{hits:>14}")
+
+    if args.json:
+        with open(args.json, mode='w', encoding='utf-8') as file:
+            json.dump({'interval': args.interval, 'days': args.days, 'fee': args.fee, 'horizon': args.horizon, 'results': results}, file, indent=2)
+        print(f"Resultados guardados en {args.json}")
+
+
+if __name__ == '__main__':
+    main()
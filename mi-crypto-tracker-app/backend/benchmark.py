@@ -0,0 +1,468 @@
+# Benchmark de los indicadores del barrido.
+# Compara, para un universo sintético de símbolos, el tiempo de cálculo de:
+#   - python:    calculate_sma / calculate_bollinger_bands / calculate_rsi + get_combined_signals símbolo a símbolo
+#   - streaming: IndicatorEngine actualizando solo la vela abierta (caso típico entre barridos)
+#   - numpy:     calculate_indicators_batch + get_combined_signals_batch sobre toda la matriz
+# y comprueba que las señales de 'numpy' coinciden con las de 'python'.
+#
+# Con --suite mide el pipeline completo contra un servidor KuCoin falso local (símbolos, velas y
+# tickers sintéticos, con latencia y tasa de 429 configurables), para cada tamaño de universo:
+#   - barrido en frío y en caliente (scheduled_analysis_job), desglosado en descarga (I/O), parseo JSON,
+#     indicadores, serialización y escritura del historial, más el snapshot
+#   - los tres motores de indicadores de arriba
+#   - los endpoints HTTP (p50/p99 y peticiones por segundo)
+#   - memoria máxima del proceso
+# Cada tamaño corre en un proceso aparte (memoria limpia, ficheros de datos en un directorio temporal)
+# y el resultado sale en JSON para comparar ejecuciones (--compare).
+#
+# Uso: python benchmark.py [--symbols 1000] [--candles 200] [--repeat 3]
+#      python benchmark.py --suite [--sizes 10,100,1000,5000] [--latency 0.05] [--error-rate 0.01]
+#                          [--requests 200] [--json resultados.json] [--compare anterior.json]
+import argparse
+import contextlib
+import http.server
+import inspect
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from urllib.parse import parse_qs, urlparse
+
+os.environ.setdefault('RUN_BACKGROUND_JOBS', '0')
+
+import httpx
+import numpy as np
+
+import app
+
+BENCHMARK_SIZES = '10,100,1000,5000'
+BENCHMARK_RATE_LIMIT = 100000 # El benchmark mide el pipeline, no el limitador de KuCoin (se puede fijar con --rate-limit)
+# Métricas que se comparan con --compare (menos es mejor) y variación a partir de la que se marcan
+COMPARE_METRICS = ('sweep_cold.wall_s', 'sweep_warm.wall_s', 'snapshot_s', 'indicators.numpy_ms', 'peak_rss_mb')
+COMPARE_THRESHOLD = 0.10
+
+
+def make_closes(n_symbols, n_candles, seed=42):
+    rng = np.random.default_rng(seed)
+    returns = rng.normal(0, 0.02, size=(n_symbols, n_candles))
+    start_prices = rng.uniform(0.01, 50000, size=(n_symbols, 1))
+    return start_prices * np.cumprod(1 + returns, axis=1)
+
+
+def run_python(closes):
+    signals = []
+    for row in closes.tolist():
+        sma_short = app.calculate_sma(row, 20)
+        sma_long = app.calculate_sma(row, 50)
+        bollinger_bands = app.calculate_bollinger_bands(row, 20, 2)
+        rsi = app.calculate_rsi(row, 14)
+        signals.append(app.get_combined_signals(sma_short, sma_long, rsi, bollinger_bands, row))
+    return signals
+
+
+def run_numpy(closes):
+    indicators = app.calculate_indicators_batch(closes)
+    return indicators, app.get_combined_signals_batch(indicators, closes)
+
+
+def prepare_streaming(closes):
+    engines = []
+    windows = []
+    for row in closes.tolist():
+        klines = app.KlineColumns(array('q', range(0, len(row) * 3600000, 3600000)), array('d', row))
+        engine = app.IndicatorEngine(maxlen=len(row))
+        engine.update(klines.timestamps, klines.closes)
+        engines.append(engine)
+        windows.append(klines)
+    return engines, windows
+
+
+def run_streaming(engines, windows):
+    for engine, klines in zip(engines, windows):
+        klines.closes[-1] *= 1.001
+        engine.update(klines.timestamps, klines.closes)
+
+
+def best_of(repeat, func, *args):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started_at
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def check_parity(closes, python_signals, numpy_result):
+    indicators, numpy_signals = numpy_result
+    mismatches = sum(
+        1 for i, signals in enumerate(python_signals)
+        if any(signals[key] != numpy_signals[key][i] for key in ('sma', 'rsi', 'bb', 'overall'))
+    )
+    max_diff = 0.0
+    for i, row in enumerate(closes.tolist()):
+        reference = {
+            'sma_short': app.calculate_sma(row, 20)[-1]['y'],
+            'sma_long': app.calculate_sma(row, 50)[-1]['y'],
+            'bb_upper': app.calculate_bollinger_bands(row, 20, 2)['upper'][-1]['y'],
+            'rsi_data': app.calculate_rsi(row, 14)[-1]['y'],
+        }
+        vectorized = {
+            'sma_short': indicators['sma_short'][i, -1],
+            'sma_long': indicators['sma_long'][i, -1],
+            'bb_upper': indicators['bb_bands']['upper'][i, -1],
+            'rsi_data': indicators['rsi_data'][i, -1],
+        }
+        for key, value in reference.items():
+            max_diff = max(max_diff, abs(value - vectorized[key]) / max(1.0, abs(value)))
+    return mismatches, max_diff
+
+
+# --- SERVIDOR KUCOIN FALSO ---
+# Sirve /api/v1/symbols, /api/v1/market/candles (type, startAt, endAt) y /api/v1/market/allTickers con
+# datos sintéticos deterministas: el precio de cada símbolo es una función del timestamp, así que las
+# velas de un mismo instante no cambian entre peticiones salvo la que sigue abierta.
+class FakeKucoinHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        time.sleep(server.latency)
+        if url.path == '/api/v1/symbols':
+            self.send_json({'code': '200000', 'data': [
+                {'symbol': symbol, 'baseCurrency': symbol.split('-')[0], 'quoteCurrency': 'USDT', 'enableTrading': True}
+                for symbol in server.symbols]})
+        elif url.path == '/api/v1/market/candles':
+            with server.stats_lock:
+                server.stats['candles'] += 1
+                throttled = server.random.random() < server.error_rate
+                if throttled:
+                    server.stats['429'] += 1
+            if throttled:
+                self.send_response(429)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_json({'code': '200000', 'data': fake_candles(query['symbol'][0], query['type'][0], query.get('startAt', [None])[0], query.get('endAt', [None])[0])})
+        elif url.path == '/api/v1/market/allTickers':
+            self.send_json({'code': '200000', 'data': {'time': int(time.time() * 1000), 'ticker': [
+                {'symbol': symbol, 'volValue': str(1e7 / (i + 1))} for i, symbol in enumerate(server.symbols)]}})
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+# Velas en el formato de KuCoin (más recientes primero; [time, open, close, high, low, volume, turnover])
+def fake_candles(symbol, interval, start_at=None, end_at=None):
+    interval_seconds = app.KUCOIN_INTERVAL_SECONDS[interval]
+    now = int(time.time())
+    end = min(int(end_at) if end_at else now, now) // interval_seconds * interval_seconds
+    start = int(start_at) // interval_seconds * interval_seconds if start_at else end - (app.KUCOIN_LIMIT - 1) * interval_seconds
+    start = max(start, end - (app.KUCOIN_MAX_CANDLES_PER_REQUEST - 1) * interval_seconds)
+    if start > end:
+        return []
+    timestamps = np.arange(start, end + interval_seconds, interval_seconds)
+    phase = (zlib.crc32(symbol.encode('utf-8')) % 1000) / 1000 * 2 * math.pi
+    def price(ts):
+        noise = np.sin(ts * 12.9898 + phase) * 43758.5453 % 1 - 0.5
+        return 100 * np.exp(0.2 * np.sin(ts / 604800 * 2 * math.pi + phase) + 0.02 * noise)
+    closes = price(timestamps)
+    closes[-1] *= 1 + 0.001 * math.sin(time.time()) # La vela abierta se mueve
+    opens = price(timestamps - interval_seconds)
+    rows = [[str(ts), f"{o:.8f}", f"{c:.8f}", f"{max(o, c) * 1.002:.8f}", f"{min(o, c) * 0.998:.8f}", '1000', '100000']
+            for ts, o, c in zip(timestamps.tolist(), opens.tolist(), closes.tolist())]
+    return rows[::-1]
+
+def start_fake_kucoin(n_symbols, latency, error_rate):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeKucoinHandler)
+    server.daemon_threads = True
+    server.symbols = [f"S{i:05d}-USDT" for i in range(n_symbols)]
+    server.latency = latency
+    server.error_rate = error_rate
+    server.random = random.Random(42)
+    server.stats = {'candles': 0, '429': 0}
+    server.stats_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- MEDICIÓN POR ETAPAS ---
+# Envuelve funciones del app para acumular el tiempo que pasa en cada una. La descarga es concurrente,
+# así que su tiempo acumulado puede superar al del barrido; sus latencias dan el p50/p99 de KuCoin.
+class StageTimer:
+    def __init__(self):
+        self.totals = {}
+        self.samples = {}
+
+    def add(self, stage, elapsed):
+        self.totals[stage] = self.totals.get(stage, 0.0) + elapsed
+        self.samples.setdefault(stage, []).append(elapsed)
+
+    def wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+        if inspect.iscoroutinefunction(original):
+            async def wrapper(*args, **kwargs):
+                started_at = time.perf_counter()
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - started_at)
+        else:
+            def wrapper(*args, **kwargs):
+                started_at = time.perf_counter()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - started_at)
+        setattr(owner, name, wrapper)
+
+    def reset(self):
+        self.totals = {}
+        self.samples = {}
+
+def percentiles(samples):
+    if not samples:
+        return {'p50_ms': None, 'p99_ms': None}
+    ordered = sorted(samples)
+    return {
+        'p50_ms': round(ordered[len(ordered) // 2] * 1000, 3),
+        'p99_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 3)
+    }
+
+def install_stage_timer():
+    timer = StageTimer()
+    timer.wrap(app, 'get_kucoin_candles', 'upstream')
+    timer.wrap(httpx.Response, 'json', 'json_parse')
+    timer.wrap(app, 'calculate_indicators_batch', 'indicators')
+    timer.wrap(app, 'get_combined_signals_batch', 'indicators')
+    timer.wrap(app.IndicatorEngine, 'update', 'indicators')
+    timer.wrap(app, 'serialize_analysis', 'serialization')
+    timer.wrap(app.history_writer, 'flush', 'history_io')
+    timer.wrap(app, 'flush_last_recommendations', 'history_io')
+    return timer
+
+def measure_sweep(timer, symbols):
+    timer.reset()
+    started_at = time.perf_counter()
+    app.worker.run(app.scheduled_analysis_job(symbols), timeout=None)
+    wall = time.perf_counter() - started_at
+    result = {
+        'wall_s': round(wall, 3),
+        'symbols_per_s': round(len(symbols) / wall, 1),
+        'requests': len(timer.samples.get('upstream', [])),
+        'stages_s': {stage: round(total, 3) for stage, total in sorted(timer.totals.items())},
+        'upstream_latency': percentiles(timer.samples.get('upstream', []))
+    }
+    result['analyzed'] = len(app.current_analysis_cache)
+    return result
+
+def measure_endpoints(client, symbols, n_requests):
+    rng = random.Random(7)
+    endpoints = {
+        'latest_analysis_chart_gzip': lambda: client.get(f"/get_latest_analysis/{rng.choice(symbols)}", headers={'Accept-Encoding': 'gzip'}),
+        'latest_analysis_chart': lambda: client.get(f"/get_latest_analysis/{rng.choice(symbols)}"),
+        'latest_analysis_columnar': lambda: client.get(f"/get_latest_analysis/{rng.choice(symbols)}?format=columnar"),
+        'latest_analysis_4hour': lambda: client.get(f"/get_latest_analysis/{rng.choice(symbols)}?timeframe=4hour"),
+        'current_opportunities': lambda: client.get('/get_current_opportunities'),
+        'ranked_opportunities': lambda: client.get('/get_current_opportunities?sort=rsi&limit=20'),
+        'recommendations': lambda: client.get('/get_recommendations?limit=20'),
+    }
+    results = {}
+    for name, call in endpoints.items():
+        latencies = []
+        errors = 0
+        started_at = time.perf_counter()
+        for _ in range(n_requests):
+            request_started_at = time.perf_counter()
+            response = call()
+            latencies.append(time.perf_counter() - request_started_at)
+            errors += response.status_code >= 400
+        elapsed = time.perf_counter() - started_at
+        results[name] = dict(percentiles(latencies), requests_per_s=round(n_requests / elapsed, 1), errors=errors)
+    return results
+
+def peak_rss_mb():
+    # ru_maxrss va en KB en Linux y en bytes en macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+
+# Un tamaño de universo, en el proceso hijo (cwd temporal, KUCOIN_API_BASE apuntando al servidor falso)
+def run_size(n_symbols, n_requests, repeat):
+    result = {'symbols': n_symbols}
+    with open(os.devnull, mode='w') as devnull, contextlib.redirect_stdout(devnull):
+        timer = install_stage_timer()
+        app.leader_lock.is_leader = True
+        symbols = app.worker.run(app.get_all_kucoin_symbols(), timeout=None)[:n_symbols]
+        result['sweep_cold'] = measure_sweep(timer, symbols)
+        result['sweep_warm'] = measure_sweep(timer, symbols)
+
+        started_at = time.perf_counter()
+        app.save_analysis_snapshot(dict(app.current_analysis_cache), dict(app.analysis_response_cache), app.snapshot_kline_stores())
+        result['snapshot_s'] = round(time.perf_counter() - started_at, 3)
+        result['snapshot_mb'] = round(os.path.getsize(app.ANALYSIS_SNAPSHOT_FILE) / (1024 * 1024), 2)
+
+        closes = make_closes(n_symbols, app.KUCOIN_LIMIT)
+        python_time, _ = best_of(1 if n_symbols > 1000 else repeat, run_python, closes)
+        numpy_time, _ = best_of(repeat, run_numpy, closes)
+        engines, windows = prepare_streaming(closes)
+        streaming_time, _ = best_of(repeat, run_streaming, engines, windows)
+        result['indicators'] = {'python_ms': round(python_time * 1000, 2), 'streaming_ms': round(streaming_time * 1000, 2), 'numpy_ms': round(numpy_time * 1000, 2)}
+
+        result['endpoints'] = measure_endpoints(app.app.test_client(), symbols, n_requests)
+    result['peak_rss_mb'] = peak_rss_mb()
+    app.worker.stop()
+    return result
+
+def run_suite(args):
+    sizes = [int(size) for size in args.sizes.split(',')]
+    server = start_fake_kucoin(max(sizes), args.latency, args.error_rate)
+    kucoin_url = f"http://127.0.0.1:{server.server_address[1]}"
+    env = dict(os.environ, KUCOIN_API_BASE=kucoin_url, RUN_BACKGROUND_JOBS='0',
+               KUCOIN_RATE_LIMIT=str(args.rate_limit), KUCOIN_RATE_BURST=str(max(1, int(args.rate_limit))))
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'analysis_backend': app.ANALYSIS_BACKEND,
+        'latency_s': args.latency,
+        'error_rate': args.error_rate,
+        'rate_limit': args.rate_limit,
+        'results': []
+    }
+    for n_symbols in sizes:
+        with tempfile.TemporaryDirectory(prefix='crypto-tracker-bench-') as workdir:
+            result_file = os.path.join(workdir, 'result.json')
+            command = [sys.executable, os.path.abspath(__file__), '--run-size', str(n_symbols), '--result-file', result_file,
+                       '--requests', str(args.requests), '--repeat', str(args.repeat)]
+            started_at = time.perf_counter()
+            completed = subprocess.run(command, cwd=workdir, env=env, stdout=None if args.verbose else subprocess.DEVNULL)
+            if completed.returncode != 0 or not os.path.exists(result_file):
+                print(f"{n_symbols:>6} símbolos: falló (código {completed.returncode})")
+                continue
+            with open(result_file, encoding='utf-8') as file:
+                result = json.load(file)
+        report['results'].append(result)
+        print_size_result(result, time.perf_counter() - started_at)
+    report['upstream'] = dict(server.stats)
+    server.shutdown()
+    return report
+
+def print_size_result(result, elapsed):
+    cold, warm = result['sweep_cold'], result['sweep_warm']
+    print(f"\n=== {result['symbols']} símbolos ({elapsed:.1f}s) ===")
+    for name, sweep in (('frío', cold), ('caliente', warm)):
+        stages = ', '.join(f"{stage} {seconds:.2f}s" for stage, seconds in sweep['stages_s'].items())
+        latency = sweep['upstream_latency']
+        print(f"barrido {name:<9}{sweep['wall_s']:>8.2f}s {sweep['symbols_per_s']:>9.1f} símb/s  {sweep['requests']} peticiones"
+              f" (p50 {latency['p50_ms']} ms, p99 {latency['p99_ms']} ms)  [{stages}]")
+    print(f"snapshot          {result['snapshot_s']:>8.2f}s  {result['snapshot_mb']} MB")
+    indicators = result['indicators']
+    print(f"indicadores       python {indicators['python_ms']:.1f} ms, streaming {indicators['streaming_ms']:.1f} ms, numpy {indicators['numpy_ms']:.1f} ms")
+    print(f"{'endpoint':<30}{'p50 ms':>10}{'p99 ms':>10}{'req/s':>10}{'errores':>9}")
+    for name, stats in result['endpoints'].items():
+        print(f"{name:<30}{stats['p50_ms']:>10.3f}{stats['p99_ms']:>10.3f}{stats['requests_per_s']:>10.1f}{stats['errors']:>9}")
+    print(f"memoria máxima    {result['peak_rss_mb']} MB")
+
+def metric_value(result, path):
+    value = result
+    for key in path.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+# Compara con un JSON anterior del mismo formato; devuelve cuántas métricas empeoraron más de COMPARE_THRESHOLD
+def compare_reports(report, baseline):
+    previous = {result['symbols']: result for result in baseline['results']}
+    regressions = 0
+    print(f"\nComparación con {baseline['created_at']} (umbral {COMPARE_THRESHOLD:.0%}):")
+    for result in report['results']:
+        before = previous.get(result['symbols'])
+        if before is None:
+            continue
+        for path in COMPARE_METRICS:
+            old, new = metric_value(before, path), metric_value(result, path)
+            if not old or new is None:
+                continue
+            change = new / old - 1
+            flag = '  <-- peor' if change > COMPARE_THRESHOLD else ''
+            regressions += change > COMPARE_THRESHOLD
+            print(f"{result['symbols']:>6} {path:<22}{old:>10.3f} -> {new:<10.3f}{change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de los indicadores (python vs streaming vs numpy) y, con --suite, del pipeline completo.')
+    parser.add_argument('--symbols', type=int, default=1000)
+    parser.add_argument('--candles', type=int, default=app.KUCOIN_LIMIT)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--suite', action='store_true', help='Barrido, indicadores y endpoints contra un KuCoin falso')
+    parser.add_argument('--sizes', default=BENCHMARK_SIZES)
+    parser.add_argument('--latency', type=float, default=0.05, help='Latencia del KuCoin falso en segundos')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fracción de peticiones de velas que responden 429')
+    parser.add_argument('--rate-limit', type=float, default=BENCHMARK_RATE_LIMIT, help='KUCOIN_RATE_LIMIT del app durante la suite')
+    parser.add_argument('--requests', type=int, default=200, help='Peticiones por endpoint')
+    parser.add_argument('--json', default=None, help='Guarda el informe de la suite en este fichero')
+    parser.add_argument('--compare', default=None, help='Informe anterior con el que comparar')
+    parser.add_argument('--verbose', action='store_true', help='Muestra el log del app durante la suite')
+    parser.add_argument('--run-size', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_size is not None:
+        result = run_size(args.run_size, args.requests, args.repeat)
+        with open(args.result_file, mode='w', encoding='utf-8') as file:
+            json.dump(result, file)
+        os._exit(0) # Sin esperar a los hilos del cliente HTTP y del servidor de fondo
+    if args.suite:
+        report = run_suite(args)
+        if args.json:
+            with open(args.json, mode='w', encoding='utf-8') as file:
+                json.dump(report, file, indent=2)
+            print(f"\nInforme guardado en {args.json}")
+        if args.compare:
+            with open(args.compare, encoding='utf-8') as file:
+                regressions = compare_reports(report, json.load(file))
+            sys.exit(1 if regressions else 0)
+        return
+
+    closes = make_closes(args.symbols, args.candles)
+    print(f"Universo sintético: {args.symbols} símbolos x {args.candles} velas (mejor de {args.repeat})")
+
+    python_time, python_signals = best_of(args.repeat, run_python, closes)
+    numpy_time, numpy_result = best_of(args.repeat, run_numpy, closes)
+    engines, windows = prepare_streaming(closes)
+    streaming_time, _ = best_of(args.repeat, run_streaming, engines, windows)
+
+    print(f"{'backend':<12}{'total ms':>12}{'us/símbolo':>14}{'speedup':>10}")
+    for name, elapsed in (('python', python_time), ('streaming', streaming_time), ('numpy', numpy_time)):
+        print(f"{name:<12}{elapsed * 1000:>12.1f}{elapsed / args.symbols * 1e6:>14.1f}{python_time / elapsed:>9.1f}x")
+
+    mismatches, max_diff = check_parity(closes, python_signals, numpy_result)
+    print(f"Paridad numpy vs python: {mismatches} señales distintas, diferencia relativa máx. {max_diff:.2e}")
+
+
+if __name__ == '__main__':
+    main()
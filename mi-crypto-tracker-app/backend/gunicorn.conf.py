@@ -0,0 +1,20 @@
+# Configuración de Gunicorn (se carga sola al arrancar `gunicorn app:app` desde backend/).
+# /stream (SSE) deja abierta una conexión por pestaña: con los workers síncronos por defecto cada una
+# bloquea un worker entero y el timeout de 30 s la corta. Con gthread cada conexión ocupa un hilo y
+# el latido del worker no depende de las peticiones en curso.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 64))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 0)) # 0: sin límite para los streams largos
+graceful_timeout = 10
+keepalive = 5
+
+# Los streams no pueden quedarse con todos los hilos: se reserva una parte para el resto de peticiones.
+# Por encima del límite /stream responde 503 y el navegador vuelve al polling.
+STREAM_RESERVED_THREADS = 16
+os.environ.setdefault('STREAM_MAX_CLIENTS', str(max(1, threads - STREAM_RESERVED_THREADS)))
+
+# No usar preload_app: el loop de fondo y el lock del líder se crean al importar la app en cada worker.
@@ -0,0 +1,62 @@
+# Los tests importan app.py como lo haría Gunicorn, pero sin tareas de fondo, sin el limitador de
+# KuCoin de producción y con los ficheros de datos (data.csv, history.db, snapshot...) en un
+# directorio temporal, para no tocar los del backend.
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ['RUN_BACKGROUND_JOBS'] = '0'
+os.environ.setdefault('KUCOIN_RATE_LIMIT', '1000')
+os.environ.setdefault('KUCOIN_RATE_BURST', '1000')
+os.chdir(tempfile.mkdtemp(prefix='crypto-tracker-tests-'))
+sys.path.insert(0, BACKEND_DIR)
+
+import app  # noqa: E402 (después de fijar el entorno)
+import benchmark  # noqa: E402
+
+
+# Servidor falso de KuCoin (benchmark.py) en un puerto libre, con KUCOIN_API_BASE apuntando a él
+@pytest.fixture
+def kucoin(monkeypatch):
+    server = benchmark.start_fake_kucoin(5, latency=0.0, error_rate=0.0)
+    monkeypatch.setattr(app, 'KUCOIN_API_BASE', f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(app, 'KUCOIN_BACKOFF_BASE', 0.0)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+# history.db nuevo en un fichero temporal. Las conexiones son por hilo (también las de asyncio.to_thread),
+# así que se cambia el threading.local entero para que ningún hilo siga con la base de datos anterior.
+@pytest.fixture
+def history_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'HISTORY_DB_FILE', str(tmp_path / 'history.db'))
+    monkeypatch.setattr(app, 'history_db_local', threading.local())
+    app.init_history_db()
+    yield app.get_history_db()
+    app.get_history_db().close()
+
+
+# Sustituye save_analysis_snapshot para apuntar cada publicación (hilo y símbolos) y escribir en tmp_path.
+# Deja la cache y las respuestas vacías y el snapshot sin cambios pendientes.
+@pytest.fixture
+def saves(tmp_path, monkeypatch):
+    calls = []
+    original = app.save_analysis_snapshot
+
+    def save(analysis_by_symbol, responses_by_symbol, candles_by_symbol=None):
+        calls.append({'thread': threading.current_thread(), 'symbols': sorted(analysis_by_symbol)})
+        return original(analysis_by_symbol, responses_by_symbol, candles_by_symbol, path=str(tmp_path / 'snapshot.bin'))
+
+    monkeypatch.setattr(app, 'save_analysis_snapshot', save)
+    monkeypatch.setattr(app, 'current_analysis_cache', {})
+    monkeypatch.setattr(app, 'analysis_response_cache', {})
+    monkeypatch.setattr(app, 'analysis_snapshot_dirty', False)
+    monkeypatch.setattr(app, 'analysis_snapshot_published_at', 0.0)
+    monkeypatch.setattr(app, 'forced_analyses_unpublished', {})
+    return calls
@@ -0,0 +1,111 @@
+# Cola de análisis forzados en history.db: queued -> running -> done/error y recuperación tras un líder caído.
+import app
+
+SYMBOL = 'S00001-USDT'
+
+
+def status(symbol=SYMBOL):
+    return app.get_forced_analysis(symbol)['status']
+
+
+def test_enqueue_is_idempotent_while_pending(history_db):
+    first = app.enqueue_forced_analysis(SYMBOL)
+    assert first['status'] == 'queued'
+    assert app.enqueue_forced_analysis(SYMBOL)['requested_at'] == first['requested_at']
+    assert app.claim_forced_analysis(SYMBOL)
+    assert app.enqueue_forced_analysis(SYMBOL)['status'] == 'running'
+    assert app.read_queued_forced_analyses() == []
+
+
+def test_claim_only_once(history_db):
+    app.enqueue_forced_analysis(SYMBOL)
+    assert app.claim_forced_analysis(SYMBOL)
+    assert not app.claim_forced_analysis(SYMBOL)
+    assert not app.claim_forced_analysis('OTHER-USDT')
+
+
+def test_finished_job_can_be_queued_again(history_db):
+    app.enqueue_forced_analysis(SYMBOL)
+    app.claim_forced_analysis(SYMBOL)
+    app.finish_forced_analysis(SYMBOL, 'error', 'boom')
+    job = app.get_forced_analysis(SYMBOL)
+    assert (job['status'], job['error']) == ('error', 'boom') and job['finished_at']
+    job = app.enqueue_forced_analysis(SYMBOL)
+    assert (job['status'], job['error'], job['started_at'], job['finished_at']) == ('queued', None, None, None)
+
+
+def test_interrupted_jobs_are_requeued(history_db):
+    for symbol in ('A-USDT', 'B-USDT', 'C-USDT'):
+        app.enqueue_forced_analysis(symbol)
+    app.claim_forced_analysis('A-USDT')
+    app.claim_forced_analysis('B-USDT')
+    app.finish_forced_analysis('B-USDT', 'done')
+    app.requeue_interrupted_forced_analyses()
+    assert [status(symbol) for symbol in ('A-USDT', 'B-USDT', 'C-USDT')] == ['queued', 'done', 'queued']
+    assert app.get_forced_analysis('A-USDT')['started_at'] is None
+    assert sorted(app.read_queued_forced_analyses()) == ['A-USDT', 'C-USDT']
+
+
+def test_run_is_done_once_published(history_db, kucoin, saves, monkeypatch):
+    monkeypatch.setattr(app, 'FORCED_ANALYSIS_PUBLISH_INTERVAL', 0)
+    app.enqueue_forced_analysis(SYMBOL)
+    app.worker.run(app.run_forced_analysis(SYMBOL))
+    assert SYMBOL in app.current_analysis_cache
+    assert status() == 'running' and saves == [] # Analizado, pero los seguidores aún no lo ven
+    app.worker.run(app.publish_forced_analyses())
+    assert status() == 'done'
+    assert len(saves) == 1 and saves[0]['symbols'] == [SYMBOL]
+    # Ya terminado: otra ejecución sin encolar no lo vuelve a reclamar
+    app.worker.run(app.run_forced_analysis(SYMBOL))
+    assert status() == 'done'
+
+
+def test_burst_is_published_once(history_db, kucoin, saves, monkeypatch):
+    monkeypatch.setattr(app, 'FORCED_ANALYSIS_PUBLISH_INTERVAL', 3600)
+    symbols = kucoin.symbols
+    for symbol in symbols:
+        app.enqueue_forced_analysis(symbol)
+        app.worker.run(app.run_forced_analysis(symbol))
+    app.worker.run(app.publish_forced_analyses()) # Nunca se ha publicado: sale ya
+    for symbol in symbols:
+        app.enqueue_forced_analysis(symbol)
+        app.worker.run(app.run_forced_analysis(symbol))
+    app.worker.run(app.publish_forced_analyses()) # Dentro del intervalo: espera
+    assert len(saves) == 1 and saves[0]['symbols'] == sorted(symbols)
+    assert {status(symbol) for symbol in symbols} == {'running'}
+    # El barrido publica por su cuenta: los pendientes pasan a 'done' sin otra escritura
+    app.worker.run(app.publish_analysis_snapshot())
+    app.worker.run(app.publish_forced_analyses())
+    assert len(saves) == 2
+    assert {status(symbol) for symbol in symbols} == {'done'}
+
+
+def test_run_without_analysis_is_an_error(history_db, saves, monkeypatch):
+    async def no_candles(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(app, 'get_kucoin_candles', no_candles)
+    app.enqueue_forced_analysis(SYMBOL)
+    app.worker.run(app.run_forced_analysis(SYMBOL))
+    assert status() == 'error'
+    assert app.forced_analyses_unpublished == {}
+
+
+def test_run_records_errors(history_db, monkeypatch):
+    async def failing_job(symbols, force=False):
+        raise RuntimeError('upstream down')
+
+    monkeypatch.setattr(app, 'scheduled_analysis_job', failing_job)
+    app.enqueue_forced_analysis(SYMBOL)
+    app.worker.run(app.run_forced_analysis(SYMBOL))
+    job = app.get_forced_analysis(SYMBOL)
+    assert (job['status'], job['error']) == ('error', 'upstream down')
+
+
+def test_post_route_rejects_unknown_symbols_and_needs_a_sweeper(history_db, monkeypatch):
+    monkeypatch.setattr(app.symbol_universe, 'symbol_set', frozenset({SYMBOL}))
+    client = app.app.test_client()
+    assert client.post('/force_analysis/NOPE-USDT').status_code == 404
+    # Los tests corren con RUN_BACKGROUND_JOBS=0 y sin líder: nadie recogería el trabajo
+    assert client.post(f'/force_analysis/{SYMBOL}').status_code == 503
+    assert app.get_forced_analysis(SYMBOL) is None
@@ -0,0 +1,127 @@
+# Historial en SQLite sobre una base de datos temporal: paginación de /get_recommendations y agregados
+# de recommendation_stats (trigger y recálculo) frente a un GROUP BY directo sobre recommendations.
+import csv
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import app
+
+SYMBOLS = ('AAA-USDT', 'BBB-USDT', 'CCC-USDT')
+RECS = ('buy', 'sell', 'hold')
+METRIC_TYPES = ('Acierto', 'Riesgo', 'N/A')
+
+
+def make_rows(count, seed, span=timedelta(hours=30)):
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    rows = []
+    for _ in range(count):
+        timestamp = now - span * rng.random()
+        rows.append([
+            timestamp.isoformat().replace('+00:00', 'Z'), rng.choice(SYMBOLS), rng.choice(RECS), rng.choice(RECS),
+            rng.choice(METRIC_TYPES), f'{rng.uniform(-5, 5):.2f}', 'test'
+        ])
+    return rows
+
+
+def window_ids(conn, symbol=None):
+    threshold_ts = app.datetime_to_micros(datetime.now(timezone.utc) - app.HISTORY_WINDOW)
+    query = 'SELECT timestamp, symbol FROM recommendations WHERE ts >= ?'
+    params = [threshold_ts]
+    if symbol is not None:
+        query += ' AND symbol = ?'
+        params.append(symbol)
+    return [tuple(row) for row in conn.execute(query + ' ORDER BY ts DESC, id DESC', params)]
+
+
+@pytest.mark.parametrize('symbol', [None, 'BBB-USDT'])
+def test_cursor_pages_cover_the_window_once(history_db, symbol):
+    app.insert_history_rows(make_rows(400, seed=1))
+    client = app.app.test_client()
+    expected = window_ids(history_db, symbol)
+
+    seen = []
+    cursor = None
+    page = 1
+    while True:
+        query = {'limit': 17, 'page': page}
+        if symbol:
+            query['symbol'] = symbol
+        if cursor:
+            query['cursor'] = cursor
+        data = client.get('/get_recommendations', query_string=query).get_json()
+        assert data['total_items'] == len(expected)
+        assert data['current_page'] == page
+        seen.extend((row['timestamp'], row['symbol']) for row in data['recommendations'])
+        cursor = data['next_cursor']
+        if cursor is None:
+            break
+        page += 1
+
+    assert seen == expected
+    assert page == data['total_pages']
+
+
+def test_legacy_page_offset_matches_cursor(history_db):
+    app.insert_history_rows(make_rows(100, seed=2))
+    client = app.app.test_client()
+    first = client.get('/get_recommendations', query_string={'limit': 10}).get_json()
+    by_cursor = client.get('/get_recommendations', query_string={'limit': 10, 'cursor': first['next_cursor'], 'page': 2}).get_json()
+    by_page = client.get('/get_recommendations', query_string={'limit': 10, 'page': 2}).get_json()
+    assert by_page['recommendations'] == by_cursor['recommendations']
+
+
+def test_invalid_cursor_is_rejected(history_db):
+    response = app.app.test_client().get('/get_recommendations', query_string={'cursor': 'nope'})
+    assert response.status_code == 400
+
+
+# Agregados esperados, calculados de nuevo con un GROUP BY sobre el historial (independiente de STATS_COUNTER_SQL)
+def grouped_stats(conn):
+    bucket = f"ts / {app.STATS_BUCKET_SECONDS * 1000000} * {app.STATS_BUCKET_SECONDS}"
+    sums = (
+        "COUNT(*), SUM(metric_type = 'Acierto'), SUM(metric_type = 'Riesgo'), ROUND(SUM(COALESCE(metric_value, 0)), 6), "
+        "SUM(recommendation IN ('buy', 'sell', 'hold') AND prev_recommendation IN ('buy', 'sell', 'hold') AND recommendation != prev_recommendation), "
+        "SUM(recommendation = 'buy'), SUM(recommendation = 'sell'), SUM(recommendation = 'hold')"
+    )
+    cutoff = app.get_stats_cutoff_bucket() * 1000000
+    rows = conn.execute(f"SELECT symbol, {bucket}, {sums} FROM recommendations WHERE ts >= ? GROUP BY symbol, {bucket}", (cutoff,)).fetchall()
+    rows += conn.execute(f"SELECT ?, {bucket}, {sums} FROM recommendations WHERE ts >= ? GROUP BY {bucket}", (app.STATS_ALL_SYMBOLS, cutoff)).fetchall()
+    return {(row[0], row[1]): tuple(row[2:]) for row in rows}
+
+
+def stored_stats(conn):
+    columns = ', '.join(f'ROUND({name}, 6)' if name == 'metric_sum' else name for name in ('total',) + app.STATS_COUNTERS)
+    return {(row[0], row[1]): tuple(row[2:]) for row in conn.execute(f'SELECT symbol, bucket, {columns} FROM recommendation_stats')}
+
+
+def test_stats_match_group_by_after_inserts_and_rebuild(history_db):
+    app.insert_history_rows(make_rows(300, seed=3))
+    app.insert_history_rows(make_rows(300, seed=3)) # Repetidas: INSERT OR IGNORE no las suma
+    app.insert_history_rows(make_rows(200, seed=4, span=timedelta(days=40))) # Parte fuera de la retención
+    expected = grouped_stats(history_db)
+    assert len(expected) > 30 # Varias horas, por símbolo y globales
+    assert stored_stats(history_db) == expected
+
+    history_db.execute('UPDATE recommendation_stats SET total = total + 5, hits = 0')
+    history_db.commit()
+    assert stored_stats(history_db) != expected
+    app.rebuild_recommendation_stats()
+    assert stored_stats(history_db) == expected
+
+
+def test_stats_match_group_by_after_csv_import(history_db, tmp_path):
+    path = tmp_path / 'data.csv'
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(app.HISTORY_COLUMNS)
+        writer.writerows(make_rows(500, seed=5, span=timedelta(days=35)))
+        writer.writerow(['not-a-date', 'AAA-USDT', 'buy', 'sell', 'N/A', 'x', 'broken'])
+    imported, skipped = app.import_history_csv(str(path))
+    assert (imported, skipped) == (history_db.execute('SELECT COUNT(*) FROM recommendations').fetchone()[0], 1)
+    expected = grouped_stats(history_db)
+    assert stored_stats(history_db) == expected
+    app.rebuild_recommendation_stats()
+    assert stored_stats(history_db) == expected
@@ -0,0 +1,134 @@
+# Paridad de los indicadores incrementales (IndicatorEngine) y vectorizados (numpy) con las funciones
+# de referencia calculate_sma / calculate_bollinger_bands / calculate_rsi, sobre una ventana que se
+# desplaza vela a vela y con revisiones de la vela abierta entre medias, como en el barrido.
+import math
+import random
+from array import array
+
+import numpy as np
+import pytest
+
+import app
+
+WINDOW = 120
+HOUR_MS = 3600 * 1000
+# SMA y Bollinger arrastran sumas móviles (se resincronizan cada INDICATOR_RESYNC_EVERY actualizaciones):
+# la diferencia con la suma directa de la ventana es error de redondeo de float
+SUM_TOLERANCE = 1e-9
+
+
+def random_walk(n, seed):
+    rng = random.Random(seed)
+    closes = [100.0]
+    for _ in range(n - 1):
+        closes.append(closes[-1] * (1 + rng.uniform(-0.03, 0.03)))
+    return closes
+
+
+def reference(closes):
+    as_float = lambda series: [math.nan if value is None else value['y'] for value in series]
+    bands = app.calculate_bollinger_bands(closes, 20, 2)
+    return {
+        'sma_short': as_float(app.calculate_sma(closes, 20)),
+        'sma_long': as_float(app.calculate_sma(closes, 50)),
+        'bb_middle': as_float(bands['middle']),
+        'bb_upper': as_float(bands['upper']),
+        'bb_lower': as_float(bands['lower']),
+        'rsi_data': as_float(app.calculate_rsi(closes, 14))
+    }
+
+
+def flatten(indicators):
+    return {
+        'sma_short': list(indicators['sma_short']),
+        'sma_long': list(indicators['sma_long']),
+        'bb_middle': list(indicators['bb_bands']['middle']),
+        'bb_upper': list(indicators['bb_bands']['upper']),
+        'bb_lower': list(indicators['bb_bands']['lower']),
+        'rsi_data': list(indicators['rsi_data'])
+    }
+
+
+def assert_series_equal(name, got, expected, tolerance):
+    assert len(got) == len(expected), name
+    for i, (a, b) in enumerate(zip(got, expected)):
+        if math.isnan(b):
+            assert math.isnan(a), (name, i, a)
+        else:
+            assert a == pytest.approx(b, rel=tolerance, abs=tolerance), (name, i, a, b)
+
+
+# Recorre la serie como el barrido: cada paso revisa la vela abierta una o dos veces y luego abre
+# una vela nueva; la ventana (como KlineStore) guarda las últimas WINDOW velas
+def sliding_updates(closes, seed):
+    rng = random.Random(seed)
+    timestamps = [i * HOUR_MS for i in range(len(closes))]
+    for end in range(1, len(closes) + 1):
+        start = max(0, end - WINDOW)
+        window_closes = list(closes[start:end])
+        for _ in range(rng.randint(1, 2)):
+            yield timestamps[start:end], window_closes
+            window_closes = window_closes[:-1] + [window_closes[-1] * (1 + rng.uniform(-0.01, 0.01))]
+        yield timestamps[start:end], window_closes
+
+
+@pytest.mark.parametrize('seed', [1, 2])
+def test_engine_matches_reference_on_sliding_window(seed):
+    engine = app.IndicatorEngine(maxlen=WINDOW)
+    closes = random_walk(3 * WINDOW, seed)
+    for step, (timestamps, window_closes) in enumerate(sliding_updates(closes, seed)):
+        got = flatten(engine.update(array('q', timestamps), array('d', window_closes)))
+        expected = reference(window_closes)
+        for name in expected:
+            # RSI se vuelve a sembrar al desplazarse la ventana: mismas operaciones, resultado idéntico
+            assert_series_equal(f"{name}@{step}", got[name], expected[name], 0.0 if name == 'rsi_data' else SUM_TOLERANCE)
+
+
+def test_engine_resyncs_sums_over_long_runs():
+    engine = app.IndicatorEngine(maxlen=WINDOW)
+    closes = random_walk(app.INDICATOR_RESYNC_EVERY + 2 * WINDOW, 3)
+    timestamps = [i * HOUR_MS for i in range(len(closes))]
+    for end in range(1, len(closes) + 1):
+        start = max(0, end - WINDOW)
+        got = engine.update(array('q', timestamps[start:end]), array('d', closes[start:end]))
+    expected = reference(closes[-WINDOW:])
+    for name, series in flatten(got).items():
+        assert_series_equal(name, series, expected[name], 0.0 if name == 'rsi_data' else SUM_TOLERANCE)
+
+
+def test_engine_resets_when_window_jumps():
+    engine = app.IndicatorEngine(maxlen=WINDOW)
+    closes = random_walk(3 * WINDOW, 4)
+    timestamps = [i * HOUR_MS for i in range(len(closes))]
+    engine.update(array('q', timestamps[:WINDOW]), array('d', closes[:WINDOW]))
+    got = engine.update(array('q', timestamps[-WINDOW:]), array('d', closes[-WINDOW:]))
+    expected = reference(closes[-WINDOW:])
+    for name, series in flatten(got).items():
+        assert_series_equal(name, series, expected[name], SUM_TOLERANCE)
+
+
+@pytest.mark.parametrize('length', [10, 30, 60, WINDOW])
+def test_batch_matches_reference(length):
+    closes = np.array([random_walk(length, seed) for seed in range(5)])
+    batch = app.calculate_indicators_batch(closes)
+    for row in range(len(closes)):
+        got = flatten({
+            'sma_short': batch['sma_short'][row],
+            'sma_long': batch['sma_long'][row],
+            'bb_bands': {band: batch['bb_bands'][band][row] for band in ('middle', 'upper', 'lower')},
+            'rsi_data': batch['rsi_data'][row]
+        })
+        expected = reference(closes[row].tolist())
+        for name in expected:
+            assert_series_equal(f"{name}[{row}]", got[name], expected[name], SUM_TOLERANCE)
+
+
+def test_chart_format_keeps_legacy_point_shape():
+    closes = random_walk(WINDOW, 5)
+    klines = app.KlineColumns(array('q', [i * HOUR_MS for i in range(WINDOW)]), array('d', closes))
+    indicators = app.calculate_indicators_for_symbol(klines.closes)
+    entry = app.build_analysis_entry(app.get_combined_signals_for_symbol(indicators, klines.closes), klines, indicators)
+    chart = app.analysis_to_chart(entry)
+    assert chart['klines'] == [{'x': x, 'y': close} for x, close in zip(klines.timestamps, closes)]
+    expected = app.calculate_sma(closes, 20)
+    assert [point if point is None else set(point) for point in chart['sma_short']] == [point if point is None else {'y'} for point in expected]
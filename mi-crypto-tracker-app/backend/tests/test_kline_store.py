@@ -0,0 +1,122 @@
+# Almacén de velas por columnas (KlineStore): fusión incremental, desplazamiento de la ventana y lecturas.
+import numpy as np
+import pytest
+
+import app
+
+HOUR_MS = 3600 * 1000
+
+
+def make_candles(start, count, step=HOUR_MS, base=100.0):
+    return [(start + i * step, base + i, base + i + 0.5, base + i + 1, base + i - 1, 10.0 + i) for i in range(count)]
+
+
+def as_tuples(columns):
+    return list(zip(columns.timestamps.tolist(), *(column.tolist() for column in columns[1:])))
+
+
+def test_merge_revises_open_candle_and_appends():
+    store = app.KlineStore('1hour', limit=10)
+    candles = make_candles(0, 5)
+    store.replace('A', app.candles_to_columns(candles))
+    revised_open = (candles[-1][0], 1.0, 2.0, 3.0, 0.5, 99.0)
+    new = [revised_open] + make_candles(5 * HOUR_MS, 2, base=200.0)
+    assert store.merge('A', app.candles_to_columns(candles[:2] + new)) == (1, 2)
+    assert as_tuples(store.get_columns('A')) == candles[:4] + new
+    assert store.get_fingerprint('A') == (7, 6 * HOUR_MS, 201.5, 11.0)
+
+
+def test_window_slides_once_full():
+    store = app.KlineStore('1hour', limit=8)
+    candles = make_candles(0, 30)
+    store.replace('A', app.candles_to_columns(candles[:6]))
+    for i in range(6, 30, 3):
+        store.merge('A', app.candles_to_columns(candles[i:i + 3]))
+        assert as_tuples(store.get_columns('A')) == candles[max(0, i + 3 - 8):i + 3]
+    store.replace('B', app.candles_to_columns(candles))
+    assert as_tuples(store.get_columns('B')) == candles[-8:]
+
+
+def test_reads_are_copies_with_typed_columns():
+    store = app.KlineStore('1hour', limit=8)
+    candles = make_candles(0, 8)
+    store.replace('A', app.candles_to_columns(candles))
+    klines = store.get_klines('A')
+    columns = store.get_columns('A')
+    store.merge('A', app.candles_to_columns(make_candles(8 * HOUR_MS, 4, base=500.0)))
+    assert klines.timestamps.typecode == 'q' and klines.closes.typecode == 'd'
+    assert list(klines.closes) == [candle[2] for candle in candles]
+    assert as_tuples(columns) == candles
+    assert columns.timestamps.dtype == np.int64
+
+
+def test_empty_symbol():
+    store = app.KlineStore('1hour', limit=8)
+    assert store.get_columns('A') is None
+    assert store.get_last_start('A') is None and store.get_start_at('A') is None
+    assert list(store.get_klines('A').closes) == []
+
+
+# Velas de 15min deterministas y, como referencia, las de 'interval' agregadas a mano bucket a bucket
+# (lo que devolvería KuCoin para esa temporalidad)
+BASE_MS = 15 * 60 * 1000
+
+
+def base_candles(count, start=1_700_000_000_000 // (86400 * 1000) * 86400 * 1000):
+    candles = []
+    for i in range(count):
+        open_price = 100 + (i * 37 % 23) - (i * 11 % 7)
+        close = open_price + (i * 13 % 5) - 2
+        candles.append((start + i * BASE_MS, float(open_price), float(close), float(max(open_price, close) + 1), float(min(open_price, close) - 1), float(i % 9 + 1)))
+    return candles
+
+
+def direct_candles(candles, interval):
+    interval_ms = app.KUCOIN_INTERVAL_SECONDS[interval] * 1000
+    buckets = {}
+    for candle in candles:
+        buckets.setdefault(candle[0] - candle[0] % interval_ms, []).append(candle)
+    return [
+        (start, group[0][1], group[-1][2], max(c[3] for c in group), min(c[4] for c in group), sum(c[5] for c in group))
+        for start, group in sorted(buckets.items())
+    ]
+
+
+@pytest.mark.parametrize('interval', ['1hour', '4hour', '1day'])
+def test_resample_matches_direct_candles(interval):
+    candles = base_candles(3 * 96 + 37) # Tres días y uno abierto a medias
+    resampled = app.resample_candles(app.candles_to_columns(candles), interval)
+    assert as_tuples(resampled) == direct_candles(candles, interval)
+    assert resampled.timestamps.dtype == np.int64
+
+
+def test_resample_into_store_rebuilds_the_open_candle():
+    candles = base_candles(2 * 96 + 10)
+    store = app.KlineStore('1hour', limit=50)
+    # El almacén tiene la vela abierta tal como estaba hace dos velas de 15min
+    stale = direct_candles(candles[:-2], '1hour')
+    store.replace('A', app.candles_to_columns(stale))
+    assert app.resample_into_store(store, 'A', app.candles_to_columns(candles[-40:]))
+    assert as_tuples(store.get_columns('A')) == direct_candles(candles, '1hour')[-50:]
+
+
+def test_resample_into_store_needs_base_coverage():
+    candles = base_candles(96)
+    store = app.KlineStore('1hour', limit=50)
+    assert not app.resample_into_store(store, 'A', app.candles_to_columns(candles)) # Almacén vacío
+    store.replace('A', app.candles_to_columns(direct_candles(candles, '1hour')))
+    assert not app.resample_into_store(store, 'A', app.candles_to_columns(candles[-2:])) # La base no llega al inicio de la vela abierta
+    assert not app.resample_into_store(store, 'A', None)
+
+
+def test_resample_into_store_falls_back_on_missing_base_candles():
+    candles = base_candles(2 * 96 + 10)
+    store = app.KlineStore('1hour', limit=50)
+    stale = direct_candles(candles[:-2], '1hour')
+    store.replace('A', app.candles_to_columns(stale))
+    open_start = stale[-1][0]
+    # Falta una vela de 15min dentro de la hora abierta, o justo la del inicio: la agregada saldría parcial
+    for missing in (open_start + BASE_MS, open_start):
+        gapped = [candle for candle in candles if candle[0] != missing]
+        assert not app.resample_into_store(store, 'A', app.candles_to_columns(gapped))
+        assert as_tuples(store.get_columns('A')) == stale[-50:]
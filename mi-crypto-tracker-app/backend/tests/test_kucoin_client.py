@@ -0,0 +1,55 @@
+# Cliente de KuCoin contra el servidor falso de benchmark.py (KUCOIN_API_BASE apuntando a 127.0.0.1)
+import time
+
+import pytest
+
+import app
+import benchmark
+
+
+# Sustituye al random del servidor falso: decide qué peticiones de velas reciben un 429
+class ScriptedRandom:
+    def __init__(self, values):
+        self.values = list(values)
+
+    def random(self):
+        return self.values.pop(0) if self.values else 1.0
+
+
+def test_symbols_are_filtered_and_sorted(kucoin):
+    symbols = app.worker.run(app.get_all_kucoin_symbols())
+    assert symbols == sorted(kucoin.symbols)
+
+
+def test_candles_window_is_ascending(kucoin):
+    interval_seconds = app.KUCOIN_INTERVAL_SECONDS['1hour']
+    start_at = app.get_window_start('1hour', 100)
+    candles = app.worker.run(app.get_kucoin_candles('S00001-USDT', '1hour', start_at=start_at))
+    assert len(candles) == 100
+    assert candles[0][0] == start_at * 1000
+    assert all(b[0] - a[0] == interval_seconds * 1000 for a, b in zip(candles, candles[1:]))
+    assert all(len(candle) == 6 and candle[4] <= candle[2] <= candle[3] for candle in candles)
+    assert candles[-1][0] <= time.time() * 1000
+
+
+def test_candles_end_at_limits_the_page(kucoin):
+    interval_seconds = app.KUCOIN_INTERVAL_SECONDS['1hour']
+    end_at = app.get_window_start('1hour', 10)
+    start_at = end_at - 4 * interval_seconds
+    candles = app.worker.run(app.get_kucoin_candles('S00002-USDT', '1hour', start_at=start_at, end_at=end_at))
+    assert [candle[0] // 1000 for candle in candles] == list(range(start_at, end_at + 1, interval_seconds))
+
+
+def test_rate_limited_request_is_retried(kucoin):
+    kucoin.error_rate = 0.5
+    kucoin.random = ScriptedRandom([0.0, 0.0])
+    candles = app.worker.run(app.get_kucoin_candles('S00003-USDT', '1hour', start_at=app.get_window_start('1hour', 20)))
+    assert kucoin.stats == {'candles': 3, '429': 2}
+    assert len(candles) == 20
+
+
+def test_rate_limited_request_gives_up_after_max_retries(kucoin):
+    kucoin.error_rate = 1.0
+    candles = app.worker.run(app.get_kucoin_candles('S00004-USDT', '1hour'))
+    assert candles is None
+    assert kucoin.stats['429'] == app.KUCOIN_MAX_RETRIES + 1
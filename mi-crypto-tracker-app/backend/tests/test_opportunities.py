@@ -0,0 +1,90 @@
+# Índice de oportunidades: los rankings mantenidos con bisect coinciden con ordenar desde cero tras
+# altas, cambios de recomendación y bajas; y sync_opportunity_index sigue al snapshot del líder.
+import json
+import random
+from array import array
+
+import pytest
+
+import app
+
+
+def expected_ranking(entries, rec, sort):
+    scored = [(-entry['scores'][sort], symbol) for symbol, entry in entries.items() if entry['rec'] == rec and sort in entry['scores']]
+    return [symbol for _, symbol in sorted(scored)]
+
+
+def random_update(rng, index, symbol, etag):
+    rec = rng.choice(['buy', 'sell', 'hold', 'error', 'N/A'])
+    close = rng.uniform(50, 150)
+    rsi = rng.choice([rng.uniform(0, 100), float('nan')])
+    index.update(symbol, rec, etag, close, rsi, close * rng.uniform(0.9, 1.1), close * rng.uniform(0.9, 1.1))
+
+
+def test_rankings_match_a_full_sort():
+    rng = random.Random(7)
+    index = app.OpportunityIndex()
+    symbols = [f'S{i}' for i in range(40)]
+    for step in range(2000):
+        symbol = rng.choice(symbols)
+        if rng.random() < 0.15:
+            index.discard(symbol)
+        else:
+            random_update(rng, index, symbol, f'etag-{step}')
+        if step % 100 == 0:
+            for rec in app.OPPORTUNITY_RANKED_RECS:
+                for sort in app.OPPORTUNITY_SORTS:
+                    assert [symbol for _, symbol in index.rankings[(rec, sort)]] == expected_ranking(index.entries, rec, sort)
+    members = {rec: sorted(symbol for symbol, entry in index.entries.items() if entry['rec'] == rec) for rec in app.OPPORTUNITY_RECS}
+    assert {rec: sorted(index.members[rec]) for rec in app.OPPORTUNITY_RECS} == members
+
+
+def test_same_etag_is_a_no_op_and_versions_track_membership():
+    index = app.OpportunityIndex()
+    assert index.update('A', 'buy', 'e1', 100.0, 20.0, 110.0, 95.0)
+    version = index.version
+    assert not index.update('A', 'buy', 'e1', 1.0, 1.0, 1.0, 1.0)
+    assert index.update('A', 'buy', 'e2', 100.0, 25.0, 110.0, 95.0)
+    assert index.version == version # Mismo conjunto: solo cambia la revisión
+    index.update('A', 'sell', 'e3', 100.0, 80.0, 95.0, 90.0)
+    assert index.version == version + 1
+    assert index.rankings[('buy', 'rsi')] == [] and index.rankings[('sell', 'rsi')] == [(-10.0, 'A')]
+    index.discard('A')
+    assert index.symbols() == [] and index.get_etag('A') is None
+    assert all(ranking == [] for ranking in index.rankings.values())
+
+
+def test_ranked_payload_orders_and_limits():
+    index = app.OpportunityIndex()
+    for symbol, rsi in (('A', 25.0), ('B', 10.0), ('C', 29.0)):
+        index.update(symbol, 'buy', symbol, 100.0, rsi, 110.0, 90.0)
+    data = json.loads(index.get_ranked_payload('rsi', limit=2, rec='buy')['body'])
+    assert [item['symbol'] for item in data['buy']] == ['B', 'A']
+    assert data['buy'][0]['rsi_distance'] == 20.0 and 'sell' not in data
+
+
+def analysis(rec, closes):
+    klines = app.KlineColumns(array('q', range(0, len(closes) * 1000, 1000)), array('d', closes))
+    indicators = app.calculate_indicators_for_symbol(klines.closes)
+    return app.build_analysis_entry({'overall': rec, 'sma': rec, 'rsi': 'hold', 'bb': 'hold'}, klines, indicators)
+
+
+def test_sync_follows_the_snapshot(tmp_path, monkeypatch):
+    path = str(tmp_path / 'snapshot.bin')
+    closes = [100.0 + i for i in range(60)]
+    monkeypatch.setattr(app, 'opportunity_index', app.OpportunityIndex())
+    monkeypatch.setattr(app, 'current_analysis_cache', {})
+    snapshot = app.AnalysisSnapshot(path)
+    monkeypatch.setattr(app, 'analysis_snapshot', snapshot)
+
+    app.save_analysis_snapshot({'A': analysis('buy', closes), 'B': analysis('sell', closes)}, {}, path=path)
+    snapshot.refresh()
+    app.sync_opportunity_index()
+    assert app.opportunity_index.get_payload()['data']['buy'] == ['A']
+    assert app.opportunity_index.get_etag('B') == snapshot.get_index()['B']['etag']
+
+    app.save_analysis_snapshot({'A': analysis('sell', closes)}, {}, path=path)
+    snapshot.refresh()
+    app.sync_opportunity_index()
+    data = app.opportunity_index.get_payload()['data']
+    assert (data['buy'], data['sell']) == ([], ['A']) # B dejó de estar en el snapshot
@@ -0,0 +1,30 @@
+# Publicación del snapshot por el líder: solo cuando algo cambió, y con las copias fuera del loop de fondo.
+from array import array
+
+import app
+
+
+def analysis(closes):
+    klines = app.KlineColumns(array('q', range(0, len(closes) * 1000, 1000)), array('d', closes))
+    indicators = app.calculate_indicators_for_symbol(klines.closes)
+    return app.build_analysis_entry(app.get_combined_signals_for_symbol(indicators, klines.closes), klines, indicators)
+
+
+def test_publishes_only_after_changes(saves):
+    assert not app.worker.run(app.publish_analysis_snapshot())
+    assert saves == []
+
+    app.set_analysis_entry('A', analysis([100.0 + i for i in range(60)]))
+    assert app.worker.run(app.publish_analysis_snapshot())
+    assert len(saves) == 1 and saves[0]['symbols'] == ['A']
+    assert saves[0]['thread'] is not app.worker.thread # Copias y escritura en un hilo, no en el loop
+
+    assert not app.worker.run(app.publish_analysis_snapshot())
+    assert len(saves) == 1
+
+
+def test_failed_write_stays_dirty(saves, monkeypatch):
+    monkeypatch.setattr(app, 'save_analysis_snapshot', lambda *args: False)
+    app.set_analysis_entry('A', analysis([100.0 + i for i in range(60)]))
+    assert not app.worker.run(app.publish_analysis_snapshot())
+    assert app.analysis_snapshot_dirty
@@ -0,0 +1,110 @@
+# Canal push (AnalysisEventHub): límite de clientes, reparto por símbolo, clientes lentos y deltas tras un barrido.
+import json
+import queue
+from array import array
+
+import pytest
+
+import app
+
+
+def drain(subscriber):
+    events = []
+    while True:
+        try:
+            events.append(subscriber.queue.get_nowait())
+        except queue.Empty:
+            return events
+
+
+def parse(event):
+    lines = event.strip().split('\n')
+    return lines[0].removeprefix('event: '), json.loads(lines[1].removeprefix('data: '))
+
+
+def test_subscribe_respects_max_clients(monkeypatch):
+    monkeypatch.setattr(app, 'STREAM_MAX_CLIENTS', 2)
+    hub = app.AnalysisEventHub()
+    first = hub.subscribe(frozenset({'A'}))
+    assert hub.subscribe(frozenset()) is not None
+    assert hub.subscribe(frozenset()) is None
+    hub.unsubscribe(first)
+    assert hub.subscribe(frozenset()) is not None
+    assert hub.get_stats()['clients'] == 2
+
+
+def test_publish_routes_by_symbol():
+    hub = app.AnalysisEventHub()
+    a = hub.subscribe(frozenset({'A'}))
+    b = hub.subscribe(frozenset({'B'}))
+    hub.publish('to-a', 'A')
+    hub.publish('to-all')
+    assert drain(a) == ['to-a', 'to-all']
+    assert drain(b) == ['to-all']
+    assert hub.subscribed_symbols() == {'A', 'B'}
+
+
+def test_slow_client_is_dropped_with_end_marker(monkeypatch):
+    monkeypatch.setattr(app, 'STREAM_QUEUE_SIZE', 3)
+    hub = app.AnalysisEventHub()
+    slow = hub.subscribe(frozenset())
+    for i in range(4):
+        hub.publish(f'event-{i}')
+    events = drain(slow)
+    assert events[-1] is None # El generador de /stream cierra la conexión al verlo
+    assert hub.get_stats()['clients'] == 0 and hub.get_stats()['clients_dropped'] == 1
+
+
+def analysis(rec, closes):
+    klines = app.KlineColumns(array('q', range(0, len(closes) * 1000, 1000)), array('d', closes))
+    indicators = app.calculate_indicators_for_symbol(klines.closes)
+    return app.build_analysis_entry({'overall': rec, 'sma': rec, 'rsi': 'hold', 'bb': 'hold'}, klines, indicators)
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    hub = app.AnalysisEventHub()
+    monkeypatch.setattr(app, 'event_hub', hub)
+    monkeypatch.setattr(app, 'current_analysis_cache', {})
+    monkeypatch.setattr(app, 'analysis_response_cache', {})
+    return hub
+
+
+def test_notify_sends_only_changes(hub):
+    closes = [100.0 + i for i in range(60)]
+    app.set_analysis_entry('A', analysis('hold', closes))
+    app.set_analysis_entry('B', analysis('hold', closes))
+    app.notify_analysis_updates() # Primer estado: no se envía nada
+    watcher = hub.subscribe(frozenset({'A'}))
+    other = hub.subscribe(frozenset({'C'}))
+
+    app.set_analysis_entry('A', analysis('buy', closes[:-1] + [200.0]))
+    app.notify_analysis_updates()
+    events = [parse(event) for event in drain(watcher)]
+    assert [name for name, _ in events] == ['analysis', 'opportunity_changes', 'sweep']
+    delta = events[0][1]
+    assert (delta['symbol'], delta['overall_rec'], delta['last']['close']) == ('A', 'buy', 200.0)
+    assert delta['etag'] == app.analysis_response_cache['A']['chart']['etag']
+    assert events[1][1] == {'A': 'buy'}
+    assert [parse(event)[0] for event in drain(other)] == ['opportunity_changes', 'sweep']
+
+    app.notify_analysis_updates() # Sin cambios: silencio
+    assert drain(watcher) == []
+
+
+def test_stream_releases_client_when_never_iterated(monkeypatch):
+    hub = app.AnalysisEventHub()
+    monkeypatch.setattr(app, 'event_hub', hub)
+    # Se llama a la vista directamente: el cliente de pruebas de Werkzeug siempre lee el primer trozo
+    with app.app.test_request_context('/stream?symbols=A'):
+        response = app.app.view_functions['stream']()
+    assert response.status_code == 200 and hub.get_stats()['clients'] == 1
+    response.close() # El servidor cierra la respuesta sin haberla recorrido (el cliente ya se fue)
+    assert hub.get_stats()['clients'] == 0
+
+
+def test_stream_rejects_over_the_limit(monkeypatch):
+    hub = app.AnalysisEventHub()
+    monkeypatch.setattr(app, 'event_hub', hub)
+    monkeypatch.setattr(app, 'STREAM_MAX_CLIENTS', 0)
+    assert app.app.test_client().get('/stream').status_code == 503
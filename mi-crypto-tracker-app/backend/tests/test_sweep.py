@@ -0,0 +1,90 @@
+# Barrido: el planificador reparte el presupuesto en peticiones (los símbolos en frío cuestan una por
+# temporalidad) y refresh_symbol_klines hace exactamente las peticiones que se le cuentan.
+import pytest
+
+import app
+
+
+@pytest.fixture
+def stores(monkeypatch):
+    stores = {interval: app.KlineStore(interval, store.limit) for interval, store in app.kline_stores.items()}
+    monkeypatch.setattr(app, 'kline_stores', stores)
+    monkeypatch.setattr(app, 'base_kline_store', stores[app.KUCOIN_BASE_INTERVAL])
+    monkeypatch.setattr(app, 'kline_store', stores[app.KUCOIN_INTERVAL])
+    return stores
+
+
+def test_cold_start_requests_match_the_planned_cost(kucoin, stores):
+    symbol = kucoin.symbols[0]
+    cold_cost = app.get_symbol_request_cost(symbol)
+    assert cold_cost == len(set(stores.values()))
+    before = kucoin.stats['candles']
+    assert app.worker.run(app.refresh_symbol_klines(symbol)) is not None
+    assert kucoin.stats['candles'] - before == cold_cost
+    # Ya en caliente: una sola petición (la base) y el resto se agrega
+    assert app.get_symbol_request_cost(symbol) == 1
+    before = kucoin.stats['candles']
+    assert app.worker.run(app.refresh_symbol_klines(symbol)) is not None
+    assert kucoin.stats['candles'] - before == 1
+
+
+def test_plan_spreads_cold_symbols_over_ticks(monkeypatch):
+    monkeypatch.setattr(app, 'SWEEP_TAIL_MIN_SHARE', 1.0)
+    planner = app.SweepPlanner()
+    symbols = [f'S{i}' for i in range(10)]
+    warm = set()
+
+    def cost(symbol):
+        return 1 if symbol in warm else 4
+
+    ticks = []
+    for _ in range(4):
+        picked = planner.plan(symbols, 8, app.TAIL_REFRESH_INTERVAL.total_seconds(), cost)
+        assert sum(cost(symbol) for symbol in picked) <= 8
+        ticks.append(picked)
+        warm.update(picked)
+    assert [len(picked) for picked in ticks] == [2, 2, 2, 2]
+    assert planner.get_stats()['requests'] == 8
+    assert ticks[-1] == ['S6', 'S7']
+    # Cuando quedan solo los dos en frío ya no entra nadie más; después, ocho calientes por tick
+    assert planner.plan(symbols, 8, app.TAIL_REFRESH_INTERVAL.total_seconds(), cost) == ['S8', 'S9']
+    warm.update(['S8', 'S9'])
+    assert planner.plan(symbols, 8, app.TAIL_REFRESH_INTERVAL.total_seconds(), cost) == [f'S{i}' for i in range(8)]
+
+
+def test_plan_takes_an_oversized_symbol_alone():
+    planner = app.SweepPlanner()
+    planner.record_demand('A')
+    assert planner.plan(['A', 'B'], 2, 1, lambda symbol: 4) == ['A']
+
+
+def failed_total():
+    return sum(value for _, _, value in app.sweep_failed_metric.samples())
+
+
+# Una descarga fallida no cuenta como analizada ni como saltada: va a 'failed' (y a su métrica)
+@pytest.mark.parametrize('backend', ['numpy', 'streaming'])
+def test_failed_fetches_are_counted_apart(backend, kucoin, stores, history_db, saves, monkeypatch):
+    monkeypatch.setattr(app, 'ANALYSIS_BACKEND', backend)
+    monkeypatch.setattr(app, 'analysis_fingerprints', {})
+    monkeypatch.setattr(app, 'last_sweep_stats', dict(app.last_sweep_stats))
+    ok, broken = kucoin.symbols[:2]
+    refresh = app.refresh_symbol_klines
+
+    async def refresh_or_fail(symbol):
+        return None if symbol == broken else await refresh(symbol)
+
+    monkeypatch.setattr(app, 'refresh_symbol_klines', refresh_or_fail)
+    failed_before = failed_total()
+    app.worker.run(app.scheduled_analysis_job([ok, broken]))
+    assert app.last_sweep_stats == {'symbols': 2, 'analyzed': 1, 'skipped': 0, 'failed': 1}
+    assert set(app.current_analysis_cache) == {ok} and broken not in app.analysis_fingerprints
+    app.worker.run(app.scheduled_analysis_job([ok, broken]))
+    assert app.last_sweep_stats['failed'] == 1 and app.last_sweep_stats['analyzed'] + app.last_sweep_stats['skipped'] == 1
+    assert failed_total() - failed_before == 2
+
+
+def test_filter_changed_klines_returns_failures():
+    klines = object()
+    changed, failed = app.filter_changed_klines([('A', None), ('B', klines)], force=True)
+    assert changed == [('B', klines)] and failed == ['A']